@@ -17,6 +17,9 @@ install_requires = [
 if sys.version_info[:3] < (2,6,0):
     raise ValueError("Must have Python 2.6+.")
 
+# The asyncio interface can't be compiled on Python 2.
+exclude = ['pop.aio'] if sys.version_info[0] < 3 else []
+
 
 setup(name="pop",
       version=version,
@@ -32,15 +35,23 @@ setup(name="pop",
       url="http://www.github.com/malthe/pop",
       license="GPL",
       namespace_packages=[],
-      packages = find_packages('src'),
+      packages = find_packages('src', exclude=exclude),
       package_dir = {'':'src'},
       include_package_data=True,
       zip_safe=False,
       entry_points = """
       [console_scripts]
       pop = pop.control:main
+
+      [pop.services]
+      threaded-echo = pop.services.examples:ThreadedEchoService
+      twisted-echo = pop.services.examples:TwistedEchoService
       """,
       install_requires=install_requires,
+      extras_require={
+          'msgpack': ['msgpack'],
+          'aio': ['aiozk'],
+          },
       tests_require=install_requires + [
           'nose',
           ],
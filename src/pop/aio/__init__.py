@@ -0,0 +1,380 @@
+"""Asyncio interface to the hierarchy.
+
+This module provides ``async`` equivalents of the Twisted-based
+machine agent and service operations, for use in applications that
+run on an asyncio event loop (including uvloop). It requires Python
+3 and the ``aiozk`` package (the ``aio`` extra); the package is not
+installed on Python 2.
+
+The service implementations themselves run on Twisted. The agent
+therefore starts services using a zygote process (see
+:mod:`pop.zygote`), which runs with the given interpreter::
+
+  client = aiozk.ZKClient("localhost:2181")
+  await client.start()
+
+  zygote = Zygote("localhost:2181", "/", executable="python2")
+  agent = MachineAgent(client, "", uuid, zygote=zygote)
+  pids = await agent.start()
+
+Supervision and reconciliation of the started services remain with
+the Twisted agent (``pop fg``). The layout of the hierarchy is shared
+with it (see :mod:`pop.hierarchy`).
+"""
+
+import os
+import sys
+import json
+import asyncio
+import logging
+
+from aiozk.exc import BadVersion
+from aiozk.exc import NoNode
+from aiozk.exc import NodeExists
+
+from pop import log
+from pop.exceptions import PopException
+from pop.hierarchy import added_machines
+from pop.hierarchy import analyze
+from pop.hierarchy import deployed_services
+from pop.hierarchy import index_path
+from pop.hierarchy import instance_count
+from pop.hierarchy import instance_name
+from pop.hierarchy import machine_path
+from pop.hierarchy import missing_instances
+from pop.hierarchy import service_index_paths
+from pop.hierarchy import unique
+from pop.serialization import NodeFormat
+
+
+class ZygoteError(PopException):
+    """Raised when the zygote exits with requests pending."""
+
+
+async def gather(func, items, concurrency):
+    """Call coroutine function for each item.
+
+    At most ``concurrency`` calls are in progress at any time. The
+    results are returned in the order of the items, as tuples of a
+    success flag and the result (or exception).
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(item):
+        async with semaphore:
+            return await func(item)
+
+    results = await asyncio.gather(
+        *[call(item) for item in items], return_exceptions=True
+        )
+
+    return [
+        (not isinstance(result, Exception), result) for result in results
+        ]
+
+
+class Zygote(object):
+    """Runs the zygote process (see ``pop.zygote.Zygote``)."""
+
+    def __init__(self, servers, path, executable=None):
+        self.servers = servers
+        self.path = path
+        self.executable = executable or sys.executable
+        self.pending = []
+        self._process = None
+        self._reader = None
+
+    async def start(self, machine):
+        if self._process is not None:
+            return
+
+        args = [
+            "-m", "pop.zygote", self.servers, self.path,
+            "--verbosity", str(int(log.isEnabledFor(logging.DEBUG))),
+            ]
+
+        # The workers must use the machine id of the agent.
+        env = dict(os.environ, POP_MACHINE_ID=machine)
+
+        log.debug("starting zygote...")
+        self._process = await asyncio.create_subprocess_exec(
+            self.executable, *args, env=env,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            )
+
+        log.debug("zygote started: %d." % self._process.pid)
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def fork(self, name, instance=0):
+        """Start service in a new worker; returns the pid."""
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append(future)
+
+        message = json.dumps({"name": name, "instance": instance})
+        self._process.stdin.write(message.encode("utf-8") + b"\n")
+        await self._process.stdin.drain()
+
+        return await future
+
+    async def stop(self):
+        self._process.stdin.close()
+        await self._process.wait()
+        await self._reader
+
+    async def _read(self):
+        while True:
+            line = await self._process.stdout.readline()
+            if not line:
+                break
+
+            message = json.loads(line.decode("utf-8"))
+            if "status" in message:
+                log.debug("worker exited: %(pid)d (status: %(status)d)." % (
+                    message))
+            else:
+                self.pending.pop(0).set_result(message["pid"])
+
+        log.debug("zygote stopped.")
+
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.set_exception(ZygoteError("zygote stopped."))
+
+
+class Service(object):
+    """Service at the given path (see ``pop.services.common.Service``).
+
+    The ``defaults`` are used for settings that are not given.
+    """
+
+    codec = None
+
+    def __init__(self, client, path, defaults=None):
+        assert not path.endswith("/")
+
+        self.client = client
+        self.path = path
+        self.defaults = defaults or {}
+
+    @property
+    def node_format(self):
+        return NodeFormat("json", self.codec)
+
+    async def get_settings(self):
+        settings = dict(self.defaults)
+
+        try:
+            value, stat = await self.client.get(self.path + "/settings")
+        except NoNode:
+            value = None
+
+        if value:
+            settings.update(self.node_format.loads(value))
+
+        return settings
+
+    async def deploy(self, *machines):
+        """Deploy service to one or more machines.
+
+        The machines are added to the machines declaration of the
+        service, and the service to the deployment index of each
+        machine. The changes are committed together, and retried on
+        a concurrent change. Returns the machines that were added to
+        the declaration.
+        """
+
+        log.debug("machine id: %s." % ", ".join(machines))
+
+        machines = unique(machines)
+        path = self.path + "/machines"
+        indexes = service_index_paths(self.path, machines)
+
+        await asyncio.gather(*[
+            self.client.ensure_path(index.rsplit("/", 1)[0])
+            for index in indexes
+            ])
+
+        while True:
+            (value, stat), *exists = await asyncio.gather(
+                self.client.get(path),
+                *[self.client.exists(index) for index in indexes]
+                )
+
+            declared = json.loads(value)
+            added = added_machines(declared, machines)
+            missing = [
+                index for index, found in zip(indexes, exists) if not found
+                ]
+
+            if not added and not missing:
+                return added
+
+            transaction = self.client.begin_transaction()
+
+            if added:
+                transaction.set_data(
+                    path, json.dumps(declared + added), stat.version
+                    )
+
+            for index in missing:
+                transaction.create(index)
+
+            try:
+                result = await transaction.commit()
+            except (BadVersion, NodeExists):
+                result = None
+
+            if result:
+                return added
+
+            log.debug("concurrent deploy; retrying...")
+
+
+class MachineAgent(object):
+    """Machine agent (see ``pop.machine.MachineAgent``).
+
+    The ``concurrency`` argument limits the number of requests that
+    are in flight at any time.
+    """
+
+    concurrency = 256
+
+    def __init__(self, client, path, uuid, concurrency=None, zygote=None):
+        assert not path.endswith("/")
+
+        if concurrency is not None:
+            self.concurrency = concurrency
+
+        self.client = client
+        self.path = path
+        self.name = str(uuid)
+        self.zygote = zygote
+        self.deployed = set()
+        self.running = set()
+        self.stopped = set()
+        self.instances = {}
+        self.pids = []
+
+    async def initialize(self):
+        """Create machine state node and deployment index."""
+
+        path = index_path(self.path, self.name)
+        await self.client.ensure_path(path.rsplit("/", 1)[0])
+
+        try:
+            await self.client.create(path)
+        except NodeExists:
+            pass
+        else:
+            await self.reindex()
+
+    async def reindex(self):
+        """Rebuild deployment index from the service declarations."""
+
+        log.debug("indexing services for machine: %s..." % self.name)
+
+        services = await self.client.get_children(self.path + "/services")
+        results = await gather(
+            self.get_machines, services, self.concurrency
+            )
+
+        for success, machines in results:
+            if not success:
+                raise machines
+
+        deployed = deployed_services(
+            self.name, services, [machines for success, machines in results]
+            )
+
+        async def create(name):
+            path = index_path(self.path, self.name, name)
+            try:
+                await self.client.create(path)
+            except NodeExists:
+                pass
+
+        for success, result in await gather(
+                create, deployed, self.concurrency):
+            if not success:
+                raise result
+
+        log.debug("indexed %d service(s)." % len(deployed))
+
+    async def scan(self):
+        """Analyze state of the services deployed to the machine."""
+
+        log.debug("scanning machine: %s..." % self.name)
+
+        deployed, children = await asyncio.gather(
+            self.client.get_children(index_path(self.path, self.name)),
+            self.client.get_children(machine_path(self.path, self.name)),
+            )
+
+        # A service is stopped if any of its instances is not running.
+        results = await gather(
+            lambda name: self.get_service(name).get_settings(),
+            deployed, self.concurrency
+            )
+
+        for name, (success, settings) in zip(deployed, results):
+            if not success:
+                raise settings
+
+            self.instances[name] = instance_count(settings)
+
+        self.deployed, self.running, self.stopped = analyze(
+            deployed, children, self.instances
+            )
+
+    async def get_machines(self, name):
+        """Return list of machines configured for service."""
+
+        try:
+            value = await self.client.get_data(
+                self.path + "/services/" + name + "/machines"
+                )
+        except NoNode:
+            log.warn(
+                "missing machines declaration for service: %s." %
+                name
+                )
+            return []
+
+        return json.loads(value)
+
+    def get_service(self, name):
+        return Service(self.client, self.path + "/services/" + name)
+
+    async def start(self):
+        """Start the services that are not running.
+
+        Each service runs as the number of instances given by its
+        ``workers`` setting; the instances that are not running are
+        started. Returns the process identifiers.
+        """
+
+        if self.zygote is None:
+            raise PopException("a zygote is required to start services.")
+
+        await self.initialize()
+        await self.scan()
+
+        await self.zygote.start(self.name)
+
+        requests = []
+        for name in sorted(self.stopped):
+            for instance in missing_instances(
+                    name, self.instances[name], self.running):
+                log.debug("starting service: %s..." % instance_name(
+                    name, instance))
+                requests.append(self.zygote.fork(name, instance))
+
+        pids = await asyncio.gather(*requests)
+
+        for pid in pids:
+            log.info("process started: %d." % pid)
+
+        self.pids.extend(pids)
+        return pids
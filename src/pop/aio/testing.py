@@ -0,0 +1,155 @@
+"""In-memory client (see ``pop.testing``) with the ``aiozk`` interface.
+
+Only the methods that are used by :mod:`pop.aio` are provided.
+"""
+
+import asyncio
+import posixpath
+
+from aiozk.exc import BadVersion
+from aiozk.exc import NoNode
+from aiozk.exc import NodeExists
+
+
+class Stat(object):
+    def __init__(self, version):
+        self.version = version
+
+
+class Node(object):
+    """Node in the in-memory tree."""
+
+    def __init__(self, data=b""):
+        self.data = data
+        self.version = 0
+
+
+class Result(object):
+    """Result of a transaction; false if it was not committed."""
+
+    def __init__(self, committed):
+        self.committed = committed
+
+    def __bool__(self):
+        return self.committed
+
+
+class FakeTransaction(object):
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+
+    def create(self, path, data=None):
+        self.operations.append(("create", path, data, None))
+
+    def set_data(self, path, data, version=-1):
+        self.operations.append(("set", path, data, version))
+
+    async def commit(self):
+        await self.client._request()
+        nodes = self.client.nodes
+
+        for operation, path, data, version in self.operations:
+            if operation == "create":
+                if path in nodes or posixpath.dirname(path) not in nodes:
+                    return Result(False)
+            elif path not in nodes or version not in (
+                    -1, nodes[path].version):
+                return Result(False)
+
+        for operation, path, data, version in self.operations:
+            if operation == "create":
+                self.client._create(path, data)
+            else:
+                self.client._set(path, data)
+
+        return Result(True)
+
+
+class FakeClient(object):
+    """Keeps the nodes in memory.
+
+    Each request yields to the event loop; the number of requests is
+    counted in ``requests``.
+    """
+
+    def __init__(self):
+        self.nodes = {"/": Node()}
+        self.requests = 0
+
+    async def exists(self, path, watch=False):
+        await self._request()
+        return path in self.nodes
+
+    async def create(self, path, data=None):
+        await self._request()
+        if path in self.nodes:
+            raise NodeExists()
+
+        self._create(path, data)
+        return path
+
+    async def ensure_path(self, path):
+        segments = path.strip("/").split("/")
+        for i in range(len(segments)):
+            try:
+                await self.create("/" + "/".join(segments[:i + 1]))
+            except NodeExists:
+                pass
+
+    async def get(self, path, watch=False):
+        await self._request()
+        node = self._node(path)
+        return node.data, Stat(node.version)
+
+    async def get_data(self, path, watch=False):
+        data, stat = await self.get(path)
+        return data
+
+    async def set(self, path, data, version):
+        await self._request()
+        node = self._node(path)
+        if version not in (-1, node.version):
+            raise BadVersion()
+
+        return self._set(path, data)
+
+    async def get_children(self, path, watch=False):
+        await self._request()
+        self._node(path)
+        prefix = path.rstrip("/") + "/"
+        return sorted(
+            name[len(prefix):] for name in self.nodes
+            if name.startswith(prefix) and "/" not in name[len(prefix):]
+            )
+
+    def begin_transaction(self):
+        return FakeTransaction(self)
+
+    async def _request(self):
+        self.requests += 1
+        await asyncio.sleep(0)
+
+    def _node(self, path):
+        try:
+            return self.nodes[path]
+        except KeyError:
+            raise NoNode()
+
+    def _create(self, path, data):
+        if posixpath.dirname(path) not in self.nodes:
+            raise NoNode()
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        self.nodes[path] = Node(data or b"")
+
+    def _set(self, path, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        node = self.nodes[path]
+        node.data = data
+        node.version += 1
+        return Stat(node.version)
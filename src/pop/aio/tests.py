@@ -0,0 +1,147 @@
+"""Tests for the asyncio interface.
+
+These run against an in-memory client (see ``pop.aio.testing``)::
+
+  $ python3 -m unittest pop.aio.tests
+
+"""
+
+import json
+import asyncio
+import unittest
+
+from pop.aio import MachineAgent
+from pop.aio import Service
+from pop.aio.testing import FakeClient
+
+
+class FakeZygote(object):
+    """Returns a new process identifier for each fork."""
+
+    def __init__(self):
+        self.started = None
+        self.forked = []
+
+    async def start(self, machine):
+        self.started = machine
+
+    async def fork(self, name, instance=0):
+        self.forked.append((name, instance))
+        return 1000 + len(self.forked)
+
+
+class AsyncTestCase(unittest.IsolatedAsyncioTestCase):
+    path = "/pop"
+    machine = "00000000-0000-0000-0000-000000000001"
+
+    async def asyncSetUp(self):
+        self.client = FakeClient()
+        await self.client.ensure_path(self.path + "/services")
+
+    async def add(self, name, machines=(), settings=None):
+        path = self.path + "/services/" + name
+        await self.client.create(path)
+        await self.client.create(path + "/machines", json.dumps(machines))
+        if settings is not None:
+            await self.client.create(
+                path + "/settings", json.dumps(settings)
+                )
+
+    def get_agent(self, **kwargs):
+        return MachineAgent(self.client, self.path, self.machine, **kwargs)
+
+
+class ServiceTest(AsyncTestCase):
+    async def test_settings(self):
+        await self.add("echo", settings={"port": 8080})
+        service = Service(
+            self.client, self.path + "/services/echo", {"host": "localhost"}
+            )
+        settings = await service.get_settings()
+        self.assertEqual(settings, {"host": "localhost", "port": 8080})
+
+    async def test_deploy(self):
+        await self.add("echo", ["m1"])
+        service = Service(self.client, self.path + "/services/echo")
+        added = await service.deploy("m1", "m2", "m2")
+        self.assertEqual(added, ["m2"])
+
+        value = await self.client.get_data(
+            self.path + "/services/echo/machines"
+            )
+        self.assertEqual(json.loads(value), ["m1", "m2"])
+
+        for machine in ("m1", "m2"):
+            self.assertTrue(await self.client.exists(
+                self.path + "/machines/" + machine + "/deployed/echo"
+                ))
+
+        # Deploying again changes nothing.
+        self.assertEqual(await service.deploy("m1", "m2"), [])
+        value, stat = await self.client.get(
+            self.path + "/services/echo/machines"
+            )
+        self.assertEqual(stat.version, 1)
+
+    async def test_concurrent_deploy(self):
+        await self.add("echo")
+        first = Service(self.client, self.path + "/services/echo")
+        second = Service(self.client, self.path + "/services/echo")
+        await asyncio.gather(first.deploy("m1"), second.deploy("m2"))
+
+        value = await self.client.get_data(
+            self.path + "/services/echo/machines"
+            )
+        self.assertEqual(sorted(json.loads(value)), ["m1", "m2"])
+
+
+class MachineAgentTest(AsyncTestCase):
+    async def test_reindex(self):
+        await self.add("echo", [self.machine])
+        await self.add("other", ["m2"])
+
+        agent = self.get_agent(concurrency=1)
+        await agent.initialize()
+        await agent.scan()
+        self.assertEqual(agent.deployed, {"echo"})
+        self.assertEqual(agent.stopped, {"echo"})
+
+    async def test_scan(self):
+        await self.add("echo", [self.machine])
+        await self.add("threaded", [self.machine])
+
+        agent = self.get_agent()
+        await agent.initialize()
+        await self.client.create(
+            self.path + "/machines/" + self.machine + "/echo"
+            )
+
+        await agent.scan()
+        self.assertEqual(agent.running, {"echo"})
+        self.assertEqual(agent.stopped, {"threaded"})
+
+    async def test_start(self):
+        await self.add("echo", [self.machine], {"workers": 2})
+        await self.add("threaded", [self.machine])
+
+        zygote = FakeZygote()
+        agent = self.get_agent(zygote=zygote)
+        pids = await agent.start()
+
+        self.assertEqual(zygote.started, self.machine)
+        self.assertEqual(
+            zygote.forked, [("echo", 0), ("echo", 1), ("threaded", 0)]
+            )
+        self.assertEqual(pids, [1001, 1002, 1003])
+        self.assertEqual(agent.pids, pids)
+
+    async def test_start_missing_instances(self):
+        await self.add("echo", [self.machine], {"workers": 3})
+        await self.client.ensure_path(
+            self.path + "/machines/" + self.machine + "/echo.1"
+            )
+
+        zygote = FakeZygote()
+        agent = self.get_agent(zygote=zygote)
+        await agent.start()
+        self.assertEqual(zygote.forked, [("echo", 0), ("echo", 2)])
@@ -0,0 +1,5 @@
+"""Benchmarks for the control plane.
+
+The benchmarks run against the in-memory client from
+:mod:`pop.testing` with a simulated network latency.
+"""
@@ -0,0 +1,305 @@
+"""Runner for the control-plane benchmarks.
+
+Each benchmark runs at several scales (the number of services) and
+the results are written as JSON, such that runs can be compared
+between commits::
+
+  $ python -m pop.bench.run --scale 100 --scale 1000 -o before.json
+  $ python -m pop.bench.run --scale 100 --scale 1000 -o after.json
+  $ python -m pop.bench.run --compare before.json after.json
+
+The comparison exits with a non-zero status if a benchmark got slower
+by more than the ``--threshold`` factor.
+
+A subset is selected using ``--benchmark``; the ``init``, ``add`` and
+``deploy`` steps that the later benchmarks depend on still run, but
+are not recorded.
+
+The benchmarks are:
+
+  ``init``
+    Initialize the hierarchy.
+
+  ``add``
+    Add each service (one command per service).
+
+  ``deploy``
+    Deploy each service to one of the machines.
+
+  ``scan``
+    Scan the services deployed to each machine.
+
+  ``dump``
+    Dump the tree.
+
+  ``write``
+    Write a shared state node from concurrent writers.
+
+"""
+
+import sys
+import json
+import time
+import argparse
+
+from StringIO import StringIO
+
+from twisted.internet.defer import DeferredList
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import returnValue
+
+from pop.client import conflicts
+from pop.command import Command
+from pop.dump import dump
+from pop.machine import MachineAgent
+from pop.services import ServiceRegistry
+from pop.testing import FakeZookeeperClient
+from pop.testing import FakeZookeeperServer
+from pop.utils import YAMLState
+
+SCALES = (100, 1000)
+
+BENCHMARKS = ("init", "add", "deploy", "scan", "dump", "write")
+
+# These set up the state used by the later benchmarks; they run even
+# if they're not selected (but are then not recorded).
+SETUP = ("init", "add", "deploy")
+
+
+def machine(i):
+    return "00000000-0000-0000-0000-%012d" % i
+
+
+class Benchmark(object):
+    """Runs the benchmarks in order at a single scale.
+
+    All clients connect to the same in-memory server; the
+    measurements include the requests sent.
+    """
+
+    def __init__(self, scale, machines, writers, latency):
+        self.scale = scale
+        self.machines = machines
+        self.writers = writers
+        self.latency = latency
+        self.server = FakeZookeeperServer()
+        self.services = ServiceRegistry.from_entry_points()
+        self.results = []
+
+    def connect(self):
+        client = FakeZookeeperClient(
+            server=self.server, latency=self.latency
+            )
+
+        d = client.connect()
+        d.addCallback(lambda result: client)
+        return d
+
+    @inlineCallbacks
+    def run(self, benchmarks=BENCHMARKS):
+        self.client = yield self.connect()
+        self.command = Command(self.client, "/", self.services)
+
+        last = max(BENCHMARKS.index(name) for name in benchmarks)
+
+        for name in BENCHMARKS[:last + 1]:
+            func = getattr(self, "bench_" + name)
+            setup = getattr(self, "setup_" + name, None)
+
+            if name in benchmarks:
+                if setup is not None:
+                    yield setup()
+
+                yield self.measure(name, func)
+            elif name in SETUP:
+                yield func()
+
+        returnValue(self.results)
+
+    @inlineCallbacks
+    def measure(self, name, func):
+        requests = self.client.requests
+        started = time.time()
+        extra = yield func()
+        elapsed = time.time() - started
+
+        result = {
+            "benchmark": name,
+            "scale": self.scale,
+            "time": elapsed,
+            "requests": self.client.requests - requests,
+            }
+
+        # Commands return the client.
+        if isinstance(extra, dict):
+            result.update(extra)
+        self.results.append(result)
+
+        sys.stderr.write("%-8s %-8d requests: %-8d time: %.3fs\n" % (
+            name, self.scale, result["requests"], elapsed))
+
+    def bench_init(self):
+        return self.command.cmd_init(admin_identity="admin:admin")
+
+    @inlineCallbacks
+    def bench_add(self):
+        for i in range(self.scale):
+            yield self.command.cmd_add(
+                name="service-%d" % i, factory_name="twisted-echo"
+                )
+
+    @inlineCallbacks
+    def bench_deploy(self):
+        for i in range(self.scale):
+            yield self.command.cmd_deploy(
+                machine=machine(i % self.machines), name="service-%d" % i
+                )
+
+    @inlineCallbacks
+    def setup_scan(self):
+        self.agents = []
+
+        for i in range(self.machines):
+            agent = MachineAgent(self.client, "", machine(i))
+            yield agent.initialize()
+            self.agents.append(agent)
+
+    @inlineCallbacks
+    def bench_scan(self):
+        for agent in self.agents:
+            yield agent.scan()
+
+    @inlineCallbacks
+    def bench_dump(self):
+        count = yield dump(
+            self.client, "/", StringIO(), self.client.concurrency
+            )
+        returnValue({"nodes": count})
+
+    @inlineCallbacks
+    def bench_write(self):
+        path = "/services/service-0/state/shared"
+        clients = []
+
+        for i in range(self.writers):
+            client = yield self.connect()
+            clients.append(client)
+
+        @inlineCallbacks
+        def write(client, i):
+            state = YAMLState(client, path)
+            yield state.read()
+            state["writer-%d" % i] = i
+            yield state.write()
+
+        count = sum(conflicts.values.values())
+        requests = sum(client.requests for client in clients)
+
+        yield DeferredList([
+            write(client, i) for (i, client) in enumerate(clients)
+            ], fireOnOneErrback=True, consumeErrors=True)
+
+        # The writers use clients of their own.
+        self.client.requests += sum(
+            client.requests for client in clients
+            ) - requests
+
+        returnValue({
+            "writers": self.writers,
+            "conflicts": sum(conflicts.values.values()) - count,
+            })
+
+
+def compare(before, after, threshold):
+    """Print comparison of results; returns the number of regressions."""
+
+    def index(results):
+        return dict(
+            ((result["benchmark"], result["scale"]), result)
+            for result in results["results"]
+            )
+
+    before, after = index(before), index(after)
+    regressions = 0
+
+    for key in sorted(set(before) & set(after), key=lambda key: (
+            BENCHMARKS.index(key[0]), key[1])):
+        old, new = before[key], after[key]
+        ratio = new["time"] / old["time"] if old["time"] else 1.0
+        regressed = ratio > threshold
+        regressions += regressed
+
+        print("%-8s %-8d time: %.3fs -> %.3fs (%.2fx) "
+              "requests: %d -> %d%s" % (
+                  key[0], key[1], old["time"], new["time"], ratio,
+                  old["requests"], new["requests"],
+                  " REGRESSION" if regressed else ""))
+
+    return regressions
+
+
+@inlineCallbacks
+def main(reactor, args):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scale", type=int, action="append",
+        help="number of services (may be repeated)",
+        )
+    parser.add_argument("--machines", type=int, default=10)
+    parser.add_argument("--writers", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.001)
+    parser.add_argument(
+        "--benchmark", action="append", choices=BENCHMARKS,
+        help="benchmark to run (may be repeated; default: all)",
+        )
+    parser.add_argument(
+        "--output", "-o", help="write results to file (default: stdout)",
+        )
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+        help="compare results instead of running the benchmarks",
+        )
+    parser.add_argument(
+        "--threshold", type=float, default=1.2,
+        help="slowdown reported as a regression (default: %(default)s)",
+        )
+    options = parser.parse_args(args)
+
+    if options.compare:
+        before, after = [
+            json.load(open(filename)) for filename in options.compare
+            ]
+
+        if compare(before, after, options.threshold):
+            raise SystemExit(1)
+
+        return
+
+    benchmarks = [
+        name for name in BENCHMARKS
+        if options.benchmark is None or name in options.benchmark
+        ]
+
+    results = []
+    for scale in options.scale or SCALES:
+        benchmark = Benchmark(
+            scale, options.machines, options.writers, options.latency
+            )
+        results.extend((yield benchmark.run(benchmarks)))
+
+    output = json.dumps({
+        "latency": options.latency,
+        "machines": options.machines,
+        "results": results,
+        }, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    from twisted.internet.task import react
+    react(main, (sys.argv[1:], ))
@@ -0,0 +1,78 @@
+"""Benchmark for the machine agent scan and index rebuild.
+
+Usage::
+
+  $ python -m pop.bench.scan --services 2000 --latency 0.001
+
+"""
+
+import json
+import time
+import argparse
+
+from twisted.internet.defer import inlineCallbacks
+
+from pop.machine import MachineAgent
+from pop.testing import FakeZookeeperClient
+
+MACHINE = "00000000-0000-0000-0000-000000000000"
+
+
+@inlineCallbacks
+def populate(client, path, services, machines=(MACHINE, )):
+    yield client.create(path)
+    yield client.create(path + "/services")
+    yield client.create(path + "/machines")
+
+    for i in range(services):
+        service = path + "/services/service-%d" % i
+        yield client.create(service)
+        yield client.create(service + "/machines", json.dumps(machines))
+
+
+@inlineCallbacks
+def timed(client, label, func, *args):
+    requests = client.requests
+    started = time.time()
+    yield func(*args)
+    elapsed = time.time() - started
+
+    print("%-24s requests: %-6d time: %.3fs" % (
+        label, client.requests - requests, elapsed))
+
+
+@inlineCallbacks
+def measure(client, path, concurrency):
+    agent = MachineAgent(client, path, MACHINE, concurrency=concurrency)
+    yield agent.initialize()
+
+    yield timed(
+        client, "reindex (%d in flight)" % concurrency, agent.reindex
+        )
+    yield timed(client, "scan", agent.scan)
+
+
+@inlineCallbacks
+def main(reactor, args):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--services", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.001)
+    parser.add_argument(
+        "--concurrency", type=int, action="append",
+        help="in-flight limit (may be repeated)",
+        )
+    options = parser.parse_args(args)
+
+    client = FakeZookeeperClient()
+    yield client.connect()
+    yield populate(client, "/bench", options.services)
+    client.latency = options.latency
+
+    for concurrency in options.concurrency or (1, 16, 256):
+        yield measure(client, "/bench", concurrency)
+
+
+if __name__ == "__main__":
+    import sys
+    from twisted.internet.task import react
+    react(main, (sys.argv[1:], ))
@@ -0,0 +1,84 @@
+"""Benchmark for node data codecs.
+
+Each codec encodes and decodes a settings-like dictionary at a
+range of sizes; the pure-Python YAML loader is included for
+comparison. Usage::
+
+  $ python -m pop.bench.serialization --runs 5
+
+"""
+
+import time
+import argparse
+
+import yaml
+
+from pop.serialization import codecs
+
+SIZES = (100, 1000, 10000, 100000, 1000000)
+
+
+class PurePythonYAMLCodec(object):
+    name = "yaml (pure)"
+
+    @staticmethod
+    def loads(data):
+        return yaml.load(data, Loader=yaml.SafeLoader)
+
+    @staticmethod
+    def dumps(value):
+        return yaml.dump(value, Dumper=yaml.SafeDumper)
+
+
+def payload(size):
+    """Return dictionary which encodes to roughly ``size`` bytes."""
+
+    value = {}
+    i = 0
+    while len(repr(value)) < size:
+        value["key-%d" % i] = {
+            "host": "10.0.%d.%d" % (i // 256 % 256, i % 256),
+            "port": 8000 + i,
+            "enabled": i % 2 == 0,
+            }
+        i += 1
+
+    return value
+
+
+def best(func, arg, runs):
+    timings = []
+    for i in range(runs):
+        started = time.time()
+        func(arg)
+        timings.append(time.time() - started)
+
+    return min(timings)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    options = parser.parse_args(args)
+
+    candidates = [codecs[name] for name in sorted(codecs)]
+    candidates.append(PurePythonYAMLCodec)
+
+    for size in SIZES:
+        value = payload(size)
+
+        for codec in candidates:
+            try:
+                data = codec.dumps(value)
+            except ImportError:
+                continue
+
+            print("%-8d %-12s bytes: %-8d dumps: %.4fs loads: %.4fs" % (
+                size, codec.name, len(data),
+                best(codec.dumps, value, options.runs),
+                best(codec.loads, data, options.runs),
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Benchmark for process spawn latency against open descriptors.
+
+The parent process opens a number of descriptors, then starts
+``/bin/true`` repeatedly using each method and waits for it to exit.
+Usage::
+
+  $ python -m pop.bench.spawn --runs 20
+
+"""
+
+import os
+import time
+import argparse
+import resource
+import subprocess
+
+from twisted.internet.process import _listOpenFDs
+
+from pop.process import fork
+from pop.process import close_fds
+from pop.exceptions import ProcessForked
+
+COUNTS = (10, 100, 1000, 10000)
+ARGV = ["/bin/true"]
+
+
+def spawn(argv, posix_spawn):
+    """Execute ``argv`` in a new process and return its pid.
+
+    Only the standard streams are inherited. With ``posix_spawn``, the
+    descriptors are closed using a file action each (which requires
+    Python 3.8 or later); otherwise we fork and exec.
+    """
+
+    if posix_spawn:
+        file_actions = [
+            (os.POSIX_SPAWN_CLOSE, fd) for fd in _listOpenFDs() if fd >= 3
+            ]
+
+        return os.posix_spawnp(
+            argv[0], argv, os.environ, file_actions=file_actions
+            )
+
+    pid = os.fork()
+    if pid == 0:
+        # The child process must either exec or _exit.
+        try:
+            close_fds()
+            os.execvp(argv[0], argv)
+        except:
+            pass
+        os._exit(127)
+
+    return pid
+
+
+def run_fork():
+    try:
+        pid = fork()
+    except ProcessForked:
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+
+
+def run_spawn():
+    os.waitpid(spawn(ARGV, posix_spawn=False), 0)
+
+
+def run_posix_spawn():
+    os.waitpid(spawn(ARGV, posix_spawn=True), 0)
+
+
+def run_subprocess():
+    subprocess.Popen(ARGV, close_fds=True).wait()
+
+
+METHODS = [
+    ("fork", run_fork),
+    ("fork+exec", run_spawn),
+    ("subprocess", run_subprocess),
+    ]
+
+if hasattr(os, "posix_spawnp"):
+    METHODS.append(("posix_spawn", run_posix_spawn))
+
+
+def median(func, runs):
+    timings = []
+    for i in range(runs):
+        started = time.time()
+        func()
+        timings.append(time.time() - started)
+
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=20)
+    options = parser.parse_args(args)
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    except (ValueError, resource.error):
+        pass
+
+    null = os.open(os.devnull, os.O_RDONLY)
+    fds = []
+
+    for count in COUNTS:
+        if count + 32 > soft:
+            print("%-8d skipped (limit: %d)" % (count, soft))
+            continue
+
+        while len(fds) < count:
+            fds.append(os.dup(null))
+
+        for name, func in METHODS:
+            print("%-8d %-12s %.2fms" % (
+                count, name, median(func, options.runs) * 1000))
+
+    for fd in fds:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Benchmark for command-line startup time.
+
+Each command line is parsed in a fresh interpreter; the command
+itself is not run. Usage::
+
+  $ python -m pop.bench.startup --runs 10
+
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+COMMANDS = (
+    ["--help"],
+    ["status", "example"],
+    ["add", "--help"],
+    )
+
+SCRIPT = """\
+import sys
+from pop.control import parse
+try:
+    parse(sys.argv[1:])
+except SystemExit:
+    pass
+"""
+
+
+def measure(argv, runs):
+    timings = []
+    for i in range(runs):
+        started = time.time()
+        subprocess.check_call(
+            [sys.executable, "-c", SCRIPT] + argv,
+            stdout=open("/dev/null", "w"),
+            )
+        timings.append(time.time() - started)
+
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    options = parser.parse_args(args)
+
+    for argv in COMMANDS:
+        median = measure(argv, options.runs)
+        print("pop %-20s median: %.3fs" % (" ".join(argv), median))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
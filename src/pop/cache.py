@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+from twisted.internet.defer import succeed
+
+
+class NodeCache(object):
+    """Least-recently-used cache of node data and children.
+
+    Each entry is fetched together with a watch; when the watch
+    fires (or the session expires), the entry is dropped. At most
+    ``size`` entries are kept.
+
+    The ``hits`` and ``misses`` attributes count lookups.
+    """
+
+    def __init__(self, client, size=1024):
+        self.client = client
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        """Return deferred node data and stat."""
+
+        return self._lookup("data", path, self.client.get_and_watch)
+
+    def get_children(self, path):
+        """Return deferred list of children."""
+
+        d = self._lookup(
+            "children", path, self.client.get_children_and_watch
+            )
+        d.addCallback(list)
+        return d
+
+    def invalidate(self, path):
+        """Drop entries for path."""
+
+        self.entries.pop(("data", path), None)
+        self.entries.pop(("children", path), None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def _lookup(self, kind, path, fetch):
+        key = kind, path
+
+        try:
+            result = self.entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            self.entries[key] = result
+            self.hits += 1
+            return succeed(result)
+
+        self.misses += 1
+        d, watch = fetch(path)
+
+        @watch.addBoth
+        def _invalidate(event):
+            self.entries.pop(key, None)
+
+        @d.addCallback
+        def _store(result):
+            if not watch.called:
+                self.entries[key] = result
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+            return result
+
+        return d
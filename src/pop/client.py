@@ -1,12 +1,260 @@
+from pop import log
+from pop import metrics
+from pop.cache import NodeCache
+from pop.utils import gather
+
 from txzookeeper import client
+from txzookeeper.client import ZOO_OPEN_ACL_UNSAFE
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import DeferredList, succeed
+from twisted.internet.defer import CancelledError
+from zookeeper import BadVersionException
+from zookeeper import EPHEMERAL
 from zookeeper import NodeExistsException
 from zookeeper import NoNodeException
 from zookeeper import NotEmptyException
 
+request_seconds = metrics.histogram(
+    "pop_zookeeper_request_seconds", "Latency of ZooKeeper requests.",
+    ("operation", ),
+    )
+
+request_errors = metrics.counter(
+    "pop_zookeeper_errors_total", "ZooKeeper requests that failed.",
+    ("operation", "error"),
+    )
+
+conflicts = metrics.counter(
+    "pop_zookeeper_conflicts_total",
+    "Conditional writes that failed due to a concurrent change.",
+    ("operation", ),
+    )
+
+
+class Transaction(object):
+    """Batch of operations that are committed together.
+
+    The operations are pipelined: all requests are sent before any
+    reply is awaited, and since ZooKeeper applies the requests of a
+    session in order, a batch costs a single round-trip.
+
+    If an operation fails, the operations that went through are
+    undone in reverse order and the first error is raised. To make
+    this possible, the data of a node is read (in the same pipeline)
+    before it's changed or deleted; for a deletion, the ACL is read
+    too, such that the node can be restored as it was. An ephemeral
+    node that belongs to another session can't be restored.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def create(self, path, data="", acls=[ZOO_OPEN_ACL_UNSAFE], flags=0):
+        self.operations.append(("create", path, (data, acls, flags)))
+        return self
+
+    def delete(self, path, version=-1):
+        self.operations.append(("delete", path, (version, )))
+        return self
+
+    def set(self, path, data="", version=-1):
+        self.operations.append(("set", path, (data, version)))
+        return self
+
+    def check(self, path, version):
+        self.operations.append(("check", path, (version, )))
+        return self
+
+    @inlineCallbacks
+    def commit(self):
+        """Send operations and return list of results."""
+
+        client = self.client
+        requests = []
+
+        for kind, path, args in self.operations:
+            if kind == "set":
+                previous = client.get(path)
+            elif kind == "delete":
+                previous = self._read(path)
+            else:
+                previous = None
+
+            if kind == "check":
+                d = client.exists(path)
+                d.addCallback(self._check, path, *args)
+            else:
+                d = getattr(client, kind)(path, *args)
+
+            requests.append(DeferredList(
+                [d, previous or succeed(None)],
+                consumeErrors=True,
+                ))
+
+        results = yield DeferredList(requests)
+        failure = None
+        undo = []
+
+        for (kind, path, args), (ok, replies) in \
+                zip(self.operations, results):
+            (success, result), (read, previous) = replies
+
+            if not success:
+                failure = failure or result
+            elif kind != "check" and read:
+                undo.append((kind, path, args, previous))
+
+        if failure is not None:
+            yield self._undo(reversed(undo))
+            failure.raiseException()
+
+        returnValue([replies[0][1] for ok, replies in results])
+
+    def _read(self, path):
+        """Return data, ACL and metadata of node."""
+
+        d = DeferredList(
+            [self.client.get(path), self.client.get_acl(path)],
+            fireOnOneErrback=True, consumeErrors=True,
+            )
+
+        @d.addCallback
+        def _combine(results):
+            (ok, (data, stat)), (ok, (acls, ignored)) = results
+            return data, acls, stat
+
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+    def _undo(self, operations):
+        client = self.client
+        client_id = client.client_id
+        session = client_id[0] if client_id else None
+        requests = []
+
+        for kind, path, args, previous in operations:
+            if kind == "create":
+                requests.append(client.delete(path))
+            elif kind == "set":
+                requests.append(client.set(path, previous[0]))
+            elif kind == "delete":
+                data, acls, stat = previous
+                owner = stat["ephemeralOwner"]
+                if owner and owner != session:
+                    log.warn("unable to restore ephemeral node %s of "
+                             "another session." % path)
+                    continue
+
+                requests.append(client.create(
+                    path, data, acls, EPHEMERAL if owner else 0
+                    ))
+
+        d = DeferredList(requests, consumeErrors=True)
+
+        @d.addCallback
+        def _log(results):
+            for success, result in results:
+                if not success:
+                    log.warn("unable to undo operation: %s." %
+                             result.getErrorMessage())
+
+        return d
+
+    @staticmethod
+    def _check(stat, path, version):
+        if stat is None:
+            raise NoNodeException(path)
+
+        if stat["version"] != version:
+            conflicts.inc("check")
+            raise BadVersionException(path)
+
+        return stat
+
 
 class ZookeeperClient(client.ZookeeperClient):
-    """Adds convenience methods."""
+    """Adds convenience methods.
+
+    The ``concurrency`` attribute limits the number of requests in
+    flight for operations that work on a subtree.
+
+    If ``cache_size`` is given, reads through :meth:`get_cached` and
+    :meth:`get_children_cached` are served from a local cache which
+    is kept up to date using watches.
+
+    The latency and errors of requests are recorded for each type of
+    operation (see ``pop.metrics``).
+    """
+
+    concurrency = 64
+
+    def __init__(self, servers=None, session_timeout=None, cache_size=0):
+        super(ZookeeperClient, self).__init__(servers, session_timeout)
+        self._known_paths = set()
+        self.cache = NodeCache(self, cache_size) if cache_size else None
+
+    def create(self, path, data="", acls=[ZOO_OPEN_ACL_UNSAFE], flags=0):
+        return self._measure("create", super(ZookeeperClient, self).create(
+            path, data, acls, flags))
+
+    def delete(self, path, version=-1):
+        return self._measure("delete", super(ZookeeperClient, self).delete(
+            path, version))
+
+    def set(self, path, data="", version=-1):
+        return self._measure("set", super(ZookeeperClient, self).set(
+            path, data, version))
+
+    def _get(self, path, watcher):
+        return self._measure("get", super(ZookeeperClient, self)._get(
+            path, watcher))
+
+    def _get_children(self, path, watcher):
+        return self._measure(
+            "get_children",
+            super(ZookeeperClient, self)._get_children(path, watcher)
+            )
+
+    def _exists(self, path, watcher):
+        return self._measure("exists", super(ZookeeperClient, self)._exists(
+            path, watcher))
+
+    def _measure(self, operation, d):
+        request_seconds.time(d, operation)
+
+        @d.addErrback
+        def failed(failure):
+            request_errors.inc(operation, failure.type.__name__)
+            if failure.check(BadVersionException):
+                conflicts.inc(operation)
+            return failure
+
+        return d
+
+    def get_cached(self, path):
+        """Get node data, using the cache if enabled."""
+
+        if self.cache is None:
+            return self.get(path)
+
+        return self.cache.get(path)
+
+    def get_children_cached(self, path):
+        """Get children, using the cache if enabled."""
+
+        if self.cache is None:
+            return self.get_children(path)
+
+        return self.cache.get_children(path)
+
+    def transaction(self):
+        """Return new transaction."""
+
+        return Transaction(self)
 
     @inlineCallbacks
     def create_or_clear(self, path, **kwargs):
@@ -15,46 +263,114 @@ class ZookeeperClient(client.ZookeeperClient):
         try:
             yield self.create(path, **kwargs)
         except NodeExistsException:
-            children = yield self.get_children(path)
-            for name in children:
-                yield self.recursive_delete(path + "/" + name)
+            yield self.clear(path)
 
-    @inlineCallbacks
-    def recursive_delete(self, path, **kwargs):
+    def clear(self, path):
+        """Recursively delete the contents of path."""
+
+        return self._delete_tree(path, 1)
+
+    def recursive_delete(self, path):
         """Recursively delete path."""
 
+        return self._delete_tree(path, 0)
+
+    @inlineCallbacks
+    def list_tree(self, path):
+        """Return the paths of the subtree at path, level by level.
+
+        The children of all nodes on a level are requested together.
+        """
+
+        levels = []
+        level = [path]
+
+        while level:
+            levels.append(level)
+            results = yield gather(self.get_children, level, self.concurrency)
+
+            level = []
+            for parent, (success, children) in zip(levels[-1], results):
+                if not success:
+                    children.trap(NoNodeException)
+                    continue
+
+                prefix = parent.rstrip("/") + "/"
+                level.extend(prefix + name for name in children)
+
+        returnValue(levels)
+
+    @inlineCallbacks
+    def _delete_tree(self, path, depth):
+        """Delete the nodes of the subtree at path, leaves first.
+
+        Levels above ``depth`` are kept. If nodes are added while
+        the tree is being deleted, we start over.
+        """
+
         while True:
-            try:
-                yield self.delete(path, **kwargs)
-            except NoNodeException:
-                break
-            except NotEmptyException:
-                children = yield self.get_children(path)
-                for name in children:
-                    yield self.recursive_delete(path + "/" + name)
-            else:
+            levels = yield self.list_tree(path)
+            retry = False
+
+            for level in reversed(levels[depth:]):
+                results = yield gather(self.delete, level, self.concurrency)
+
+                for success, result in results:
+                    if not success:
+                        if result.check(NotEmptyException):
+                            retry = True
+                        else:
+                            result.trap(NoNodeException)
+
+            if not retry:
                 break
 
     @inlineCallbacks
     def create_path(self, path, **kwargs):
-        """Create nodes required to complete path."""
+        """Create nodes required to complete path.
+
+        Paths that are known to exist are remembered (until a watch
+        tells us otherwise) such that repeated calls are free.
+        """
+
+        parent = path[:path.rfind("/")]
+        if not parent or parent in self._known_paths:
+            return
 
-        i = 0
-        while i < len(path):
-            i = path.find("/", i)
+        stat = yield self._watch_path(parent)
 
-            if i < 0:
-                return
+        if stat is None:
+            # The missing nodes are created in a single pipeline,
+            # followed by a check that also watches the path.
+            requests = []
+            i = path.find("/", 1)
+            while i > 0:
+                requests.append(self.create(path[:i], **kwargs))
+                i = path.find("/", i + 1)
 
-            subpath = path[:i]
+            d = self._watch_path(parent)
+            results = yield DeferredList(requests, consumeErrors=True)
 
-            if i > 0:
-                try:
-                    yield self.create(subpath, **kwargs)
-                except NodeExistsException:
-                    pass
+            for success, result in results:
+                if not success:
+                    result.trap(NodeExistsException)
 
-            i += 1
+            yield d
+
+    def _watch_path(self, path):
+        d, watch = self.exists_and_watch(path)
+
+        @d.addCallback
+        def _known(stat):
+            if stat is not None:
+                self._known_paths.add(path)
+            return stat
+
+        @watch.addBoth
+        def _forget(event):
+            self._known_paths.discard(path)
+
+        return d
 
     def set_or_create(self, path, *args, **kwargs):
         """Sets the data of a node at the given path, or creates it."""
@@ -87,6 +403,7 @@ class ZookeeperClient(client.ZookeeperClient):
         children = yield d
 
         if name in children:
+            watch.addErrback(lambda failure: failure.trap(CancelledError))
             watch.cancel()
             deferred = self.get(path)
 
@@ -1,67 +1,34 @@
 import os
+import re
 import sys
 import json
-import shutil
 import signal
 import functools
 import zookeeper
 
-from StringIO import StringIO
-
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredList
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.defer import returnValue
-from twisted.python.failure import Failure
 
 from txzookeeper.client import ZOO_OPEN_ACL_UNSAFE
 
 from zookeeper import PERM_ALL
+from zookeeper import NoNodeException
 from zookeeper import NodeExistsException
 
 from pop import log
-from pop.utils import YAMLState
+from pop import metrics
+from pop.dump import dump
+from pop.manifest import apply as apply_manifest
+from pop.manifest import load as load_manifest
+from pop.utils import check_service_name
+from pop.hierarchy import instance_name
 from pop.utils import local_machine_uuid
 from pop.exceptions import StateException
 from pop.exceptions import ServiceException
 from pop.machine import MachineAgent
-
-
-def run(func, debug, options):
-    from twisted.internet import reactor
-
-    def wrapper():
-        d = func(options)
-
-        @d.addCallback
-        def disconnect(client):
-            return client.close()
-
-        @d.addBoth
-        def handle_exit(result, stream=sys.stderr, reactor=reactor):
-            if isinstance(result, Failure):
-                if debug:
-                    tracebackIO = StringIO()
-                    result.printTraceback(file=tracebackIO)
-                    log.warn(tracebackIO.getvalue())
-
-                message = result.getErrorMessage()
-                for i, line in enumerate(message.split('\n')):
-                    line = line[0:1].lower() + line[1:]
-
-                    if i == 0:
-                        line = "error - %s." % line.rstrip('.')
-
-                    log.error(line)
-            else:
-                name = func.__name__.split('_', 1)[-1]
-                log.debug("done - '%s' completed OK.\n" % name)
-
-            if reactor.running:
-                reactor.stop()
-
-        return d
-
-    reactor.callWhenRunning(wrapper)
-    reactor.run()
+from pop.zygote import Zygote
 
 
 def connected(func):
@@ -73,9 +40,11 @@ def connected(func):
             ", ".join(("%s=%r" % args for args in kwargs.items()))
             ))
 
-        log.debug("connecting to zookeeper...")
-        yield command.client.connect()
-        log.debug("connected.")
+        if not command.client.connected:
+            log.debug("connecting to zookeeper...")
+            yield command.client.connect()
+            log.debug("connected.")
+
         yield func(command, **kwargs)
         returnValue(command.client)
         log.debug("connection closed.")
@@ -104,7 +73,9 @@ class Command(object):
     @inlineCallbacks
     def get_service(self, name):
         path = self.get_service_path(name)
-        factory_name, metadata = yield self.client.get(path + "/type")
+        factory_name, metadata = yield self.client.get_cached(
+            path + "/type"
+            )
         factory = self.get_service_factory(factory_name)
         service = factory(self.client, path)
         returnValue(service)
@@ -126,29 +97,85 @@ class Command(object):
             log.info("using name: '%s'." % factory_name)
             name = factory_name
 
+        check_service_name(name)
         path = self.get_service_path(name)
         factory = self.get_service_factory(factory_name)
         service = factory(self.client, path)
-        yield service.add()
+        yield service.add(options)
+
+    @twisted
+    def cmd_apply(self, manifest):
+        with open(manifest) as f:
+            services = load_manifest(f)
+
+        log.debug("applying manifest with %d service(s)..." % len(services))
+        changes = yield apply_manifest(
+            self.client, self.path, self.services, services,
+            self.client.concurrency,
+            )
+
+        for name, action, detail in changes:
+            sys.stdout.write("%-12s %s (%s)\n" % (action, name, detail))
 
-        if options:
-            settings = yield service.get_settings()
-            settings.update(options)
-            yield settings.save()
+        log.info("manifest applied (%d change(s))." % len(changes))
 
     @twisted
-    def cmd_fg(self):
+    def cmd_fg(self, zygote=False, parallelism=None, metrics_port=None):
         uuid = local_machine_uuid()
-        agent = MachineAgent(self.client, self.path, uuid)
 
-        yield agent.initialize()
-        yield agent.scan()
+        if metrics_port is not None:
+            port = metrics.listen(metrics_port)
+            log.info("serving metrics on: http://%s:%d/." % (
+                port.getHost().host, port.getHost().port))
+        else:
+            port = None
+
+        if zygote:
+            zygote = Zygote(self.client.servers, self.path)
+            zygote.start()
+        else:
+            zygote = None
+
+        agent = MachineAgent(
+            self.client, self.path[:-1], uuid, zygote=zygote,
+            parallelism=parallelism,
+            )
 
         try:
             yield agent.start()
         except ServiceException as exc:
+            # This is a forked service process; the metrics are
+            # served by the agent only.
+            if port is not None:
+                yield port.stopListening()
+                port = None
+
             name = str(exc)
-            yield self.cmd_start(name)
+            yield self.cmd_start(name, wait=True, instance=exc.instance)
+
+        if zygote is not None:
+            yield zygote.stop()
+
+        if port is not None:
+            yield port.stopListening()
+
+    @twisted
+    def cmd_daemon(self, socket):
+        from pop.daemon import listen
+
+        stopped = Deferred()
+
+        def session_event(client, event):
+            if event.state_name == "expired" and not stopped.called:
+                log.warn("session expired; stopping daemon.")
+                stopped.callback(None)
+
+        self.client.set_session_callback(session_event)
+        port = listen(self.client, self.services, socket)
+        log.info("daemon listening on: %s." % socket)
+
+        yield stopped
+        yield port.stopListening()
 
     @twisted
     def cmd_deploy(self, machine, name):
@@ -166,52 +193,63 @@ class Command(object):
     def cmd_dump(self, format):
         assert format == 'yaml'
         path = self.path if self.path == "/" else self.path[:-1]
-        state = YAMLState(self.client, path)
-        yield state.read()
-        stream = state.dump()
-        stream.seek(0)
-        shutil.copyfileobj(stream, sys.stdout)
-        log.info("state output to stdout (%d bytes)." % stream.tell())
+        count = yield dump(
+            self.client, path, sys.stdout, self.client.concurrency
+            )
+        log.info("state output to stdout (%d nodes)." % count)
 
     @twisted
     def cmd_init(self, admin_identity):
         yield self._initialize_hierarchy(admin_identity)
 
     @twisted
-    def cmd_start(self, name):
+    def cmd_start(self, name, wait=False, instance=0):
         uuid = local_machine_uuid()
         machine = str(uuid)
 
         service = yield self.get_service(name)
-        log.info("starting service: %r..." % name)
+        service.instance = instance
+        log.info("starting service: %r..." % instance_name(name, instance))
         state = yield service.start()
 
         log.debug("registering service on machine: %s..." % machine)
 
+        # Each instance of a service registers under its own name.
         yield self.client.create(
-            self.path + "machines/" + machine + "/" + name,
+            self.path + "machines/" + machine + "/" +
+            instance_name(name, instance),
             str(os.getpid()),
             flags=zookeeper.EPHEMERAL,
             )
 
         yield self.client.create(
-            service.path + "/state/" + machine,
-            json.dumps(state),
+            service.path + "/state/" + instance_name(machine, instance),
+            service.node_format.dumps(state),
             flags=zookeeper.EPHEMERAL,
             )
 
+        stopped = Deferred()
+
         def stop(signum, frame, service=service):
             from twisted.internet import reactor
             reactor.callWhenRunning(service.stop)
 
+            if not stopped.called:
+                reactor.callWhenRunning(stopped.callback, None)
+
         signal.signal(signal.SIGHUP, stop)
 
+        # Keep the process running until the service is stopped.
+        if wait:
+            yield stopped
+
     @twisted
-    def cmd_status(self):
-        path = self.path + "services/" + self.options.name
-        t, metadata = yield self.client.get(path + "/type")
-        machines = yield self.client.get_children(path + "/machines")
-        sys.stdout.write("status:   %s\n" % self.options.name)
+    def cmd_status(self, name):
+        path = self.get_service_path(name)
+        t, metadata = yield self.client.get_cached(path + "/type")
+        value, metadata = yield self.client.get(path + "/machines")
+        machines = json.loads(value)
+        sys.stdout.write("status:   %s\n" % name)
         sys.stdout.write("type:     %s\n" % t)
         if machines:
             sys.stdout.write("machines: %s\n" % ", ".join(machines))
@@ -223,22 +261,39 @@ class Command(object):
         uuid = local_machine_uuid()
         machine = str(uuid)
 
-        path = self.path + "machines/" + machine + "/" + name
+        path = self.path + "machines/" + machine
         log.debug("getting pid for service: %s..." % name)
-        d, watch = yield self.client.get_and_watch(path)
 
-        pid, metadata = yield d
+        # Stop all instances of the service.
+        children = yield self.client.get_children(path)
+        pattern = re.compile(r"^%s(\.\d+)?$" % re.escape(name))
+        watches = []
+
+        for child in sorted(children):
+            if pattern.match(child) is None:
+                continue
+
+            d, watch = self.client.get_and_watch(path + "/" + child)
+
+            try:
+                pid, metadata = yield d
+            except NoNodeException:
+                continue
+
+            if pid is None:
+                continue
 
-        if pid is None:
-            log.info("no pid found; service probably not running.")
-        else:
             pid = int(pid)
 
             log.debug("sending SIGHUP to process: %d." % pid)
             os.kill(pid, signal.SIGHUP)
+            watches.append(watch)
 
+        if not watches:
+            log.info("no pid found; service probably not running.")
+        else:
             log.debug("waiting for ephemeral node to disappear...")
-            yield watch
+            yield DeferredList(watches)
 
     @inlineCallbacks
     def _initialize_hierarchy(self, admin_identity):
@@ -247,9 +302,6 @@ class Command(object):
                  "perms": self.permissions,
                  }, ZOO_OPEN_ACL_UNSAFE]
 
-        create = self.client.create_or_clear if self.force else \
-                 self.client.create
-
         # If the hierarchy root path is non-trivial, we create it
         # immediately. Note that this is currently only imagined
         # useful for automated testing.
@@ -265,12 +317,18 @@ class Command(object):
         if self.force:
             log.warn("using '--force' to initialize hierarchy.")
 
+            clear = self.client.create_or_clear
+            yield clear(self.path + "machines", acls=acls)
+            yield clear(self.path + "services", acls=acls)
+            return
+
+        transaction = self.client.transaction()
+        transaction.create(self.path + "machines", acls=acls)
+        transaction.create(self.path + "services", acls=acls)
+
         try:
-            yield create(self.path + "machines", acls=acls)
-            yield create(self.path + "services", acls=acls)
+            yield transaction.commit()
         except NodeExistsException as exc:
-            assert not self.force
-
             raise StateException(
                 "%s!\nIf you're sure, run command again "
                 "with '--force'." % exc
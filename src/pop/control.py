@@ -1,18 +1,19 @@
+"""Command-line utility.
+
+Only the argument parser is set up when this module is imported; the
+client and the commands are imported when a command runs (and not at
+all when it runs in the control daemon).
+"""
+
 import os
 import sys
+import uuid
 import logging
 import argparse
-import venusian
 import pkg_resources
 
-from zookeeper import set_log_stream
-from pop.client import ZookeeperClient
-
 from pop import log
-from pop.command import Command
-from pop.command import run
-from pop import services
-from pop.utils import autocast
+from pop.services import ServiceRegistry
 
 LEVELS = (
     logging.DEBUG, logging.INFO
@@ -21,8 +22,54 @@ LEVELS = (
 DESCRIPTION = "Automated build, deployment and service management tool."
 
 
+def autocast(string, types):
+    for cast in types:
+        try:
+            return cast(string)
+        except BaseException:
+            pass
+
+    return string
+
+
+def machine_id(string):
+    """Argument type of the machine identifier (a UUID)."""
+
+    try:
+        uuid.UUID(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid machine id: %r (expected a UUID)" % string
+            )
+
+    return string
+
+
 class ExtraArgumentParser(argparse.ArgumentParser):
-    """An argument parser that accepts additional arguments."""
+    """An argument parser that accepts additional arguments.
+
+    If a service registry is given (``services``), the services that
+    have a description are listed in the help. The descriptions are
+    looked up (importing the service factories) only when the help is
+    formatted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.services = kwargs.pop('services', None)
+        super(ExtraArgumentParser, self).__init__(*args, **kwargs)
+
+    def format_help(self):
+        if self.services is not None:
+            lines = []
+            for name in self.services:
+                description = self.services.describe(name)
+                if description is not None:
+                    lines.append("  %-22s%s" % (name, description))
+
+            if lines:
+                self.epilog = "\n".join(["services:"] + lines)
+
+        return super(ExtraArgumentParser, self).format_help()
 
     def parse_known_args(self, *args, **kwargs):
         args, argv = super(ExtraArgumentParser, self).parse_known_args(
@@ -43,13 +90,14 @@ class CommandConfiguration(object):
     available_parsers = []
     register = available_parsers.append
 
+    # Called with the servers and client options to connect
+    # (default: ``pop.client.ZookeeperClient``).
+    client_factory = None
+
     def __init__(self, subparsers):
         self.subparsers = subparsers
 
-        scanner = venusian.Scanner()
-        scanner.scan(services)
-
-        self.services = scanner.registry
+        self.services = ServiceRegistry.from_entry_points()
 
     def __call__(self):
         for configure in self.available_parsers:
@@ -62,11 +110,16 @@ class CommandConfiguration(object):
         """Wrap command class in constructor."""
 
         def command(options):
-            client = ZookeeperClient(
-                "%s:%d" % (options.pop('host'), options.pop('port')),
-                session_timeout=1000
-                )
+            from pop import daemon
+
+            servers = "%s:%d" % (options.pop('host'), options.pop('port'))
+            cache_size = options.pop('cache_size')
 
+            socket = options.pop('daemon_socket') or daemon.SOCKET
+            if name == "daemon":
+                options['socket'] = socket
+
+            machine_id = options.pop('machine_id')
             path = options.pop('path_prefix')
             force = options.pop('force')
             extra = options.pop('extra')
@@ -76,16 +129,51 @@ class CommandConfiguration(object):
             # that's something we're willing to accept.
             options.update(extra)
 
-            controller = Command(client, path, self.services, force)
-            method = getattr(controller, "cmd_%s" % name)
-            return method(**options)
+            def run_command():
+                from zookeeper import set_log_stream
+                from pop.command import Command
+                from pop.utils import set_local_machine_uuid
+
+                set_log_stream(open(os.devnull, 'w'))
+
+                client_factory = self.client_factory
+                if client_factory is None:
+                    from pop.client import ZookeeperClient as client_factory
+
+                client = client_factory(
+                    servers, session_timeout=1000, cache_size=cache_size,
+                    )
+
+                if machine_id is not None:
+                    set_local_machine_uuid(machine_id)
+
+                controller = Command(client, path, self.services, force)
+                return getattr(controller, "cmd_%s" % name)(**options)
+
+            if name not in daemon.COMMANDS:
+                return run_command()
+
+            # Run the command in the daemon if possible; this reuses
+            # its connection.
+            d = daemon.proxy(
+                name, servers, path, force, options, socket, machine_id
+                )
+
+            @d.addErrback
+            def connect(failure):
+                failure.trap(daemon.DaemonUnavailable)
+                log.debug("daemon not available; connecting directly.")
+                return run_command()
+
+            return d
 
         return command
 
     @register
     def configure_add_parser(self):
         sub_parser = self.subparsers.add_parser(
-            'add', help='add service',
+            'add', help='add service', services=self.services,
+            formatter_class=argparse.RawDescriptionHelpFormatter,
             )
 
         sub_parser.add_argument(
@@ -104,18 +192,31 @@ class CommandConfiguration(object):
         # that it's a good programming pattern.
         # service_parser.type = converter
 
-        for name, factory in self.services.items():
-            if factory is None:
-                continue
+        # The service factories are not imported here; the services
+        # are described in the help of the command (see above).
+        for name in self.services:
+            service_parser.add_parser(name)
 
-            if factory.description is None:
-                p = argparse.ArgumentParser()
-            else:
-                p = service_parser.add_parser(
-                    name, help=factory.description,
-                    )
+        return sub_parser
+
+    @register
+    def configure_apply_parser(self):
+        sub_parser = self.subparsers.add_parser(
+            'apply', help='add, configure and deploy services from manifest',
+            )
+
+        sub_parser.add_argument(
+            dest='manifest', metavar='MANIFEST',
+            help='path to manifest file (YAML)',
+            )
+
+        return sub_parser
 
-            service_parser.choices[name] = p
+    @register
+    def configure_daemon_parser(self):
+        sub_parser = self.subparsers.add_parser(
+            'daemon', help='run control daemon in foreground',
+            )
 
         return sub_parser
 
@@ -144,8 +245,18 @@ class CommandConfiguration(object):
             )
 
         sub_parser.add_argument(
-            'name', action='store', default=None,
-            help='name of the service to start',
+            '--zygote', action='store_true',
+            help='start services from a pre-forked process',
+            )
+
+        sub_parser.add_argument(
+            '--parallelism', action='store', type=int, metavar='N',
+            help='number of services to start at a time',
+            )
+
+        sub_parser.add_argument(
+            '--metrics-port', action='store', type=int, metavar='PORT',
+            help='serve metrics on this local port (Prometheus format)',
             )
 
         return sub_parser
@@ -243,6 +354,24 @@ def parse(args):
         default=2181,
         )
 
+    parser.add_argument(
+        '--cache-size', action='store', type=int,
+        help='number of nodes to cache locally (default: no cache)',
+        metavar='SIZE', default=0,
+        )
+
+    parser.add_argument(
+        '--daemon-socket', action='store',
+        help='control daemon socket (default: in the runtime directory)',
+        metavar='PATH',
+        )
+
+    parser.add_argument(
+        '--machine-id', action='store', type=machine_id,
+        help='identifier of the local machine (default: autodetect)',
+        metavar='UUID',
+        )
+
     parser.add_argument(
         '--path-prefix', action='store', type=str,
         help='zookeeper path prefix', metavar='PATH',
@@ -288,11 +417,12 @@ def main(argv=sys.argv, quiet=False):
 
     logging.basicConfig(format=FORMAT)
     logging.getLogger().setLevel(logging.WARN)
-    set_log_stream(open('/dev/null', 'w'))
 
     log.debug("all arguments parsed.")
     package = pkg_resources.get_distribution("pop")
     log.debug("%s system initialized." % package.egg_name().lower())
 
-    # Invoke command
-    run(d.pop('func'), verbosity > 1, d)
+    # Invoke command. A service process forked by the machine agent
+    # exits here too; it's restarted if the status is non-zero.
+    from pop.runner import run
+    sys.exit(run(d.pop('func'), verbosity > 1, d))
@@ -0,0 +1,255 @@
+"""Local control daemon.
+
+The daemon holds a single ZooKeeper session and runs commands on
+behalf of the command-line utility, which connects to it using a
+Unix socket. Requests and replies are JSON-encoded, one per line.
+"""
+
+import os
+import sys
+import json
+import tempfile
+
+from StringIO import StringIO
+
+from twisted.internet.defer import DeferredLock
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.defer import returnValue
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+from pop import log
+from pop.exceptions import PopException
+
+# These commands only depend on the hierarchy (and not on the
+# process that runs them), so they can run in the daemon. The output
+# of ``dump`` is streamed and therefore not sent through the daemon.
+COMMANDS = frozenset(("add", "deploy", "init", "status"))
+
+
+def get_socket_path():
+    """Return default socket path.
+
+    The socket is placed in the user's runtime directory if set, and
+    otherwise in a private per-user directory in the temporary
+    directory.
+    """
+
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "pop.sock")
+
+    return os.path.join(
+        tempfile.gettempdir(), "pop-%d" % os.getuid(), "pop.sock"
+        )
+
+
+SOCKET = get_socket_path()
+
+
+class DaemonError(PopException):
+    """Raised when the daemon reports an error."""
+
+
+class DaemonUnavailable(PopException):
+    """Raised when a command can't run in the daemon."""
+
+
+def native(value):
+    """Convert decoded JSON strings to native strings."""
+
+    if isinstance(value, dict):
+        return dict((native(k), native(v)) for (k, v) in value.items())
+
+    if isinstance(value, list):
+        return [native(item) for item in value]
+
+    if not isinstance(value, str) and hasattr(value, 'encode'):
+        return value.encode('utf-8')
+
+    return value
+
+
+class DaemonProtocol(LineReceiver):
+    delimiter = "\n"
+    MAX_LENGTH = 1 << 26
+
+    def lineReceived(self, line):
+        d = maybeDeferred(self.factory.handle, native(json.loads(line)))
+
+        @d.addCallback
+        def reply(output):
+            return {"output": output, "error": None}
+
+        @d.addErrback
+        def error(failure):
+            if failure.check(DaemonUnavailable):
+                return {"refused": failure.getErrorMessage()}
+
+            log.debug(failure.getTraceback())
+            return {"output": "", "error": failure.getErrorMessage()}
+
+        @d.addCallback
+        def send(result):
+            self.sendLine(json.dumps(result))
+
+    def lineLengthExceeded(self, line):
+        self.transport.loseConnection()
+
+
+class DaemonFactory(Factory):
+    """Runs commands using a shared client.
+
+    Since commands write their output to the standard output
+    stream, which is captured for the duration of a command, they
+    run one at a time.
+    """
+
+    protocol = DaemonProtocol
+
+    def __init__(self, client, services):
+        self.client = client
+        self.services = services
+        self.lock = DeferredLock()
+
+    def handle(self, request):
+        if request["command"] not in COMMANDS:
+            raise DaemonUnavailable(
+                "command not available: %s." % request["command"]
+                )
+
+        if request["servers"] != self.client.servers:
+            raise DaemonUnavailable(
+                "daemon connected to: %s." % self.client.servers
+                )
+
+        return self.lock.run(self.run, request)
+
+    @inlineCallbacks
+    def run(self, request):
+        from pop.command import Command
+        from pop.utils import local_machine_uuid
+        from pop.utils import set_local_machine_uuid
+
+        log.debug("running command: %s..." % request["command"])
+
+        command = Command(
+            self.client, request["path"], self.services, request["force"]
+            )
+
+        # The machine id given to the utility applies to this command
+        # only (commands run one at a time).
+        machine_id = request.get("machine_id")
+        if machine_id is not None:
+            try:
+                previous = local_machine_uuid()
+            except RuntimeError:
+                previous = None
+
+            set_local_machine_uuid(machine_id)
+
+        method = getattr(command, "cmd_%s" % request["command"])
+        stdout = sys.stdout
+        sys.stdout = stream = StringIO()
+
+        try:
+            yield method(**request["options"])
+        finally:
+            sys.stdout = stdout
+
+            if machine_id is not None:
+                set_local_machine_uuid(previous)
+
+        returnValue(stream.getvalue())
+
+
+class ProxyProtocol(LineReceiver):
+    delimiter = "\n"
+    MAX_LENGTH = 1 << 26
+
+    def __init__(self):
+        self.reply = Deferred()
+
+    def lineReceived(self, line):
+        self.transport.loseConnection()
+        self.reply.callback(json.loads(line))
+
+    def connectionLost(self, reason):
+        if not self.reply.called:
+            self.reply.errback(reason)
+
+
+class Proxy(object):
+    """Stands in for the client when a command runs in the daemon."""
+
+    def close(self):
+        pass
+
+
+def listen(client, services, path=SOCKET):
+    from twisted.internet import reactor
+
+    # The directory of the socket must be private to the user.
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    if os.stat(directory).st_uid != os.getuid():
+        raise DaemonError("socket directory not owned by user: %s." % (
+            directory))
+
+    factory = DaemonFactory(client, services)
+    return reactor.listenUNIX(path, factory, mode=0o600, wantPID=True)
+
+
+@inlineCallbacks
+def proxy(name, servers, path, force, options, socket=SOCKET,
+          machine_id=None):
+    """Run command in the daemon.
+
+    Raises ``DaemonUnavailable`` if the daemon is not running, is not
+    run by the current user, or refuses the command.
+    """
+
+    from twisted.internet import reactor
+    from twisted.internet.endpoints import UNIXClientEndpoint
+    from twisted.internet.endpoints import connectProtocol
+    from twisted.internet.error import ConnectError
+
+    if name not in COMMANDS or not os.path.exists(socket):
+        raise DaemonUnavailable(socket)
+
+    # Options may include credentials; only talk to our own daemon.
+    if os.stat(socket).st_uid != os.getuid():
+        raise DaemonUnavailable("socket not owned by user: %s." % socket)
+
+    endpoint = UNIXClientEndpoint(reactor, socket)
+
+    try:
+        protocol = yield connectProtocol(endpoint, ProxyProtocol())
+    except ConnectError as exc:
+        raise DaemonUnavailable(exc)
+
+    log.debug("connected to daemon.")
+
+    protocol.sendLine(json.dumps({
+        "command": name,
+        "servers": servers,
+        "path": path,
+        "force": force,
+        "options": options,
+        "machine_id": machine_id,
+        }))
+
+    result = yield protocol.reply
+
+    if "refused" in result:
+        raise DaemonUnavailable(result["refused"])
+
+    if result["error"] is not None:
+        raise DaemonError(result["error"])
+
+    sys.stdout.write(native(result["output"]))
+    returnValue(Proxy())
@@ -0,0 +1,163 @@
+"""Streaming dump of a subtree.
+
+The subtree is written as a YAML mapping from node names to their
+data (or, for nodes that have children, to a mapping of the
+children). The data of a node that has children is given using the
+key ``.``, which is not a valid node name.
+
+Nodes are requested ahead of the output, in the order in which
+they're written, with a bounded number of requests in flight; each
+node is written as soon as it arrives and then discarded.
+"""
+
+import base64
+
+from collections import deque
+
+from twisted.internet.defer import FirstError
+from twisted.internet.defer import gatherResults
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import returnValue
+from yaml import events
+from yaml.emitter import Emitter
+from yaml.nodes import ScalarNode
+from yaml.resolver import Resolver
+
+from zookeeper import NoNodeException
+
+STR_TAG = u"tag:yaml.org,2002:str"
+NULL_TAG = u"tag:yaml.org,2002:null"
+BINARY_TAG = u"tag:yaml.org,2002:binary"
+
+# Nodes that belong to ZooKeeper itself.
+EXCLUDE = ("/zookeeper", )
+
+
+class TreeEmitter(object):
+    """Emits a nested mapping one node at a time."""
+
+    def __init__(self, stream):
+        self._emitter = Emitter(stream)
+        self._resolver = Resolver()
+        self._depth = 0
+
+        self._emit(events.StreamStartEvent())
+        self._emit(events.DocumentStartEvent())
+        self._emit(events.MappingStartEvent(None, None, True))
+
+    def node(self, name, data, depth, parent):
+        """Emit node at the given depth, relative to the root."""
+
+        self._close(depth)
+        self._scalar(name)
+
+        if parent:
+            self._emit(events.MappingStartEvent(None, None, True))
+            self._depth += 1
+            self.data(data)
+        else:
+            self._scalar(data)
+
+    def data(self, data):
+        """Emit the data of the current parent node."""
+
+        if data:
+            self._scalar(u".")
+            self._scalar(data)
+
+    def close(self):
+        self._close(0)
+        self._emit(events.MappingEndEvent())
+        self._emit(events.DocumentEndEvent())
+        self._emit(events.StreamEndEvent())
+
+    def _close(self, depth):
+        while self._depth > depth:
+            self._emit(events.MappingEndEvent())
+            self._depth -= 1
+
+    def _scalar(self, value):
+        # A node without data.
+        if value is None:
+            self._emit(events.ScalarEvent(
+                None, NULL_TAG, (True, False), u"null"
+                ))
+            return
+
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            value = base64.b64encode(value).decode("ascii")
+            self._emit(events.ScalarEvent(
+                None, BINARY_TAG, (False, False), value, style="|"
+                ))
+            return
+        except AttributeError:
+            pass
+
+        implicit = tuple(
+            self._resolver.resolve(ScalarNode, value, flags) == STR_TAG
+            for flags in ((True, False), (False, True))
+            )
+
+        self._emit(events.ScalarEvent(None, STR_TAG, implicit, value))
+
+    def _emit(self, event):
+        self._emitter.emit(event)
+
+
+@inlineCallbacks
+def dump(client, path, stream, concurrency=64, exclude=EXCLUDE):
+    """Write the subtree at ``path`` to ``stream`` as YAML.
+
+    Returns the number of nodes written. Nodes that are deleted while
+    the tree is walked are left out.
+    """
+
+    emitter = TreeEmitter(stream)
+
+    # The remaining nodes in output order, and the requests in flight.
+    queue = deque([(path, 0)])
+    fetches = {}
+    count = 0
+
+    def fetch(path):
+        return gatherResults(
+            [client.get(path), client.get_children(path)],
+            consumeErrors=True,
+            )
+
+    while queue:
+        for item, depth in queue:
+            if len(fetches) >= concurrency:
+                break
+
+            if item not in fetches:
+                fetches[item] = fetch(item)
+
+        item, depth = queue.popleft()
+
+        try:
+            (data, metadata), children = yield fetches.pop(item)
+        except FirstError as exc:
+            exc.subFailure.trap(NoNodeException)
+            continue
+
+        children = [
+            (item.rstrip("/") + "/" + name, depth + 1)
+            for name in sorted(children)
+            ]
+
+        queue.extendleft(reversed([
+            child for child in children if child[0] not in exclude
+            ]))
+
+        if depth:
+            name = item.rsplit("/", 1)[-1]
+            emitter.node(name, data, depth - 1, bool(children))
+            count += 1
+        else:
+            emitter.data(data)
+
+    emitter.close()
+    returnValue(count)
@@ -2,6 +2,17 @@ class PopException(Exception):
     """Exception hierarchy base class."""
 
 
+class InvalidMachineId(PopException):
+    """Machine identifier is not a UUID."""
+
+    def __init__(self, value, source):
+        super(InvalidMachineId, self).__init__(
+            "Invalid machine id %r (from %s)." % (value, source)
+            )
+        self.value = value
+        self.source = source
+
+
 class ProcessForked(PopException):
     """Raised from the child process."""
 
@@ -9,6 +20,10 @@ class ProcessForked(PopException):
 class ServiceException(PopException):
     """Prompt runtime to start service."""
 
+    def __init__(self, name, instance=0):
+        super(ServiceException, self).__init__(name)
+        self.instance = instance
+
 
 class StateException(PopException):
     """Incorrect state for required operation."""
@@ -0,0 +1,184 @@
+"""Layout of the hierarchy.
+
+These functions don't talk to ZooKeeper; they're shared by the
+Twisted-based agents and their asyncio equivalents (see
+:mod:`pop.aio`).
+"""
+
+from pop import log
+
+
+def machine_path(root, machine):
+    """Return path of the state node of a machine.
+
+    >>> machine_path("/pop", "m1")
+    '/pop/machines/m1'
+
+    """
+
+    return root + "/machines/" + machine
+
+
+def index_path(root, machine, name=None):
+    """Return path of the deployment index of a machine.
+
+    If ``name`` is given, the path of the entry for that service is
+    returned.
+
+    >>> index_path("/pop", "m1")
+    '/pop/machines/m1/deployed'
+    >>> index_path("/pop", "m1", "echo")
+    '/pop/machines/m1/deployed/echo'
+
+    """
+
+    path = machine_path(root, machine) + "/deployed"
+    if name is not None:
+        path += "/" + name
+
+    return path
+
+
+def service_index_paths(path, machines):
+    """Return the index paths of the service at ``path``.
+
+    >>> service_index_paths("/pop/services/echo", ["m1", "m2"])
+    ['/pop/machines/m1/deployed/echo', '/pop/machines/m2/deployed/echo']
+
+    """
+
+    root, name = path.rsplit("/services/", 1)
+    return [index_path(root, machine, name) for machine in machines]
+
+
+def unique(items):
+    """Return items without duplicates, in order.
+
+    >>> unique(["m1", "m2", "m1"])
+    ['m1', 'm2']
+
+    """
+
+    result = []
+    for item in items:
+        if item not in result:
+            result.append(item)
+
+    return result
+
+
+def added_machines(declared, machines):
+    """Return the machines that are not in the declaration.
+
+    >>> added_machines(["m1"], ["m1", "m2"])
+    ['m2']
+
+    """
+
+    return [machine for machine in machines if machine not in declared]
+
+
+def deployed_services(machine, services, declarations):
+    """Return the services whose declaration includes ``machine``.
+
+    >>> deployed_services("m1", ["a", "b"], [["m1"], ["m2"]])
+    ['a']
+
+    """
+
+    return [
+        name for name, machines in zip(services, declarations)
+        if machine in machines
+        ]
+
+
+def instance_name(name, instance):
+    """Return node name for an instance of a service.
+
+    >>> instance_name("echo", 0)
+    'echo'
+    >>> instance_name("echo", 2)
+    'echo.2'
+
+    """
+
+    return "%s.%d" % (name, instance) if instance else name
+
+
+def service_name(node):
+    """Return name of the service that an instance node belongs to.
+
+    >>> service_name("echo.2")
+    'echo'
+
+    """
+
+    return node.split(".", 1)[0]
+
+
+def missing_instances(name, count, running):
+    """Return the instances of service that are not running.
+
+    >>> missing_instances("echo", 3, set(["echo", "echo.2"]))
+    [1]
+
+    """
+
+    return [
+        instance for instance in range(count)
+        if instance_name(name, instance) not in running
+        ]
+
+
+def analyze(deployed, children, instances=None):
+    """Return the deployed, running and stopped services.
+
+    The ``children`` are the nodes of the machine state node; each
+    running instance of a service has an ephemeral node there. A
+    service is stopped if any of its instances is not running; the
+    number of instances of each service is given by ``instances``
+    (one, unless given).
+
+    >>> deployed, running, stopped = analyze(
+    ...     ["a", "b", "c"], ["a", "c", "deployed"], {"c": 2})
+    >>> sorted(running), sorted(stopped)
+    (['a', 'c'], ['b', 'c'])
+
+    """
+
+    instances = instances or {}
+
+    log.debug("found %d service(s) configured for this machine." % (
+        len(deployed)))
+
+    running = set(children)
+    running.discard("deployed")
+
+    deployed = set(deployed)
+    stopped = set(
+        name for name in deployed
+        if missing_instances(name, instances.get(name, 1), running)
+        )
+
+    if stopped:
+        log.debug("services not running: %s." % ", ".join(
+            map(repr, stopped)))
+    elif running:
+        log.debug("all services are up.")
+
+    return deployed, running, stopped
+
+
+def instance_count(settings):
+    """Return the number of instances of a service.
+
+    This is given by the ``workers`` setting.
+
+    >>> instance_count({"workers": "2"})
+    2
+    >>> instance_count({})
+    1
+
+    """
+
+    return max(1, int(settings.get("workers", 1)))
@@ -1,82 +1,238 @@
 import json
+import time
 
 from pop import log
+from pop import metrics
 from pop.agent import Agent
 from pop.exceptions import ProcessForked
 from pop.exceptions import ServiceException
+from pop.hierarchy import analyze
+from pop.hierarchy import deployed_services
+from pop.hierarchy import index_path
+from pop.hierarchy import instance_count
+from pop.hierarchy import instance_name
+from pop.hierarchy import machine_path
+from pop.hierarchy import missing_instances
+from pop.hierarchy import service_name
 from pop.process import fork
+from pop.serialization import NodeFormat
+from pop.supervisor import Supervisor
+from pop.utils import gather
 
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredList
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.defer import FirstError
 from twisted.internet.defer import returnValue
 from twisted.internet.defer import inlineCallbacks
 
 from zookeeper import NoNodeException
+from zookeeper import NodeExistsException
+
+scan_seconds = metrics.histogram(
+    "pop_agent_scan_seconds", "Duration of machine scans.",
+    )
+
+fork_seconds = metrics.histogram(
+    "pop_agent_fork_seconds", "Time to fork a service process.",
+    )
+
+start_seconds = metrics.histogram(
+    "pop_agent_start_seconds",
+    "Time from starting a service until its state node appears.",
+    )
+
+services_started = metrics.counter(
+    "pop_agent_services_started_total", "Service processes started.",
+    )
+
+
+def waves(requirements):
+    """Order services by their requirements.
+
+    The ``requirements`` map service names to a tuple of the names
+    they require and their weight. Returns a list of waves; each
+    requires only services in earlier waves, with the heaviest
+    services first. Requirements that are not in the mapping are
+    ignored, and services that are part of a cycle are placed in a
+    final wave.
+    """
+
+    remaining = dict(
+        (name, set(requires).intersection(requirements))
+        for (name, (requires, weight)) in requirements.items()
+        )
+
+    result = []
+    while remaining:
+        wave = [name for (name, requires) in remaining.items()
+                if not requires]
+
+        if not wave:
+            log.warn("circular requirements: %s." % ", ".join(
+                sorted(remaining)))
+            wave = list(remaining)
+
+        wave.sort(key=lambda name: (-requirements[name][1], name))
+        result.append(wave)
+
+        for name in wave:
+            del remaining[name]
+
+        for requires in remaining.values():
+            requires.difference_update(wave)
+
+    return result
 
 
 class MachineAgent(Agent):
-    """Machine agent implementation."""
+    """Machine agent implementation.
+
+    The services deployed to the machine are indexed under
+    ``/machines/<machine-id>/deployed`` such that a scan only reads
+    the state of this machine.
+
+    The ``concurrency`` argument limits the number of requests that
+    are in flight at any time while indexing; the reads are otherwise
+    sent all at once.
+
+    If a ``zygote`` is given (see :mod:`pop.zygote`), services are
+    started in workers forked from it rather than from the agent.
 
-    def __init__(self, client, path, uuid):
+    Services are started in the order of their requirements, with at
+    most ``parallelism`` services starting at a time. A service has
+    started when its state node for the machine exists, or after
+    ``start_timeout`` seconds.
+
+    A service is started as a number of instances given by its
+    ``workers`` setting; each instance runs in its own process.
+    """
+
+    concurrency = 256
+    parallelism = 8
+    start_timeout = 60.0
+
+    def __init__(self, client, path, uuid, concurrency=None, zygote=None,
+                 parallelism=None):
         super(MachineAgent, self).__init__(client, path)
 
+        if concurrency is not None:
+            self.concurrency = concurrency
+
+        if parallelism is not None:
+            self.parallelism = parallelism
+
         self.name = str(uuid)
+        self.zygote = zygote
+        self.supervisor = Supervisor(client, path, self.name, self._restart)
+
+        if zygote is not None:
+            zygote.exited = self.supervisor.exited
+        self.deployed = set()
+        self.running = set()
         self.stopped = set()
+        self.pending = set()
+        self.instances = {}
         self.pids = []
+        self.watching = False
+        self.forked = False
+
+        # Shared by all staged starts, such that the parallelism and
+        # the order of requirements hold across them.
+        self._semaphore = DeferredSemaphore(self.parallelism)
+        self._starting = {}
+        self._stopping = Deferred()
+        self._child = Deferred()
 
     @inlineCallbacks
     def initialize(self):
-        """Create machine state node."""
+        """Create machine state node and deployment index."""
 
-        yield self.client.create_path(
-            self.path + "/machines/" + self.name + "/services"
-            )
+        path = index_path(self.path, self.name)
+        yield self.client.create_path(path)
+
+        try:
+            yield self.client.create(path)
+        except NodeExistsException:
+            pass
+        else:
+            yield self.reindex()
 
     @inlineCallbacks
-    def scan(self):
-        """Analyze state and queue tasks."""
+    def reindex(self):
+        """Rebuild deployment index from the service declarations.
 
-        log.debug("scanning machine: %s..." % self.name)
+        This reads the machines declaration of every service and is
+        only required for a hierarchy that was deployed to before the
+        machine had an index.
+        """
+
+        log.debug("indexing services for machine: %s..." % self.name)
 
-        deployed = set()
         services = yield self.client.get_children(self.path + "/services")
+        results = yield gather(
+            self.get_machines, services, self.concurrency
+            )
 
-        for name in services:
-            log.debug("checking service: '%s'..." % name)
+        for success, machines in results:
+            if not success:
+                machines.raiseException()
 
-            try:
-                value, metadata = yield self.client.get(
-                    self.path + "/services/" + name + "/machines"
-                    )
-            except NoNodeException:
-                log.warn(
-                    "missing machines declaration for service: %s." %
-                    name
-                    )
-                machines = []
-            else:
-                machines = json.loads(value)
+        deployed = deployed_services(
+            self.name, services, [machines for success, machines in results]
+            )
 
-            if machines:
-                log.debug("machines: %s." % ", ".join(machines))
+        results = yield gather(
+            lambda name: self.client.create(
+                index_path(self.path, self.name, name)
+                ),
+            deployed, self.concurrency
+            )
 
-                if self.name in machines:
-                    deployed.add(name)
-            else:
-                log.debug("service not configured for any machine.")
+        for success, result in results:
+            if not success:
+                result.trap(NodeExistsException)
 
-        count = len(deployed)
-        log.debug("found %d service(s) configured for this machine." % count)
+        log.debug("indexed %d service(s)." % len(deployed))
+
+    @inlineCallbacks
+    def scan(self):
+        """Analyze state and queue tasks."""
 
-        running = yield self.client.get_children(
-            self.path + "/machines/" + self.name
+        log.debug("scanning machine: %s..." % self.name)
+
+        started = time.time()
+        path = machine_path(self.path, self.name)
+        deployed = yield self.client.get_children(index_path(
+            self.path, self.name
+            ))
+        children = yield self.client.get_children(path)
+
+        # A service is stopped if any of its instances is not running;
+        # the number of instances is read with the requirements.
+        yield self.get_requirements(deployed)
+
+        self.deployed, self.running, self.stopped = analyze(
+            deployed, children, self.instances
             )
+        scan_seconds.observe(time.time() - started)
 
-        self.stopped = deployed - set(running)
+    @inlineCallbacks
+    def get_machines(self, name):
+        """Return list of machines configured for service."""
+
+        try:
+            value, metadata = yield self.client.get(
+                self.path + "/services/" + name + "/machines"
+                )
+        except NoNodeException:
+            log.warn(
+                "missing machines declaration for service: %s." %
+                name
+                )
+            returnValue([])
 
-        if self.stopped:
-            log.debug("services not running: %s." % ", ".join(
-                map(repr, self.stopped)))
-        elif running:
-            log.debug("all services are up.")
+        returnValue(json.loads(value))
 
     @inlineCallbacks
     def run(self):
@@ -85,19 +241,342 @@ class MachineAgent(Agent):
 
     @inlineCallbacks
     def start(self):
+        """Start services and keep them running.
+
+        Note that the returned deferred only fires when the agent is
+        stopped, or in a forked process (as a failure with the
+        ``ServiceException`` for the service to run).
+        """
+
         yield self.initialize()
         yield self.scan()
 
-    def start_services(self):
+        self.pending = set(self.stopped)
+        self._start_staged(self.pending)
+
+        try:
+            yield DeferredList(
+                [self.reconcile(), self._child],
+                fireOnOneCallback=True, fireOnOneErrback=True,
+                consumeErrors=True,
+                )
+        except FirstError as exc:
+            exc.subFailure.raiseException()
+
+    def stop(self):
+        """Stop reconciliation."""
+
+        self.watching = False
+        self.supervisor.stop()
+
+        if not self._stopping.called:
+            self._stopping.callback(None)
+
+    @inlineCallbacks
+    def reconcile(self):
+        """Watch machine state and start services as required.
+
+        Both the deployment index and the running services of the
+        machine are watched; on each event, only the services that
+        changed are considered.
+        """
+
+        path = machine_path(self.path, self.name)
+
+        self.watching = True
+        if self._stopping.called:
+            self._stopping = Deferred()
+
+        log.debug("watching machine: %s..." % self.name)
+
+        try:
+            yield DeferredList([
+                self._watch_children(
+                    index_path(self.path, self.name), self._deployed
+                    ),
+                self._watch_children(path, self._running),
+                ], fireOnOneErrback=True, consumeErrors=True)
+        except FirstError as exc:
+            self.watching = False
+            exc.subFailure.raiseException()
+
+    @inlineCallbacks
+    def get_requirements(self, names):
+        """Return the requirements and weight of each service.
+
+        These are read from the ``requires`` and ``weight`` settings;
+        the number of instances of each service (the ``workers``
+        setting) is recorded as well.
+        """
+
+        fmt = NodeFormat("json")
+
+        def get(name):
+            d = self.client.get_cached(
+                self.path + "/services/" + name + "/settings"
+                )
+            d.addCallback(lambda result: fmt.loads(result[0]))
+            return d
+
+        names = list(names)
+        results = yield gather(get, names, self.concurrency)
+
+        requirements = {}
+        for name, (success, settings) in zip(names, results):
+            if not success:
+                settings.trap(NoNodeException)
+                settings = {}
+
+            # Given on the command line, this is a comma-separated
+            # string.
+            requires = settings.get("requires", ())
+            if not isinstance(requires, (list, tuple)):
+                requires = [
+                    item.strip() for item in str(requires).split(",")
+                    if item.strip()
+                    ]
+
+            requirements[name] = (requires, settings.get("weight", 1))
+
+            self.instances[name] = instance_count(settings)
+
+        returnValue(requirements)
+
+    @inlineCallbacks
+    def start_staged(self, names=None, instances=None):
+        """Start services in the order of their requirements.
+
+        Returns a deferred which fires when all services have
+        started. In a forked process, the ``start`` method instead
+        fails with ``ServiceException``.
+
+        If ``instances`` is given, only those instances are started.
+        """
+
+        names = set(self.stopped if names is None else names)
+        requirements = yield self.get_requirements(names)
+        started = {}
+
+        for wave in waves(requirements):
+            for name in wave:
+                # Wait for requirements that are being started here or
+                # by an earlier call.
+                d = DeferredList([
+                    started.get(required) or self._starting[required]
+                    for required in requirements[name][0]
+                    if required in started or required in self._starting
+                    ])
+
+                d.addCallback(
+                    lambda result, name=name: self._semaphore.run(
+                        self._start_service, name, instances)
+                    )
+
+                @d.addErrback
+                def failed(failure, name=name):
+                    if failure.check(ServiceException):
+                        if not self._child.called:
+                            self._child.errback(failure)
+                    else:
+                        log.warn("unable to start service: %s (%s)." % (
+                            name, failure.getErrorMessage()))
+
+                started[name] = self._starting[name] = d
+
+                @d.addBoth
+                def done(result, name=name, d=d):
+                    if self._starting.get(name) is d:
+                        del self._starting[name]
+
+        yield DeferredList(list(started.values()))
+
+    @inlineCallbacks
+    def _start_service(self, name, instances=None):
+        # Callbacks may still run in a forked process; it must not
+        # start services of its own.
+        if self.forked:
+            return
+
+        if instances is None:
+            instances = self.get_missing_instances(name)
+            if not instances:
+                return
+
+        started = time.time()
+        self.start_services([name], instances)
+
+        from twisted.internet import reactor
+        timeout = Deferred()
+        call = reactor.callLater(
+            self.start_timeout, timeout.callback, None
+            )
+
+        try:
+            yield DeferredList(
+                [self._wait_for_state(name, min(instances)), timeout],
+                fireOnOneCallback=True, fireOnOneErrback=True,
+                consumeErrors=True,
+                )
+        finally:
+            timed_out = not call.active()
+            if not timed_out:
+                call.cancel()
+
+        if timed_out:
+            log.warn("service did not start in time: %s." % name)
+        else:
+            start_seconds.observe(time.time() - started)
+
+    @inlineCallbacks
+    def _wait_for_state(self, name, instance=0):
+        path = self.path + "/services/" + name + "/state/" + \
+            instance_name(self.name, instance)
+
+        while not self.forked:
+            d, watch = self.client.exists_and_watch(path)
+            stat = yield d
+            if stat is not None:
+                break
+
+            yield watch
+
+    def get_missing_instances(self, name):
+        """Return the instances of service that are not running."""
+
+        return missing_instances(
+            name, self.instances.get(name, 1), self.running
+            )
+
+    def start_services(self, names=None, instances=None):
+        """Start services and return the process identifiers.
+
+        Unless ``instances`` is given, the instances of each service
+        that are not running are started.
+
+        Using a zygote, the identifiers are instead added to
+        ``self.pids`` as the workers are forked.
+        """
+
+        if names is None:
+            names = self.stopped
+
         pids = []
-        for service in self.stopped:
-            log.debug("starting service: %s..." % service)
-            try:
-                pid = fork()
-            except ProcessForked:
-                raise ServiceException(service)
+        for service in names:
+            for instance in (
+                    self.get_missing_instances(service)
+                    if instances is None else instances):
+                log.debug("starting service: %s..." % instance_name(
+                    service, instance))
+
+                if self.zygote is not None:
+                    d = fork_seconds.time(self.zygote.fork(service, instance))
+                    d.addCallback(self._started, service, instance, False)
+                    d.addErrback(self._fork_failed, service, instance)
+                    continue
+
+                started = time.time()
+
+                try:
+                    pid = fork()
+                except ProcessForked:
+                    self.forked = True
+                    self.watching = False
+                    raise ServiceException(service, instance)
 
-            log.info("process started: %d." % pid)
-            pids.append(pid)
+                fork_seconds.observe(time.time() - started)
+                self._started(pid, service, instance)
+                pids.append(pid)
 
         return pids
+
+    def _started(self, pid, name, instance=0, reap=True):
+        log.info("process started: %d." % pid)
+        services_started.inc()
+        self.pids.append(pid)
+        self.supervisor.watch(pid, name, instance, reap)
+
+    def _fork_failed(self, failure, name, instance=0):
+        log.warn("unable to start service: %s (%s)." % (
+            instance_name(name, instance), failure.getErrorMessage()))
+
+    def _start_staged(self, names, instances=None):
+        names = set(names)
+        d = self.start_staged(names, instances)
+
+        @d.addErrback
+        def failed(failure):
+            log.warn("unable to start services: %s (%s)." % (
+                ", ".join(sorted(names)), failure.getErrorMessage()))
+
+            # The services are no longer pending, such that the next
+            # change starts them again.
+            self.pending -= names
+
+        return d
+
+    def _restart(self, name, instance=0):
+        if name in self.deployed and \
+               instance_name(name, instance) not in self.running:
+            # The first instance stands for the service as a whole.
+            if instance == 0:
+                self.pending.add(name)
+            self._start_staged([name], [instance])
+
+    @inlineCallbacks
+    def _watch_children(self, path, update):
+        while self.watching:
+            d, watch = self.client.get_children_and_watch(path)
+            children = yield d
+            update(set(children))
+
+            try:
+                yield DeferredList(
+                    [watch, self._stopping],
+                    fireOnOneCallback=True, fireOnOneErrback=True,
+                    consumeErrors=True,
+                    )
+            except FirstError as exc:
+                exc.subFailure.raiseException()
+
+    def _deployed(self, deployed):
+        changed = deployed.symmetric_difference(self.deployed)
+        self.deployed = deployed
+
+        # A service that is deployed again gets a fresh start.
+        for name in changed:
+            self.supervisor.forget(name)
+
+        self._reconcile(changed)
+
+    def _running(self, running):
+        running.discard("deployed")
+        changed = running.symmetric_difference(self.running)
+        self.running = running
+        self._reconcile(changed)
+
+    def _reconcile(self, names):
+        # The running services are given by instance.
+        names = set(service_name(name) for name in names)
+
+        for name in names:
+            missing = self.get_missing_instances(name)
+            if not missing:
+                self.pending.discard(name)
+
+            if name in self.deployed and missing:
+                self.stopped.add(name)
+            else:
+                self.stopped.discard(name)
+
+        # Services that exit are restarted by the supervisor.
+        names = set(
+            name for name in self.stopped.intersection(names) - self.pending
+            if not self.supervisor.supervised(name)
+            )
+
+        if names:
+            log.debug("services changed: %s." % ", ".join(
+                map(repr, names)))
+
+            self.pending |= names
+            self._start_staged(names)
@@ -0,0 +1,174 @@
+"""Declarative service manifest.
+
+A manifest lists services by name, with their type and, optionally,
+their settings and the machines they're deployed to::
+
+  services:
+    echo:
+      type: twisted-echo
+      settings:
+        port: 8080
+      machines:
+        - 4b1a2f8e-0c3d-4e6f-9a7b-1d2c3e4f5a6b
+
+Applying a manifest compares it to the hierarchy and makes only the
+changes needed: missing services are added, settings that differ are
+written and missing machines are deployed to. Settings and machines
+that the manifest does not mention are left as they are.
+"""
+
+import yaml
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import returnValue
+
+from zookeeper import NoNodeException
+
+from pop import log
+from pop.exceptions import PopException
+from pop.exceptions import StateException
+from pop.utils import check_service_name
+from pop.utils import gather
+
+KEYS = frozenset(("type", "settings", "machines"))
+
+
+class ManifestError(PopException):
+    """Raised for a manifest that is not valid."""
+
+
+def load(stream):
+    """Parse manifest; returns a dictionary of service declarations.
+
+    >>> services = load('''
+    ... services:
+    ...   echo:
+    ...     type: twisted-echo
+    ... ''')
+    >>> services['echo']['type'], services['echo']['machines']
+    ('twisted-echo', [])
+
+    """
+
+    try:
+        data = yaml.safe_load(stream)
+    except yaml.YAMLError as exc:
+        raise ManifestError("unable to parse manifest: %s" % exc)
+
+    if not isinstance(data, dict) or \
+            not isinstance(data.get("services"), dict):
+        raise ManifestError("manifest must contain a 'services' mapping.")
+
+    services = {}
+
+    for name, entry in data["services"].items():
+        name = str(name)
+        try:
+            check_service_name(name)
+        except ValueError as exc:
+            raise ManifestError(str(exc))
+
+        if not isinstance(entry, dict) or "type" not in entry:
+            raise ManifestError("service %r must have a 'type'." % name)
+
+        unknown = set(entry) - KEYS
+        if unknown:
+            raise ManifestError("unknown key(s) for service %r: %s." % (
+                name, ", ".join(sorted(map(str, unknown)))))
+
+        settings = entry.get("settings") or {}
+        if not isinstance(settings, dict):
+            raise ManifestError(
+                "settings for service %r must be a mapping." % name
+                )
+
+        machines = entry.get("machines") or []
+        if not isinstance(machines, list):
+            raise ManifestError(
+                "machines for service %r must be a list." % name
+                )
+
+        services[name] = {
+            "type": str(entry["type"]),
+            "settings": settings,
+            "machines": [str(machine) for machine in machines],
+            }
+
+    return services
+
+
+@inlineCallbacks
+def apply(client, path, factories, services, concurrency=None):
+    """Apply service declarations to the hierarchy at ``path``.
+
+    The ``factories`` map service types to implementations. Up to
+    ``concurrency`` services are updated at a time. Returns the
+    changes that were made, as ``(name, action, detail)`` tuples.
+    """
+
+    for name, spec in services.items():
+        if spec["type"] not in factories:
+            raise ManifestError("no such service type: %s (service %r)." % (
+                spec["type"], name))
+
+    def update(name):
+        spec = services[name]
+        factory = factories[spec["type"]]
+        service = factory(client, path + "services/" + name)
+        return _update(service, name, spec)
+
+    names = sorted(services)
+    results = yield gather(update, names, concurrency)
+    changes = []
+    failure = None
+
+    for name, (success, result) in zip(names, results):
+        if success:
+            changes.extend(result)
+        elif failure is None:
+            failure = result
+        else:
+            log.warn("unable to apply service %r: %s" % (
+                name, result.getErrorMessage()))
+
+    if failure is not None:
+        failure.raiseException()
+
+    returnValue(changes)
+
+
+@inlineCallbacks
+def _update(service, name, spec):
+    changes = []
+
+    try:
+        kind, metadata = yield service.client.get(service.path + "/type")
+    except NoNodeException:
+        yield service.add(spec["settings"])
+        changes.append((name, "added", spec["type"]))
+    else:
+        if kind != spec["type"]:
+            raise StateException(
+                "service %r has type %r (manifest: %r)." % (
+                    name, kind, spec["type"]))
+
+        settings = yield service.get_settings()
+        changed = dict(
+            (key, value) for (key, value) in spec["settings"].items()
+            if key not in settings or settings[key] != value
+            )
+
+        if changed:
+            settings.update(changed)
+            yield settings()
+            changes.append((name, "configured", ", ".join(sorted(changed))))
+
+    if spec["machines"]:
+        added = yield service.deploy(*spec["machines"])
+        if added:
+            changes.append((name, "deployed", ", ".join(added)))
+
+    for change in changes:
+        log.info("%s: %s (%s)." % change)
+
+    returnValue(changes)
@@ -0,0 +1,196 @@
+"""Runtime metrics.
+
+Metrics are registered with a registry which renders them in the
+Prometheus text format. The machine agent serves the default
+registry over HTTP (see the ``--metrics-port`` option for ``fg``):
+
+>>> registry = Registry()
+>>> requests = registry.register(
+...     Counter("requests_total", "Requests.", ("operation", )))
+>>> requests.inc("get")
+>>> print(registry.render().strip())
+# HELP requests_total Requests.
+# TYPE requests_total counter
+requests_total{operation="get"} 1
+
+"""
+
+import time
+
+
+class Metric(object):
+    """Base class for metrics.
+
+    A metric has a value for each combination of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.kind),
+            ]
+
+        for labels in sorted(self.values):
+            lines.extend(self.render_value(labels, self.values[labels]))
+
+        return lines
+
+    def render_value(self, labels, value):
+        raise NotImplementedError("must be implemented by subclass.")
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+
+        return "{%s}" % ",".join(
+            '%s="%s"' % (name, escape(value)) for name, value in pairs
+            )
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def render_value(self, labels, value):
+        yield "%s%s %s" % (
+            self.name, self.format_labels(labels), format_number(value)
+            )
+
+
+class Histogram(Metric):
+    """Counts observations (e.g. latencies in seconds) in buckets."""
+
+    kind = "histogram"
+
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+        )
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        super(Histogram, self).__init__(name, help, labels)
+
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        try:
+            counts, total, count = self.values[labels]
+        except KeyError:
+            counts, total, count = [0] * len(self.buckets), 0.0, 0
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+
+        self.values[labels] = counts, total + value, count + 1
+
+    def time(self, d, *labels):
+        """Observe the time until the deferred fires."""
+
+        started = time.time()
+
+        def observe(result):
+            self.observe(time.time() - started, *labels)
+            return result
+
+        return d.addBoth(observe)
+
+    def count(self, *labels):
+        return self.values.get(labels, (None, None, 0))[2]
+
+    def render_value(self, labels, value):
+        counts, total, count = value
+
+        for bound, n in zip(self.buckets, counts):
+            yield "%s_bucket%s %d" % (
+                self.name,
+                self.format_labels(labels, [("le", format_number(bound))]),
+                n
+                )
+
+        yield "%s_bucket%s %d" % (
+            self.name, self.format_labels(labels, [("le", "+Inf")]), count
+            )
+
+        yield "%s_sum%s %s" % (
+            self.name, self.format_labels(labels), format_number(total)
+            )
+
+        yield "%s_count%s %d" % (
+            self.name, self.format_labels(labels), count
+            )
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """Register metric; returns the metric registered by its name."""
+
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+
+        return "".join(line + "\n" for line in lines)
+
+
+registry = Registry()
+
+
+def counter(name, help, labels=()):
+    """Return counter registered with the default registry."""
+
+    return registry.register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=None):
+    """Return histogram registered with the default registry."""
+
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace(
+        "\n", "\\n").replace('"', '\\"')
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def listen(port, interface="127.0.0.1", registry=registry):
+    """Serve metrics over HTTP; returns the listening port."""
+
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class Metrics(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+            return registry.render().encode("utf-8")
+
+    return reactor.listenTCP(port, Site(Metrics()), interface=interface)
@@ -1,11 +1,71 @@
 import gc
 import os
 import sys
+import fcntl
+import ctypes
 import traceback
 
 from twisted.internet.process import _listOpenFDs
 from pop.exceptions import ProcessForked
 
+# The system call is available from Linux 5.9 and the number is the
+# same on all architectures; ``CLOSE_RANGE_CLOEXEC`` requires 5.11
+# (earlier versions fail with ``EINVAL``). If the call fails for any
+# reason, we fall back to going through the descriptors one by one.
+SYS_close_range = 436
+CLOSE_RANGE_CLOEXEC = 1 << 2
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _close_range(first, flags):
+    if _libc is None or not sys.platform.startswith("linux"):
+        return False
+
+    return _libc.syscall(
+        SYS_close_range, ctypes.c_uint(first), ctypes.c_uint(0xffffffff),
+        ctypes.c_uint(flags)
+        ) == 0
+
+
+def set_cloexec(first=3):
+    """Mark descriptors from ``first`` and up as close-on-exec.
+
+    This is a single system call where ``close_range`` is available.
+    """
+
+    if _close_range(first, CLOSE_RANGE_CLOEXEC):
+        return
+
+    for fd in _listOpenFDs():
+        if fd >= first:
+            try:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+            except (IOError, OSError):
+                pass
+
+
+def close_fds(first=3):
+    """Close descriptors from ``first`` and up."""
+
+    if _close_range(first, 0):
+        return
+
+    if _libc is not None and hasattr(_libc, "closefrom"):
+        _libc.closefrom(first)
+        return
+
+    for fd in _listOpenFDs():
+        if fd >= first:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
 
 def fork(uid=None, gid=None):
     settingUID = (uid is not None) or (gid is not None)
@@ -51,12 +111,10 @@ def fork(uid=None, gid=None):
                 # Stop debugging. If I am, I don't care anymore.
                 sys.settrace(None)
 
-                for fd in _listOpenFDs():
-                    if fd > 2:
-                        try:
-                            os.dup(fd)
-                        except:
-                            pass
+                # The child keeps using the descriptors it inherited
+                # (including those of the reactor), but they should
+                # not leak into processes that it executes.
+                set_cloexec()
             except:
                 try:
                     stderr = os.fdopen(2, 'w')
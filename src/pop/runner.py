@@ -0,0 +1,62 @@
+"""Runs a command using the reactor.
+
+This is kept apart from :mod:`pop.command`, such that a command can
+run in the control daemon without importing the client.
+"""
+
+import sys
+
+from StringIO import StringIO
+
+from twisted.python.failure import Failure
+
+from pop import log
+
+
+def run(func, debug, options):
+    """Run command using the reactor and return the exit status.
+
+    The status is non-zero if the command failed.
+    """
+
+    from twisted.internet import reactor
+
+    status = [0]
+
+    def wrapper():
+        d = func(options)
+
+        @d.addCallback
+        def disconnect(client):
+            return client.close()
+
+        @d.addBoth
+        def handle_exit(result, stream=sys.stderr, reactor=reactor):
+            if isinstance(result, Failure):
+                status[0] = 1
+
+                if debug:
+                    tracebackIO = StringIO()
+                    result.printTraceback(file=tracebackIO)
+                    log.warn(tracebackIO.getvalue())
+
+                message = result.getErrorMessage()
+                for i, line in enumerate(message.split('\n')):
+                    line = line[0:1].lower() + line[1:]
+
+                    if i == 0:
+                        line = "error - %s." % line.rstrip('.')
+
+                    log.error(line)
+            else:
+                name = func.__name__.split('_', 1)[-1]
+                log.debug("done - '%s' completed OK.\n" % name)
+
+            if reactor.running:
+                reactor.stop()
+
+        return d
+
+    reactor.callWhenRunning(wrapper)
+    reactor.run()
+    return status[0]
@@ -0,0 +1,130 @@
+"""Codecs for node data.
+
+Data written using a codec other than the default for the node is
+prefixed with a tag that names the codec, such that it can be read
+back regardless of the current setting:
+
+>>> fmt = NodeFormat("json", "yaml")
+>>> data = fmt.dumps({"port": 8080})
+>>> data.split("\\x00")[1]
+'yaml'
+>>> fmt.loads(data)
+{'port': 8080}
+>>> NodeFormat("json").loads('{"port": 8080}')
+{u'port': 8080}
+
+"""
+
+import json
+import yaml
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+TAG = "\x00"
+
+codecs = {}
+
+
+def register(codec):
+    codecs[codec.name] = codec
+    return codec
+
+
+def get_codec(name):
+    try:
+        return codecs[name]
+    except KeyError:
+        raise KeyError("No such codec: %s." % name)
+
+
+@register
+class JSONCodec(object):
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value)
+
+
+@register
+class YAMLCodec(object):
+    """Uses the C-accelerated loader and dumper if available."""
+
+    name = "yaml"
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+    @classmethod
+    def loads(cls, data):
+        return yaml.load(data, Loader=cls.loader)
+
+    @classmethod
+    def dumps(cls, value):
+        return yaml.dump(value, Dumper=cls.dumper)
+
+
+@register
+class MessagePackCodec(object):
+    """Compact binary format (requires the ``msgpack`` package)."""
+
+    name = "msgpack"
+
+    @staticmethod
+    def loads(data):
+        if msgpack is None:
+            raise ImportError("The 'msgpack' package is required.")
+
+        return msgpack.unpackb(data)
+
+    @staticmethod
+    def dumps(value):
+        if msgpack is None:
+            raise ImportError("The 'msgpack' package is required.")
+
+        return msgpack.packb(value)
+
+
+class NodeFormat(object):
+    """Reads and writes node data.
+
+    Untagged data is read using the ``default`` codec; this is also
+    the codec used for writing, unless ``codec`` is given.
+    """
+
+    def __init__(self, default, codec=None):
+        self.default = get_codec(default)
+        self.codec = get_codec(codec or default)
+
+    def loads(self, data):
+        # On Python 3, node data may be given as bytes (see
+        # ``pop.aio``).
+        tag = TAG if isinstance(data, str) else TAG.encode("ascii")
+
+        if data and data.startswith(tag):
+            name, data = data[len(tag):].split(tag, 1)
+            if not isinstance(name, str):
+                name = name.decode("ascii")
+
+            return get_codec(name).loads(data)
+
+        return self.default.loads(data)
+
+    def dumps(self, value):
+        data = self.codec.dumps(value)
+
+        if self.codec is not self.default:
+            prefix = TAG + self.codec.name + TAG
+            if not isinstance(data, str):
+                prefix = prefix.encode("ascii")
+
+            data = prefix + data
+
+        return data
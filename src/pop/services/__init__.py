@@ -1,3 +1,4 @@
+import sys
 import venusian
 
 
@@ -7,3 +8,69 @@ def register(factory):
         registry[factory.name] = factory
     venusian.attach(factory, callback)
     return factory
+
+
+class ServiceRegistry(object):
+    """Maps service names to factories.
+
+    The registry is populated from the ``pop.services`` entry point
+    group, and a factory is only imported when it's looked up. If
+    no entry points are available (i.e. running from a source
+    checkout), we fall back to scanning this package.
+    """
+
+    group = "pop.services"
+
+    def __init__(self, entry_points=None):
+        self._entry_points = entry_points or {}
+        self._factories = {}
+
+    @classmethod
+    def from_entry_points(cls):
+        import pkg_resources
+
+        entry_points = dict(
+            (entry_point.name, entry_point) for entry_point in
+            pkg_resources.iter_entry_points(cls.group)
+            )
+
+        registry = cls(entry_points)
+
+        if not entry_points:
+            scanner = venusian.Scanner()
+            scanner.scan(sys.modules[__name__])
+            registry._factories.update(getattr(scanner, 'registry', {}))
+
+        return registry
+
+    def __contains__(self, name):
+        return name in self._factories or name in self._entry_points
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, name):
+        try:
+            return self._factories[name]
+        except KeyError:
+            entry_point = self._entry_points[name]
+
+        factory = self._factories[name] = entry_point.load()
+        return factory
+
+    def keys(self):
+        return sorted(set(self._factories).union(self._entry_points))
+
+    def load_all(self):
+        """Import all factories."""
+
+        for name in self.keys():
+            self[name]
+
+    def describe(self, name):
+        """Return description of service (importing its factory)."""
+
+        return self[name].description
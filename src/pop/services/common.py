@@ -1,15 +1,34 @@
 import os
 import json
+import errno
+import select
 import signal
+import socket
+import threading
 import zookeeper
 
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
 from twisted.internet.defer import \
+     gatherResults, \
      inlineCallbacks, \
      returnValue, \
      succeed
 
+from zookeeper import BadVersionException
+from zookeeper import NodeExistsException
+from zookeeper import NoNodeException
+
 from pop import log
 from pop.agent import Agent
+from pop.hierarchy import added_machines
+from pop.hierarchy import instance_count
+from pop.hierarchy import service_index_paths
+from pop.hierarchy import unique
+from pop.serialization import NodeFormat
 
 from .utils import nodeproperty
 from .utils import DeferredDict
@@ -30,6 +49,20 @@ class Service(Agent):
     description = None
     kind = nodeproperty("type")
 
+    # The codec used to write settings and state (see
+    # ``pop.serialization``); data is read regardless of codec.
+    codec = None
+
+    # The services that must be up on a machine before this one is
+    # started there, and the relative cost of starting it; these are
+    # written to the settings when the service is added.
+    requires = ()
+    weight = 1
+
+    # The number of the process running the service on a machine, if
+    # there is more than one (see ``PythonNetworkService``).
+    instance = 0
+
     defaults = {
         'host': '0.0.0.0',
         'port': 8080,
@@ -40,17 +73,61 @@ class Service(Agent):
     _states = None
 
     @inlineCallbacks
-    def deploy(self, machine):
-        """Deploy service."""
+    def deploy(self, *machines):
+        """Deploy service to one or more machines.
+
+        The machines are added to the machines declaration of the
+        service, and the service to the deployment index of each
+        machine. The changes are sent as one pipelined transaction
+        (see ``pop.client.Transaction``), which is retried on a
+        concurrent change. Returns the machines that were added to
+        the declaration.
+        """
 
-        log.debug("machine id: %s." % machine)
+        log.debug("machine id: %s." % ", ".join(machines))
 
+        machines = unique(machines)
         path = self.path + "/machines"
-        value, metadata = yield self.client.get(path)
-        machines = json.loads(value)
-        machines.append(machine)
+        indexes = service_index_paths(self.path, machines)
+
+        while True:
+            # The parent of an index entry may have been created by a
+            # concurrent deploy (in which case this is free), or
+            # deleted since the last attempt.
+            yield gatherResults([
+                self.client.create_path(index) for index in indexes
+                ])
+
+            results = yield gatherResults(
+                [self.client.get(path)] +
+                [self.client.exists(index) for index in indexes]
+                )
+
+            (value, metadata), stats = results[0], results[1:]
+            declared = json.loads(value)
+            added = added_machines(declared, machines)
+            transaction = self.client.transaction()
+
+            if added:
+                transaction.set(
+                    path, json.dumps(declared + added), metadata["version"]
+                    )
 
-        yield self.client.set(path, json.dumps(machines))
+            for index, stat in zip(indexes, stats):
+                if stat is None:
+                    transaction.create(index)
+
+            try:
+                yield transaction.commit()
+            except (BadVersionException, NodeExistsException,
+                    NoNodeException):
+                log.debug("concurrent deploy; retrying...")
+            else:
+                returnValue(added)
+
+    @property
+    def node_format(self):
+        return NodeFormat("json", self.codec)
 
     def get_settings(self):
         if self._settings is None:
@@ -63,12 +140,13 @@ class Service(Agent):
 
                 defaults.update(entries)
 
+            fmt = self.node_format
             settings = self._settings = DeferredDict(
                 self.client, self.path + "/settings",
-                defaults, json.loads, json.dumps
+                defaults, fmt.loads, fmt.dumps
                 )
 
-            d = settings.load()
+            d = settings.load(watch=False)
 
             @d.addCallback
             def get(metadata):
@@ -84,9 +162,10 @@ class Service(Agent):
 
         state = self._states.get(machine)
         if state is None:
+            fmt = self.node_format
             state = self._states[machine] = DeferredDict(
                 self.client, self.path + "/state/" + machine,
-                {}, json.loads, json.dumps
+                {}, fmt.loads, fmt.dumps
                 )
 
             d = state.load(watch=watch)
@@ -105,13 +184,33 @@ class Service(Agent):
         return d
 
     @inlineCallbacks
-    def add(self):
-        """Add service definition to hierarchy."""
+    def add(self, settings=None):
+        """Add service definition to hierarchy.
+
+        The nodes are created in a single transaction such that a
+        failure leaves no partial definition behind.
+        """
 
-        yield self.client.create(self.path)
-        yield self.client.create(self.path + "/type", self.name)
-        yield self.client.create(self.path + "/state")
-        yield self.client.create(self.path + "/machines", "[]")
+        settings = dict(settings or {})
+
+        if self.requires:
+            settings.setdefault("requires", list(self.requires))
+
+        if self.weight != 1:
+            settings.setdefault("weight", self.weight)
+
+        transaction = self.client.transaction()
+        transaction.create(self.path)
+        transaction.create(self.path + "/type", self.name)
+        transaction.create(self.path + "/state")
+        transaction.create(self.path + "/machines", "[]")
+
+        if settings:
+            transaction.create(
+                self.path + "/settings", self.node_format.dumps(settings)
+                )
+
+        yield transaction.commit()
 
         log.debug("registered service '%s' at %s." % (self.name, self.path))
 
@@ -124,4 +223,199 @@ class PythonService(Service):
 
 
 class PythonNetworkService(PythonService):
-    """Base class for Python-based network services."""
+    """Base class for Python-based network services.
+
+    The ``workers`` setting gives the number of instances of the
+    service that the machine agent starts. The instances share the
+    listening port using ``SO_REUSEPORT``, such that the kernel
+    distributes connections between them; this requires a fixed
+    port.
+    """
+
+    defaults = {
+        'workers': 1,
+        }
+
+    backlog = 50
+
+    def listen(self, host, port, workers=1):
+        """Return socket listening on the given address.
+
+        The number of ``workers`` may be given as a string (e.g. on
+        the command line).
+        """
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if int(workers) > 1:
+            if not hasattr(socket, "SO_REUSEPORT"):
+                raise RuntimeError("SO_REUSEPORT is not supported.")
+
+            if port == 0:
+                log.warn("workers require a fixed port.")
+
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        try:
+            s.bind((host, port))
+            s.listen(self.backlog)
+        except socket.error:
+            s.close()
+            raise
+
+        return s
+
+
+class ThreadedNetworkService(PythonNetworkService):
+    """Base class for network services using blocking IO.
+
+    An acceptor thread queues incoming connections for a pool of
+    ``threads`` worker threads, which call ``handle`` for each
+    connection and close it afterwards. When ``queue_size``
+    connections are waiting, the acceptor blocks and further
+    connections wait in the listen backlog.
+
+    Stopping the service wakes up the acceptor using a pipe, which
+    then closes the listening socket, and shuts down the connections
+    that are being handled; the returned deferred fires when the
+    threads have exited.
+    """
+
+    threads = 8
+    queue_size = 64
+
+    # Timeout in seconds for blocking operations on a connection.
+    timeout = None
+
+    # Internal attributes.
+    _socket = None
+
+    @inlineCallbacks
+    def start(self):
+        settings = yield self.get_settings()
+        s = self.listen(
+            settings['host'], settings['port'], instance_count(settings)
+            )
+
+        host, port = s.getsockname()
+        self.serve(s)
+        returnValue({'host': host, 'port': port})
+
+    def handle(self, connection, address):
+        """Handle client connection (called in a worker thread)."""
+
+        raise NotImplementedError("must be implemented by subclass.")
+
+    def serve(self, s):
+        """Start threads serving connections on listening socket."""
+
+        # The acceptor waits for either socket to be readable such
+        # that ``accept`` never blocks.
+        s.setblocking(False)
+        self._socket = s
+        self._wakeup = os.pipe()
+        self._queue = Queue(self.queue_size)
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._accept)] + [
+            threading.Thread(target=self._work)
+            for i in range(self.threads)
+            ]
+
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        s, self._socket = self._socket, None
+        if s is None:
+            return succeed(None)
+
+        r, w = self._wakeup
+        try:
+            os.write(w, b"x")
+        except OSError:
+            # The acceptor has already exited.
+            pass
+        finally:
+            os.close(w)
+
+        with self._lock:
+            for connection in self._connections:
+                _shutdown(connection)
+
+        from twisted.internet.threads import deferToThread
+        return deferToThread(self._join)
+
+    def _join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _accept(self):
+        s = self._socket
+        r, w = self._wakeup
+
+        while True:
+            try:
+                readable, writable, failed = select.select([s, r], [], [])
+            except (select.error, OSError) as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                log.warn(exc)
+                break
+
+            if r in readable:
+                break
+
+            try:
+                connection, address = s.accept()
+            except socket.error as exc:
+                # The connection may be gone by the time we accept it.
+                if exc.args[0] in (
+                        errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    continue
+                log.warn(exc)
+                break
+
+            self._queue.put((connection, address))
+
+        s.close()
+        os.close(r)
+
+        for thread in self._threads[1:]:
+            self._queue.put(None)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            connection, address = item
+
+            with self._lock:
+                stopped = self._socket is None
+                if not stopped:
+                    self._connections.add(connection)
+
+            try:
+                if not stopped:
+                    connection.settimeout(self.timeout)
+                    self.handle(connection, address)
+            except socket.error as exc:
+                log.info("%s: %s." % (address, exc))
+            except Exception:
+                log.exception("error handling connection: %s." % (
+                    address, ))
+            finally:
+                with self._lock:
+                    self._connections.discard(connection)
+                connection.close()
+
+
+def _shutdown(s):
+    try:
+        s.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
@@ -1,9 +1,17 @@
+import random
+
 from twisted.internet import defer
 from twisted.internet.defer import returnValue
 from twisted.internet.defer import inlineCallbacks
 from twisted.python.failure import Failure
+from txzookeeper.utils import sleep
 
+from zookeeper import BadVersionException
 from zookeeper import NoNodeException
+from zookeeper import NodeExistsException
+
+from pop import log
+from pop.utils import merge
 
 
 def nodeproperty(path, default=None, typecast=str):
@@ -11,7 +19,9 @@ def nodeproperty(path, default=None, typecast=str):
     @inlineCallbacks
     def prop(self):
         try:
-            value, metadata = yield self.client.get(self.path + path)
+            value, metadata = yield self.client.get_cached(
+                self.path + path
+                )
         except NoNodeException:
             value = default
 
@@ -45,22 +55,60 @@ def dictproperty(path, loads, dumps):
 
 
 class DeferredDict(dict):
+    """Dictionary which is saved to a node when changed.
+
+    Changes are coalesced into a single write which is sent after
+    ``delay`` seconds; the default is to write at the end of the
+    current reactor iteration. Each change within the window
+    postpones the write (i.e. a debounce). If ``delay`` is
+    ``None``, every change is written immediately.
+
+    Calling the dictionary sends any pending write right away and
+    returns a deferred that fires with the ``(success, changes)`` of
+    each write when all changes have been written; if a write fails,
+    the deferred fails with its error.
+
+    Writes are conditional on the version of the node that was last
+    read. On conflict, the node is read again and the local changes
+    are merged into it key by key (see :func:`pop.utils.merge`), then
+    the write is retried after a randomized, growing delay.
+    """
+
     loaded = False
 
-    def __init__(self, client, path, defaults, loads, dumps):
+    # Delay in seconds before the first retry, and the upper bound.
+    backoff = 0.01
+    max_backoff = 1.0
+
+    def __init__(self, client, path, defaults, loads, dumps, delay=0):
         self._defaults = defaults
         self._deferreds = []
         self._client = client
         self._path = path
         self._loads = loads
         self._dumps = dumps
+        self._delay = delay
+        self._pending = None
+        self._call = None
+        self._lock = defer.DeferredLock()
+        self._pristine = {}
+        self._version = None
 
     def __call__(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._flush()
+
         try:
-            return defer.DeferredList(self._deferreds)
+            d = defer.DeferredList(
+                self._deferreds, fireOnOneErrback=True, consumeErrors=True
+                )
         finally:
             del self._deferreds[:]
 
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
     def __getitem__(self, item):
         try:
             return dict.__getitem__(self, item)
@@ -69,14 +117,21 @@ class DeferredDict(dict):
 
     def __setitem__(self, item, value):
         dict.__setitem__(self, item, value)
-        d = self.save()
-        self._deferreds.append(d)
+        self._changed()
+
+    def __delitem__(self, item):
+        dict.__delitem__(self, item)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
 
     def load(self, watch=True):
         if watch:
             d, watch = self._client.get_and_watch(self._path)
         else:
-            d = self._client.get(self._path)
+            d = self._client.get_cached(self._path)
 
         @d.addBoth
         def _get(result, *args):
@@ -86,7 +141,9 @@ class DeferredDict(dict):
             value, metadata = result
             data = self._loads(value)
             self.clear()
-            self.update(data)
+            dict.update(self, data)
+            self._pristine = dict(data)
+            self._version = metadata["version"]
 
         if watch:
             @d.addCallback
@@ -96,5 +153,91 @@ class DeferredDict(dict):
         return d
 
     def save(self):
-        data = self._dumps(dict(self))
-        return self._client.set_or_create(self._path, data)
+        """Write changes to the node.
+
+        Returns a deferred which fires with the list of changes
+        (``AddedItem``, ``ModifiedItem`` and ``DeletedItem``).
+        """
+
+        return self._lock.run(self._save)
+
+    @inlineCallbacks
+    def _save(self):
+        delay = self.backoff
+
+        while True:
+            current = dict(self._pristine)
+            changes = merge(self._pristine, self, current)
+
+            if not changes and self._version is not None:
+                returnValue(changes)
+
+            data = self._dumps(current)
+
+            # A missing parent makes the create fail with the same
+            # error as a set on a deleted node; only the latter is a
+            # conflict.
+            try:
+                if self._version is None:
+                    yield self._client.create(self._path, data)
+                    version = 0
+                else:
+                    try:
+                        stat = yield self._client.set(
+                            self._path, data, self._version
+                            )
+                    except NoNodeException:
+                        raise BadVersionException(self._path)
+
+                    version = stat["version"]
+            except (BadVersionException, NodeExistsException):
+                log.debug("conflict writing %s; retrying." % self._path)
+            else:
+                self._pristine = current
+                self._version = version
+
+                for change in changes:
+                    log.debug("%s: %s." % (self._path, change))
+
+                returnValue(changes)
+
+            yield sleep(delay * random.uniform(1, 2))
+            delay = min(delay * 2, self.max_backoff)
+            yield self._refresh()
+
+    @inlineCallbacks
+    def _refresh(self):
+        """Read the node and merge local changes into it."""
+
+        try:
+            value, metadata = yield self._client.get(self._path)
+        except NoNodeException:
+            current, version = {}, None
+        else:
+            current, version = self._loads(value), metadata["version"]
+
+        pristine = dict(current)
+        merge(self._pristine, self, current)
+        self.clear()
+        dict.update(self, current)
+        self._pristine = pristine
+        self._version = version
+
+    def _changed(self):
+        if self._delay is None:
+            self._deferreds.append(self.save())
+            return
+
+        if self._call is not None:
+            self._call.reset(self._delay)
+            return
+
+        from twisted.internet import reactor
+        self._pending = defer.Deferred()
+        self._deferreds.append(self._pending)
+        self._call = reactor.callLater(self._delay, self._flush)
+
+    def _flush(self):
+        d = self._pending
+        self._pending = self._call = None
+        self.save().chainDeferred(d)
@@ -0,0 +1,186 @@
+"""Supervision of service processes.
+
+When a service process fails, it's restarted after a delay which
+grows exponentially with the number of consecutive failures (with
+random jitter, such that services that fail together don't restart
+in lockstep). A process that runs for at least ``reset_after``
+seconds resets the count.
+
+A process that exits cleanly (with status 0) was stopped on request,
+e.g. using ``pop stop``, and is not restarted.
+
+A service that fails ``max_failures`` times in a row is in a crash
+loop and is no longer restarted, until it's deployed to the machine
+again (or the agent is restarted).
+
+Each instance of a service (see the ``workers`` setting) is restarted
+on its own, but the failures are counted for the service as a whole.
+
+The restart history of a service is published to
+``/services/<service-name>/restarts/<machine-id>``.
+"""
+
+import os
+import json
+import time
+import random
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.process import registerReapProcessHandler
+from twisted.internet.process import unregisterReapProcessHandler
+
+from pop import log
+from pop.hierarchy import instance_name
+
+
+class Reaper(object):
+    """Reaps a forked process (see ``registerReapProcessHandler``)."""
+
+    def __init__(self, pid, exited):
+        self.pid = pid
+        self.exited = exited
+
+    def reapProcess(self):
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError:
+            pid = None
+
+        if pid:
+            unregisterReapProcessHandler(pid, self)
+            self.processEnded(status)
+
+    def processEnded(self, status):
+        self.exited(self.pid, status)
+
+
+class Supervisor(object):
+    """Restarts the service processes of a machine agent.
+
+    The ``restart`` function is called with the name of a service
+    and the instance number to start it again.
+    """
+
+    backoff = 1.0
+    max_backoff = 300.0
+    reset_after = 60.0
+    max_failures = 5
+
+    def __init__(self, client, path, machine, restart):
+        self.client = client
+        self.path = path
+        self.machine = machine
+        self.restart = restart
+        self.processes = {}
+        self.started = {}
+        self.failures = {}
+        self.restarts = {}
+        self.scheduled = {}
+        self.crashed = set()
+
+    def supervised(self, name):
+        """Return true if the supervisor is responsible for service.
+
+        This is the case while a process is running for it, a
+        restart is scheduled or it's in a crash loop.
+        """
+
+        return (
+            any(key[0] == name for key in self.processes.values()) or
+            any(key[0] == name for key in self.scheduled) or
+            name in self.crashed
+            )
+
+    def watch(self, pid, name, instance=0, reap=True):
+        """Watch service process.
+
+        If ``reap`` is true, the process is reaped when it exits;
+        otherwise, ``exited`` must be called.
+        """
+
+        key = self.processes[pid] = (name, instance)
+        self.started[key] = time.time()
+
+        if reap:
+            registerReapProcessHandler(pid, Reaper(pid, self.exited))
+
+    def exited(self, pid, status):
+        key = self.processes.pop(pid, None)
+        if key is None:
+            return
+
+        name, instance = key
+
+        now = time.time()
+        started = self.started.pop(key, now)
+
+        if status == 0:
+            log.info("service stopped: %s." % instance_name(name, instance))
+            return
+
+        if now - started >= self.reset_after:
+            self.failures[name] = 0
+
+        failures = self.failures[name] = self.failures.get(name, 0) + 1
+        restarts = self.restarts[name] = self.restarts.get(name, 0) + 1
+
+        if failures >= self.max_failures:
+            log.error("service in crash loop: %s (%d failures)." % (
+                name, failures))
+            self.crashed.add(name)
+            delay = None
+        else:
+            delay = min(
+                self.backoff * 2 ** (failures - 1), self.max_backoff
+                ) * random.uniform(0.5, 1.5)
+
+            log.warn("service exited: %s (status: %d); restarting in "
+                     "%.1f seconds." % (
+                         instance_name(name, instance), status, delay))
+
+            from twisted.internet import reactor
+            self.scheduled[key] = reactor.callLater(
+                delay, self._restart, key
+                )
+
+        d = self.publish(name, {
+            "instance": instance,
+            "restarts": restarts,
+            "failures": failures,
+            "status": status,
+            "exited": now,
+            "delay": delay,
+            "crashloop": name in self.crashed,
+            })
+
+        @d.addErrback
+        def failed(failure):
+            log.warn("unable to publish restarts: %s (%s)." % (
+                name, failure.getErrorMessage()))
+
+    def forget(self, name):
+        """Stop supervising service (e.g. it's no longer deployed)."""
+
+        for key in list(self.scheduled):
+            if key[0] == name:
+                call = self.scheduled.pop(key)
+                if call.active():
+                    call.cancel()
+
+        self.crashed.discard(name)
+        self.failures.pop(name, None)
+
+    def stop(self):
+        for name, instance in list(self.scheduled):
+            self.forget(name)
+
+    @inlineCallbacks
+    def publish(self, name, data):
+        path = self.path + "/services/" + name + "/restarts/" + self.machine
+        yield self.client.create_path(path)
+        yield self.client.set_or_create(path, json.dumps(data))
+
+    def _restart(self, key):
+        del self.scheduled[key]
+        log.info("restarting service: %s..." % instance_name(*key))
+        self.restart(*key)
@@ -0,0 +1,366 @@
+import time
+import posixpath
+
+from twisted.internet import defer
+
+from txzookeeper.client import ClientEvent
+
+from zookeeper import ConnectionLossException
+from zookeeper import NoChildrenForEphemeralsException
+from zookeeper import NoNodeException
+from zookeeper import NodeExistsException
+from zookeeper import NotEmptyException
+from zookeeper import BadVersionException
+from zookeeper import SessionExpiredException
+from zookeeper import CONNECTED_STATE
+from zookeeper import EXPIRED_SESSION_STATE
+from zookeeper import EPHEMERAL
+from zookeeper import CREATED_EVENT
+from zookeeper import DELETED_EVENT
+from zookeeper import CHANGED_EVENT
+from zookeeper import CHILD_EVENT
+from zookeeper import SESSION_EVENT
+
+from pop.client import ZookeeperClient
+
+
+class Node(object):
+    """Node in the in-memory tree."""
+
+    def __init__(self, data="", owner=0, acls=()):
+        now = int(time.time() * 1000)
+        self.data = data
+        self.acls = list(acls)
+        self.children = set()
+        self.stat = {
+            "version": 0,
+            "cversion": 0,
+            "ctime": now,
+            "mtime": now,
+            "dataLength": len(data),
+            "numChildren": 0,
+            "ephemeralOwner": owner,
+            }
+
+    def update(self, data):
+        self.data = data
+        self.stat = dict(
+            self.stat,
+            version=self.stat["version"] + 1,
+            mtime=int(time.time() * 1000),
+            dataLength=len(data),
+            )
+
+
+class FakeZookeeperServer(object):
+    """In-memory tree shared by fake clients.
+
+    Each connected client has a session; the ephemeral nodes of a
+    session are deleted when it's closed or expires. Watches are
+    shared, such that a client is notified of the changes made by
+    another.
+
+    Requests can be made to fail using :meth:`fail`.
+    """
+
+    def __init__(self, tree=None):
+        self.tree = tree if tree is not None else {"/": Node()}
+        self.watches = {}
+        self.sessions = {}
+        self.failures = []
+        self._session_id = 0
+
+    def open(self, client):
+        """Return new session for client."""
+
+        self._session_id += 1
+        self.sessions[self._session_id] = client
+        return self._session_id
+
+    def close(self, session):
+        """Close session, deleting its ephemeral nodes."""
+
+        self.sessions.pop(session, None)
+
+        ephemeral = [
+            path for (path, node) in self.tree.items()
+            if node.stat["ephemeralOwner"] == session
+            ]
+
+        for path in sorted(ephemeral, reverse=True):
+            self.delete(path)
+
+        for key, watchers in list(self.watches.items()):
+            watchers[:] = [
+                (client, watcher) for (client, watcher) in watchers
+                if client.session != session
+                ]
+
+    def fail(self, operation, exception=ConnectionLossException,
+             path=None, count=1):
+        """Fail the next requests for operation (and path, if given).
+
+        The ``operation`` is the name of a client method, e.g. "get"
+        or "create". The ``exception`` is raised for ``count``
+        requests, or all, if ``count`` is ``None``.
+        """
+
+        self.failures.append([operation, path, exception, count])
+
+    def check(self, operation, path):
+        """Raise the exception injected for the request, if any."""
+
+        for failure in self.failures:
+            name, match, exception, count = failure
+            if name == operation and match in (None, path):
+                if count is not None:
+                    failure[3] -= 1
+                    if failure[3] == 0:
+                        self.failures.remove(failure)
+
+                raise exception(path)
+
+    def create(self, path, data, owner=0, acls=()):
+        if path in self.tree:
+            raise NodeExistsException(path)
+
+        parent = self.get(posixpath.dirname(path), path)
+        if parent.stat["ephemeralOwner"]:
+            raise NoChildrenForEphemeralsException(path)
+
+        self.tree[path] = Node(data, owner, acls)
+        self._link(parent, path)
+        self.trigger("exists", path, CREATED_EVENT)
+        self.trigger("child", posixpath.dirname(path), CHILD_EVENT)
+
+    def delete(self, path, version=-1):
+        node = self.get(path)
+        self._check_version(node, version)
+        if node.children:
+            raise NotEmptyException(path)
+
+        del self.tree[path]
+        self._unlink(self.tree[posixpath.dirname(path)], path)
+        self.trigger("exists", path, DELETED_EVENT)
+        self.trigger("child", path, DELETED_EVENT)
+        self.trigger("child", posixpath.dirname(path), CHILD_EVENT)
+
+    def set(self, path, data, version=-1):
+        node = self.get(path)
+        self._check_version(node, version)
+        node.update(data)
+        self.trigger("exists", path, CHANGED_EVENT)
+        return node.stat
+
+    def get(self, path, origin=None):
+        try:
+            return self.tree[path]
+        except KeyError:
+            raise NoNodeException(origin or path)
+
+    def watch(self, kind, path, client, watcher):
+        if watcher is not None:
+            self.watches.setdefault((kind, path), []).append(
+                (client, watcher)
+                )
+
+    def trigger(self, kind, path, event):
+        from twisted.internet import reactor
+        for client, watcher in self.watches.pop((kind, path), ()):
+            reactor.callLater(
+                client.latency, watcher, event, CONNECTED_STATE, path
+                )
+
+    @staticmethod
+    def _link(parent, path):
+        parent.children.add(posixpath.basename(path))
+        parent.stat = dict(
+            parent.stat,
+            cversion=parent.stat["cversion"] + 1,
+            numChildren=len(parent.children),
+            )
+
+    @staticmethod
+    def _unlink(parent, path):
+        parent.children.discard(posixpath.basename(path))
+        parent.stat = dict(
+            parent.stat,
+            cversion=parent.stat["cversion"] + 1,
+            numChildren=len(parent.children),
+            )
+
+    @staticmethod
+    def _check_version(node, version):
+        if version != -1 and version != node.stat["version"]:
+            raise BadVersionException(version)
+
+
+class FakeZookeeperClient(ZookeeperClient):
+    """In-memory stand-in for a ZooKeeper client.
+
+    The tree is kept by a :class:`FakeZookeeperServer`, which may be
+    shared by several clients; unless given, each client has its own.
+    Replies are delivered after ``latency`` seconds using the reactor,
+    which simulates the round-trip to a remote server; requests that
+    are issued together are answered together.
+
+    Watches are one-shot and are delivered like replies.
+
+    >>> client = FakeZookeeperClient()
+    >>> client.connected
+    False
+
+    """
+
+    session = None
+    expired = False
+
+    def __init__(self, servers=None, session_timeout=None, cache_size=0,
+                 latency=0, tree=None, server=None):
+        super(FakeZookeeperClient, self).__init__(
+            servers, session_timeout, cache_size
+            )
+        self.latency = latency
+        self.server = server if server is not None else \
+            FakeZookeeperServer(tree)
+        self.requests = 0
+
+    @property
+    def tree(self):
+        return self.server.tree
+
+    @property
+    def client_id(self):
+        if self.session is not None:
+            return self.session, ""
+
+    @property
+    def watches(self):
+        return self.server.watches
+
+    def connect(self, servers=None, timeout=10, client_id=None):
+        self.connected = True
+        self.expired = False
+        self.session = self.server.open(self)
+        return self._reply(self)
+
+    def close(self, force=False):
+        if self.session is not None:
+            self.server.close(self.session)
+            self.session = None
+
+        self.connected = False
+        return defer.succeed(True)
+
+    def expire(self):
+        """Expire the session.
+
+        The ephemeral nodes of the session are deleted, pending
+        watches fail with ``SessionExpiredException``, the session
+        callback is notified and requests fail from here on.
+        """
+
+        watchers = [
+            watcher for watchers in self.server.watches.values()
+            for (client, watcher) in watchers if client is self
+            ]
+
+        self.server.close(self.session)
+        self.session = None
+        self.connected = False
+        self.expired = True
+
+        from twisted.internet import reactor
+        for watcher in watchers:
+            reactor.callLater(
+                self.latency, watcher, None, None, None,
+                error=SessionExpiredException("Session expired")
+                )
+
+        if self._session_event_callback is not None:
+            reactor.callLater(
+                self.latency, self._session_event_callback, self,
+                ClientEvent(SESSION_EVENT, EXPIRED_SESSION_STATE, "", None)
+                )
+
+    def create(self, path, data="", acls=(), flags=0):
+        def create():
+            owner = self.session if flags & EPHEMERAL else 0
+            self.server.create(path, data, owner, acls)
+            return path
+
+        return self._request("create", path, create)
+
+    def delete(self, path, version=-1):
+        def delete():
+            self.server.delete(path, version)
+            return 0
+
+        return self._request("delete", path, delete)
+
+    def set(self, path, data="", version=-1):
+        def set():
+            return self.server.set(path, data, version)
+
+        return self._request("set", path, set)
+
+    def _get(self, path, watcher):
+        def get():
+            node = self.server.get(path)
+            self.server.watch("exists", path, self, watcher)
+            return node.data, node.stat
+
+        return self._request("get", path, get)
+
+    def get_acl(self, path):
+        def get_acl():
+            node = self.server.get(path)
+            return node.acls, node.stat
+
+        return self._request("get_acl", path, get_acl)
+
+    def _get_children(self, path, watcher):
+        def get_children():
+            node = self.server.get(path)
+            self.server.watch("child", path, self, watcher)
+            return sorted(node.children)
+
+        return self._request("get_children", path, get_children)
+
+    def _exists(self, path, watcher):
+        def exists():
+            node = self.tree.get(path)
+            self.server.watch("exists", path, self, watcher)
+            return node.stat if node is not None else None
+
+        return self._request("exists", path, exists)
+
+    def _request(self, operation, path, func):
+        self.requests += 1
+
+        try:
+            if self.expired:
+                raise SessionExpiredException(path)
+
+            self.server.check(operation, path)
+            result = func()
+        except Exception as exc:
+            d = self._reply(exc, failed=True)
+        else:
+            d = self._reply(result)
+
+        return self._measure(operation, d)
+
+    def _reply(self, result, failed=False):
+        if failed:
+            d = defer.fail(result)
+        else:
+            d = defer.succeed(result)
+
+        if not self.latency:
+            return d
+
+        from twisted.internet import reactor
+        delayed = defer.Deferred()
+        reactor.callLater(self.latency, d.chainDeferred, delayed)
+        return delayed
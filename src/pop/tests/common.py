@@ -46,3 +46,17 @@ class TestCase(TrialTestCase):
         d = Deferred()
         self.reactor.callLater(seconds, d.callback, seconds)
         return d
+
+
+class ZookeeperTestCase(TestCase):
+    """Connects an in-memory client (``self.client``)."""
+
+    cache_size = 0
+    latency = 0.001
+
+    def setUp(self):
+        from pop.testing import FakeZookeeperClient
+        self.client = FakeZookeeperClient(
+            cache_size=self.cache_size, latency=self.latency
+            )
+        return self.client.connect()
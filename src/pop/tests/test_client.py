@@ -0,0 +1,183 @@
+from twisted.internet.defer import inlineCallbacks
+
+from zookeeper import EPHEMERAL
+from zookeeper import NodeExistsException
+from zookeeper import NoNodeException
+
+from .common import ZookeeperTestCase
+
+
+class TransactionTest(ZookeeperTestCase):
+    @inlineCallbacks
+    def test_commit(self):
+        yield self.client.create("/a", "x")
+
+        transaction = self.client.transaction()
+        transaction.create("/b")
+        transaction.create("/b/c", "1")
+        transaction.set("/a", "y")
+
+        results = yield transaction.commit()
+        self.assertEqual(results[:2], ["/b", "/b/c"])
+
+        value, metadata = yield self.client.get("/a")
+        self.assertEqual(value, "y")
+
+    @inlineCallbacks
+    def test_failure_undoes_operations(self):
+        yield self.client.create("/a", "x")
+
+        transaction = self.client.transaction()
+        transaction.create("/b")
+        transaction.create("/b/c", "1")
+        transaction.set("/a", "y")
+        transaction.create("/a")
+
+        yield self.assertFailure(transaction.commit(), NodeExistsException)
+
+        children = yield self.client.get_children("/")
+        self.assertEqual(children, ["a"])
+        value, metadata = yield self.client.get("/a")
+        self.assertEqual(value, "x")
+
+    @inlineCallbacks
+    def test_failure_restores_deleted_node(self):
+        acls = [{"perms": 31, "scheme": "digest", "id": "pop:secret"}]
+        yield self.client.create("/a", "x", acls, EPHEMERAL)
+
+        transaction = self.client.transaction()
+        transaction.delete("/a")
+        transaction.create("/b/c")
+
+        yield self.assertFailure(transaction.commit(), NoNodeException)
+
+        value, metadata = yield self.client.get("/a")
+        self.assertEqual(value, "x")
+        self.assertEqual(metadata["ephemeralOwner"], self.client.session)
+        restored, metadata = yield self.client.get_acl("/a")
+        self.assertEqual(restored, acls)
+
+    @inlineCallbacks
+    def test_ephemeral_node_of_other_session_is_not_restored(self):
+        from pop.testing import FakeZookeeperClient
+        other = FakeZookeeperClient(server=self.client.server)
+        yield other.connect()
+        self.addCleanup(other.close)
+        yield other.create("/a", "x", flags=EPHEMERAL)
+
+        transaction = self.client.transaction()
+        transaction.delete("/a")
+        transaction.create("/b/c")
+
+        yield self.assertFailure(transaction.commit(), NoNodeException)
+        stat = yield self.client.exists("/a")
+        self.assertIs(stat, None)
+
+
+class DeleteTest(ZookeeperTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield super(DeleteTest, self).setUp()
+
+        for path in ("/a", "/a/b", "/a/b/c", "/a/b/d", "/a/e", "/f"):
+            yield self.client.create(path)
+
+    @inlineCallbacks
+    def test_list_tree(self):
+        levels = yield self.client.list_tree("/a")
+        self.assertEqual(
+            [sorted(level) for level in levels],
+            [["/a"], ["/a/b", "/a/e"], ["/a/b/c", "/a/b/d"]]
+            )
+
+    @inlineCallbacks
+    def test_recursive_delete(self):
+        yield self.client.recursive_delete("/a")
+        children = yield self.client.get_children("/")
+        self.assertEqual(children, ["f"])
+
+    @inlineCallbacks
+    def test_create_or_clear(self):
+        yield self.client.create_or_clear("/a")
+        children = yield self.client.get_children("/")
+        self.assertEqual(children, ["a", "f"])
+        children = yield self.client.get_children("/a")
+        self.assertEqual(children, [])
+
+
+class CreatePathTest(ZookeeperTestCase):
+    @inlineCallbacks
+    def test_create_path(self):
+        yield self.client.create_path("/a/b/c")
+        children = yield self.client.get_children("/a")
+        self.assertEqual(children, ["b"])
+
+        # The path is now known to exist.
+        requests = self.client.requests
+        yield self.client.create_path("/a/b/c")
+        self.assertEqual(self.client.requests, requests)
+
+    @inlineCallbacks
+    def test_deletion_invalidates_path(self):
+        yield self.client.create_path("/a/b/c")
+        yield self.client.recursive_delete("/a")
+        yield self.sleep(0.01)
+        yield self.client.create_path("/a/b/c")
+        children = yield self.client.get_children("/a")
+        self.assertEqual(children, ["b"])
+
+
+class CacheTest(ZookeeperTestCase):
+    cache_size = 2
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(CacheTest, self).setUp()
+        yield self.client.create("/a", "x")
+        yield self.client.create("/b", "y")
+
+    @inlineCallbacks
+    def test_cached_read(self):
+        value, metadata = yield self.client.get_cached("/a")
+        value, metadata = yield self.client.get_cached("/a")
+        self.assertEqual(value, "x")
+        self.assertEqual(self.client.cache.hits, 1)
+        self.assertEqual(self.client.cache.misses, 1)
+
+    @inlineCallbacks
+    def test_watch_invalidates_entry(self):
+        children = yield self.client.get_children_cached("/")
+        yield self.client.get_cached("/a")
+        yield self.client.set("/a", "z")
+        yield self.client.create("/c")
+        yield self.sleep(0.01)
+
+        value, metadata = yield self.client.get_cached("/a")
+        self.assertEqual(value, "z")
+        children = yield self.client.get_children_cached("/")
+        self.assertEqual(children, ["a", "b", "c"])
+        self.assertEqual(self.client.cache.hits, 0)
+
+    @inlineCallbacks
+    def test_eviction(self):
+        yield self.client.get_cached("/a")
+        yield self.client.get_cached("/b")
+        yield self.client.get_cached("/a")
+        yield self.client.get_children_cached("/")
+        self.assertEqual(len(self.client.cache), 2)
+
+        # The least recently used entry was evicted.
+        yield self.client.get_cached("/b")
+        self.assertEqual(self.client.cache.misses, 4)
+
+
+class SessionTest(ZookeeperTestCase):
+    @inlineCallbacks
+    def test_expiry_fails_watches(self):
+        from zookeeper import SessionExpiredException
+        yield self.client.create("/a")
+        d, watch = self.client.get_and_watch("/a")
+        yield d
+
+        self.client.expire()
+        yield self.assertFailure(watch, SessionExpiredException)
@@ -1,7 +1,6 @@
 import os
 import sys
 import json
-import time
 import signal
 
 from logging import DEBUG
@@ -20,36 +19,35 @@ from .common import TestCase
 
 
 class ControlTestCase(TestCase):
-    path = "/"
+    """Runs commands against an in-memory ZooKeeper server."""
+
+    path = "/pop/"
     host = 'localhost'
     port = 2181
-    timeout = 2.0
+    timeout = 5.0
 
     def setUp(self):
-        # To avoid overriding existing data in ZooKeeper, we prefix
-        # the hierarchy with a random path.
-        self.path = "/pop-%d/" % (int(time.time() * 1000))
+        import functools
+        from pop.control import CommandConfiguration
+        from pop.testing import FakeZookeeperClient
+        from pop.testing import FakeZookeeperServer
+
+        self.server = FakeZookeeperServer()
+        self.patch(
+            CommandConfiguration, "client_factory", functools.partial(
+                FakeZookeeperClient, server=self.server, latency=0.001
+                ))
 
         # Always capture log
         self.log = self.capture_logging(level=DEBUG)
 
         return super(ControlTestCase, self).setUp()
 
-    @inlineCallbacks
-    def tearDown(self):
-        client = self.get_client()
-
-        yield client.connect()
-        yield client.recursive_delete(self.path[:-1])
-        yield client.close()
-
-        super(ControlTestCase, self).tearDown()
-
     def get_client(self):
-        from pop.client import ZookeeperClient
-        return ZookeeperClient(
+        from pop.testing import FakeZookeeperClient
+        return FakeZookeeperClient(
             "%s:%d" % (self.host, self.port),
-            session_timeout=100
+            server=self.server, latency=0.001
             )
 
     @inlineCallbacks
@@ -69,7 +67,8 @@ class ControlTestCase(TestCase):
     def parse(self, *args):
         args = ('--path', self.path,
                 '--host', self.host,
-                '--port', str(self.port)) + \
+                '--port', str(self.port),
+                '--daemon-socket', self.mktemp()) + \
                 args
 
         from pop.control import parse
@@ -95,6 +94,98 @@ class InitializationTest(ControlTestCase):
         yield self.cmd("--force", "init")
 
 
+class ParserTest(ControlTestCase):
+    def test_fg_options(self):
+        args = self.parse(
+            "fg", "--zygote", "--parallelism", "4", "--metrics-port", "9100"
+            )
+        self.assertEqual(
+            (args.zygote, args.parallelism, args.metrics_port),
+            (True, 4, 9100)
+            )
+        self.assertFalse(hasattr(args, "name"))
+
+    def test_add_help(self):
+        from pop.control import ExtraArgumentParser
+
+        class Registry(dict):
+            def describe(self, name):
+                return self[name]
+
+        parser = ExtraArgumentParser(
+            services=Registry(echo="Echo service.", hidden=None)
+            )
+
+        # A service without a description is not listed.
+        help = parser.format_help()
+        self.assertIn("echo", help)
+        self.assertIn("Echo service.", help)
+        self.assertNotIn("hidden", help)
+
+    def test_invalid_machine_id(self):
+        from StringIO import StringIO
+        stderr = StringIO()
+        self.patch(sys, "stderr", stderr)
+        self.assertRaises(
+            SystemExit, self.parse, "--machine-id", "m1", "list"
+            )
+        self.assertIn(
+            "argument --machine-id: invalid machine id: 'm1'",
+            stderr.getvalue()
+            )
+
+    def test_invalid_machine_id_in_environment(self):
+        from pop import utils
+        from pop.exceptions import InvalidMachineId
+        self.patch(utils, "_machine_uuid", None)
+        self.patch(os, "environ", dict(os.environ, POP_MACHINE_ID="m1"))
+        exc = self.assertRaises(InvalidMachineId, utils.local_machine_uuid)
+        self.assertEqual((exc.value, exc.source), ("m1", "POP_MACHINE_ID"))
+
+    def test_client_is_imported_lazily(self):
+        import subprocess
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, pop.control; print(sorted(name for name in ("
+            "'pop.client', 'pop.command', 'twisted.internet.reactor', "
+            "'txzookeeper') if name in sys.modules))"
+            ], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.assertEqual(output.strip(), b"[]")
+
+
+class ForegroundTest(ControlTestCase):
+    @inlineCallbacks
+    def test_metrics_port_is_closed_in_service_process(self):
+        from twisted.internet.defer import fail, succeed
+        from pop import metrics
+        from pop.command import Command
+        from pop.exceptions import ServiceException
+        from pop.machine import MachineAgent
+
+        ports = []
+        listening = []
+
+        def listen(port, listen=metrics.listen):
+            ports.append(listen(port))
+            return ports[-1]
+
+        def start_service(command, name, wait=False, instance=0):
+            listening.append(ports[0].connected)
+            return succeed(None)
+
+        # The agent forks a service process.
+        self.patch(metrics, "listen", listen)
+        self.patch(
+            MachineAgent, "start",
+            lambda agent: fail(ServiceException("echo"))
+            )
+        self.patch(Command, "cmd_start", start_service)
+
+        yield self.cmd("init")
+        yield self.cmd("fg --metrics-port 0")
+        self.assertEqual(listening, [False])
+
+
 class DumpTest(ControlTestCase):
     @inlineCallbacks
     def test_bare_invocation(self):
@@ -103,7 +194,98 @@ class DumpTest(ControlTestCase):
         self.assertEquals(stream.getvalue(), '{}\n')
 
 
+class ApplyTest(ControlTestCase):
+    machines = (
+        "00000000-0000-0000-0000-000000000001",
+        "00000000-0000-0000-0000-000000000002",
+        )
+
+    manifest = """\
+services:
+  echo:
+    type: twisted-echo
+    settings:
+      port: %(port)d
+    machines: [%(machines)s]
+  threaded:
+    type: threaded-echo
+"""
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(ApplyTest, self).setUp()
+        yield self.cmd("init")
+        self.client = self.get_client()
+        yield self.client.connect()
+
+    @inlineCallbacks
+    def apply(self, port=8080, machines=machines):
+        filename = self.mktemp()
+        with open(filename, "w") as f:
+            f.write(self.manifest % {
+                "port": port, "machines": ", ".join(machines)
+                })
+
+        stream = self.capture_stream("stdout")
+        yield self.cmd("apply", filename)
+        returnValue(stream.getvalue().splitlines())
+
+    @inlineCallbacks
+    def test_apply(self):
+        output = yield self.apply()
+        self.assertEqual(output, [
+            "added        echo (twisted-echo)",
+            "deployed     echo (%s)" % ", ".join(self.machines),
+            "added        threaded (threaded-echo)",
+            ])
+
+        value, metadata = yield self.client.get(
+            self.path + "services/echo/machines"
+            )
+        self.assertEqual(json.loads(value), list(self.machines))
+
+        for machine in self.machines:
+            stat = yield self.client.exists(
+                self.path + "machines/" + machine + "/deployed/echo"
+                )
+            self.assertNotEqual(stat, None)
+
+    @inlineCallbacks
+    def test_apply_changes_only(self):
+        yield self.apply(machines=self.machines[:1])
+        output = yield self.apply(port=8081)
+        self.assertEqual(output, [
+            "configured   echo (port)",
+            "deployed     echo (%s)" % self.machines[1],
+            ])
+
+        value, metadata = yield self.client.get(
+            self.path + "services/echo/settings"
+            )
+        self.assertEqual(json.loads(value)["port"], 8081)
+
+        output = yield self.apply(port=8081)
+        self.assertEqual(output, [])
+
+    @inlineCallbacks
+    def test_apply_invalid_name(self):
+        from pop.manifest import ManifestError
+        self.manifest = "services:\n  echo.1:\n    type: twisted-echo\n"
+        yield self.assertFailure(self.apply(), ManifestError)
+
+    @inlineCallbacks
+    def test_apply_type_mismatch(self):
+        yield self.cmd("add --name threaded twisted-echo")
+        yield self.assertFailure(self.apply(), StateException)
+
+
 class ServiceTest(ControlTestCase):
+    """Starts services like the machine agent would.
+
+    The services run in the test process rather than in forked
+    processes, such that they share the in-memory server.
+    """
+
     @inlineCallbacks
     def setUp(self):
         yield super(ServiceTest, self).setUp()
@@ -116,22 +298,16 @@ class ServiceTest(ControlTestCase):
         yield agent.connect()
         yield agent.initialize()
 
-        self.pids = []
+        # Starting a service installs a handler for the stop signal.
+        handler = signal.getsignal(signal.SIGHUP)
+        self.addCleanup(signal.signal, signal.SIGHUP, handler)
+
+        # Maps service names to their client and stop function.
+        self.started = {}
+        self.addCleanup(self.stop_services)
 
     @inlineCallbacks
     def tearDown(self):
-        # First, close down agent connection.
-        yield self.agent.close()
-
-        # Then kill any child processes.
-        for pid in self.pids:
-            os.kill(pid, signal.SIGKILL)
-
-        # Just in case, cancel any deferred reconnectors.
-        for call in self.reactor.getDelayedCalls():
-            if call.func.__name__ == 'reconnector':
-                call.cancel()
-
         # If verbosity is above the threshold level, send the logged
         # text to the standard error stream.
         if getLogger("nose").level <= INFO:
@@ -146,11 +322,17 @@ class ServiceTest(ControlTestCase):
 
         yield super(ServiceTest, self).tearDown()
 
+    @inlineCallbacks
+    def test_add_invalid_name(self):
+        yield self.assertFailure(
+            self.cmd("add --name echo.1 twisted-echo"), ValueError
+            )
+
     @inlineCallbacks
     def test_threaded_echo_service(self):
         yield self.cmd("add --name echo threaded-echo --port 0")
         yield self.cmd("deploy", "echo")
-        yield self.run_services(0.5)
+        yield self.start_services()
         state = yield self.wait_for_service("echo")
         result = yield self.verify_echo_service(state['port'])
         self.assertEqual(result, 'Hello world! What a fine day it is. Bye!')
@@ -159,7 +341,7 @@ class ServiceTest(ControlTestCase):
     def test_twisted_echo_service(self):
         yield self.cmd("add --name echo twisted-echo --port 0")
         yield self.cmd("deploy", "echo")
-        yield self.run_services(0.5)
+        yield self.start_services()
         state = yield self.wait_for_service("echo")
         result = yield self.verify_echo_service(state['port'])
         self.assertEqual(result, 'Hello world! What a fine day it is. Bye!')
@@ -168,12 +350,50 @@ class ServiceTest(ControlTestCase):
     def test_twisted_echo_service_stop_and_start(self):
         yield self.cmd("add --name echo twisted-echo --port 0")
         yield self.cmd("deploy", "echo")
-        yield self.run_services(0.5)
+        yield self.start_services()
         state = yield self.wait_for_service("echo")
-        yield self.cmd("stop", "echo")
+        yield self.stop_service("echo")
         result = yield self.verify_echo_service(state['port'])
         self.assertNotEqual(result, 'Hello world! What a fine day it is. Bye!')
 
+        # The agent finds the service stopped.
+        yield self.agent.scan()
+        self.assertEqual(self.agent.stopped, set(["echo"]))
+
+    @inlineCallbacks
+    def test_session_expiry(self):
+        yield self.cmd("add --name echo twisted-echo --port 0")
+        yield self.cmd("deploy", "echo")
+        yield self.start_services()
+        yield self.wait_for_service("echo")
+
+        # The ephemeral nodes of the service go away with its session.
+        client, stop = self.started["echo"]
+        client.expire()
+        yield self.agent.scan()
+        self.assertEqual(self.agent.stopped, set(["echo"]))
+
+        from zookeeper import SessionExpiredException
+        yield self.assertFailure(
+            client.get(self.path + "services"), SessionExpiredException
+            )
+
+        # The service process would now stop.
+        yield self.stop_service("echo")
+
+    @inlineCallbacks
+    def test_connection_loss(self):
+        from zookeeper import ConnectionLossException
+        yield self.cmd("add --name echo twisted-echo --port 0")
+        self.capture_stream("stdout")
+        self.server.fail("get", path=self.path + "services/echo/machines")
+        yield self.assertFailure(
+            self.cmd("status", "echo"), ConnectionLossException
+            )
+
+        # The failure was injected once.
+        yield self.cmd("status", "echo")
+
     def get_machine_agent(self):
         assert self.path != "/"
         from pop.utils import local_machine_uuid
@@ -191,47 +411,40 @@ class ServiceTest(ControlTestCase):
 
         def deferred(received=received):
             connector.disconnect()
+            factory.stopTrying()
             returnValue(" ".join(received))
 
-        yield deferLater(self.reactor, 1.0, deferred)
+        yield deferLater(self.reactor, 0.5, deferred)
 
     @inlineCallbacks
-    def run_services(self, time):
-        """Run configured services on local machine agent.
-
-        Services are stopped after the provided time has elapsed.
-        """
-
-        from pop.exceptions import ServiceException
-
-        try:
-            pids = yield self.start_services()
-            self.pids.extend(pids)
+    def start_services(self):
+        """Scan and start the services not already running."""
 
-        except ServiceException as exc:
-            client = yield self.cmd("start", str(exc))
+        yield self.agent.scan()
 
-            @inlineCallbacks
-            def stop():
-                yield client.close()
-                self.reactor.stop()
-                os._exit(0)
+        for name in sorted(self.agent.stopped):
+            client = yield self.cmd("start", name)
 
-            yield deferLater(self.reactor, time, stop)
+            # The command installs a handler for the stop signal that
+            # stops the service.
+            self.started[name] = client, signal.getsignal(signal.SIGHUP)
 
     @inlineCallbacks
-    def start_services(self, attempts=0, maximum=1, delay=0.1):
-        """Scan and start the services not already running."""
+    def stop_services(self):
+        for name in list(self.started):
+            yield self.stop_service(name)
 
-        yield self.agent.scan()
-        pids = self.agent.start_services()
+        yield self.agent.close()
 
-        if not pids and attempts < maximum:
-            pids = yield deferLater(
-                self.reactor, delay, self.start_services, attempts + 1
-                )
+    @inlineCallbacks
+    def stop_service(self, name):
+        """Stop service and close its connection, as its process
+        would when it exits."""
 
-        returnValue(pids)
+        client, stop = self.started.pop(name)
+        stop(signal.SIGHUP, None)
+        yield deferLater(self.reactor, 0.05, lambda: None)
+        yield client.close()
 
     @inlineCallbacks
     def wait_for_service(self, name):
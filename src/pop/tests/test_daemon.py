@@ -0,0 +1,65 @@
+from twisted.internet.defer import inlineCallbacks
+
+from .common import TestCase
+
+
+class DaemonTest(TestCase):
+    servers = "localhost:2181"
+
+    @inlineCallbacks
+    def setUp(self):
+        from pop.daemon import listen
+        from pop.testing import FakeZookeeperClient
+        from pop.services import ServiceRegistry
+
+        self.client = FakeZookeeperClient(self.servers)
+        yield self.client.connect()
+
+        self.socket = self.mktemp()
+        port = listen(
+            self.client, ServiceRegistry.from_entry_points(), self.socket
+            )
+        self.addCleanup(port.stopListening)
+
+    def proxy(self, command, servers=None, machine_id=None, **options):
+        from pop.daemon import proxy
+        return proxy(
+            command, servers or self.servers, "/", False, options,
+            self.socket, machine_id
+            )
+
+    @inlineCallbacks
+    def test_status(self):
+        stream = self.capture_stream("stdout")
+        yield self.proxy("init", admin_identity="admin:admin")
+        yield self.proxy("add", name="echo", factory_name="twisted-echo")
+        yield self.proxy("status", name="echo")
+        self.assertIn("type:     twisted-echo", stream.getvalue())
+
+    @inlineCallbacks
+    def test_machine_id(self):
+        import json
+        machine = "00000000-0000-0000-0000-000000000001"
+        self.capture_stream("stdout")
+        yield self.proxy("init", admin_identity="admin:admin")
+        yield self.proxy("add", name="echo", factory_name="twisted-echo")
+        yield self.proxy("deploy", machine_id=machine, name="echo",
+                         machine=None)
+        value, metadata = yield self.client.get("/services/echo/machines")
+        self.assertEqual(json.loads(value), [machine])
+
+    @inlineCallbacks
+    def test_error(self):
+        from pop.daemon import DaemonError
+        yield self.assertFailure(
+            self.proxy("status", name="echo"), DaemonError
+            )
+
+    @inlineCallbacks
+    def test_unavailable(self):
+        from pop.daemon import DaemonUnavailable
+        yield self.assertFailure(
+            self.proxy("status", servers="example.com:2181", name="echo"),
+            DaemonUnavailable
+            )
+        yield self.assertFailure(self.proxy("fg"), DaemonUnavailable)
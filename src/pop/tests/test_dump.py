@@ -0,0 +1,58 @@
+import yaml
+
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks
+
+from .common import ZookeeperTestCase
+
+
+class DumpTest(ZookeeperTestCase):
+    @inlineCallbacks
+    def test_empty(self):
+        from pop.dump import dump
+        stream = StringIO()
+        count = yield dump(self.client, "/", stream)
+        self.assertEqual(count, 0)
+        self.assertEqual(stream.getvalue(), "{}\n")
+
+    def test_null(self):
+        from pop.dump import TreeEmitter
+        stream = StringIO()
+        emitter = TreeEmitter(stream)
+        emitter.node("a", None, 0, False)
+        emitter.node("b", "null", 0, False)
+        emitter.close()
+        self.assertEqual(
+            yaml.safe_load(stream.getvalue()), {"a": None, "b": "null"}
+            )
+
+    @inlineCallbacks
+    def test_tree(self):
+        from pop.dump import dump
+
+        for path, data in (
+            ("/zookeeper", ""),
+            ("/machines", ""),
+            ("/services", ""),
+            ("/services/echo", "x"),
+            ("/services/echo/machines", '["m1"]'),
+            ("/services/echo/type", "twisted-echo"),
+            ("/services/echo/pid", "123"),
+            ):
+            yield self.client.create(path, data)
+
+        stream = StringIO()
+        count = yield dump(self.client, "/", stream, concurrency=2)
+        self.assertEqual(count, 6)
+        self.assertEqual(yaml.safe_load(stream.getvalue()), {
+            "machines": "",
+            "services": {
+                "echo": {
+                    ".": "x",
+                    "machines": '["m1"]',
+                    "pid": "123",
+                    "type": "twisted-echo",
+                    },
+                },
+            })
@@ -0,0 +1,479 @@
+import json
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import returnValue
+
+from .common import ZookeeperTestCase
+
+MACHINE = "00000000-0000-0000-0000-000000000000"
+
+
+class MachineTestCase(ZookeeperTestCase):
+    path = "/pop"
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(MachineTestCase, self).setUp()
+        yield self.client.create(self.path)
+        yield self.client.create(self.path + "/services")
+        yield self.client.create(self.path + "/machines")
+
+    @inlineCallbacks
+    def add_service(self, name, machines):
+        path = self.path + "/services/" + name
+        yield self.client.create(path)
+        yield self.client.create(path + "/machines", json.dumps(machines))
+
+    def get_machine_agent(self, **kwargs):
+        from pop.machine import MachineAgent
+        return MachineAgent(self.client, self.path, MACHINE, **kwargs)
+
+
+class ScanTest(MachineTestCase):
+    @inlineCallbacks
+    def test_scan_finds_deployed_services(self):
+        yield self.add_service("a", [MACHINE])
+        yield self.add_service("b", ["other"])
+        yield self.add_service("c", [])
+        yield self.add_service("d", ["other", MACHINE])
+
+        agent = self.get_machine_agent(concurrency=2)
+        yield agent.initialize()
+        yield agent.scan()
+        self.assertEqual(agent.stopped, set(["a", "d"]))
+
+    @inlineCallbacks
+    def test_scan_missing_machines_declaration(self):
+        yield self.client.create(self.path + "/services/a")
+
+        agent = self.get_machine_agent()
+        yield agent.initialize()
+        yield agent.scan()
+        self.assertEqual(agent.stopped, set())
+
+    @inlineCallbacks
+    def test_scan_reads_deployment_index(self):
+        agent = self.get_machine_agent()
+        yield agent.initialize()
+
+        from pop.services.common import Service
+        service = Service(self.client, self.path + "/services/a")
+        yield self.add_service("a", [])
+        yield service.deploy(MACHINE)
+        yield self.add_service("b", [MACHINE])
+
+        # The second service was declared without updating the index.
+        yield agent.scan()
+        self.assertEqual(agent.stopped, set(["a"]))
+
+        value, metadata = yield self.client.get(
+            self.path + "/services/a/machines")
+        self.assertEqual(json.loads(value), [MACHINE])
+
+
+class ReconcileTest(MachineTestCase):
+    @inlineCallbacks
+    def test_reconcile_starts_changed_services(self):
+        started = []
+        agent = self.get_machine_agent()
+        agent.start_timeout = 0.005
+        agent.start_services = \
+            lambda names=None, instances=None: started.append(names) or []
+
+        yield agent.initialize()
+        yield agent.scan()
+        d = agent.reconcile()
+
+        from pop.services.common import Service
+        service = Service(self.client, self.path + "/services/a")
+        yield self.add_service("a", [])
+        yield service.deploy(MACHINE)
+        yield self.sleep(0.01)
+        self.assertEqual(started, [["a"]])
+
+        # The service comes up, then exits.
+        running = self.path + "/machines/" + MACHINE + "/a"
+        yield self.client.create(running)
+        yield self.sleep(0.01)
+        self.assertEqual(agent.pending, set())
+        yield self.client.delete(running)
+        yield self.sleep(0.01)
+        self.assertEqual(started, [["a"], ["a"]])
+
+        agent.stop()
+        yield d
+
+    @inlineCallbacks
+    def test_reconcile_starts_missing_instances(self):
+        from twisted.internet.defer import succeed
+        forked = []
+
+        class Zygote(object):
+            def fork(self, name, instance=0):
+                forked.append((name, instance))
+                return succeed(1000 + len(forked))
+
+        agent = self.get_machine_agent(zygote=Zygote())
+        agent.start_timeout = 0.005
+
+        yield self.add_service("a", [MACHINE])
+        yield self.client.create(
+            self.path + "/services/a/settings", '{"workers": 3}'
+            )
+        yield agent.initialize()
+
+        # The agent restarted while two instances kept running.
+        path = self.path + "/machines/" + MACHINE
+        yield self.client.create(path + "/a")
+        yield self.client.create(path + "/a.1")
+
+        d = agent.start()
+        yield self.sleep(0.02)
+        self.assertEqual(forked, [("a", 2)])
+        self.assertEqual(agent.stopped, set(["a"]))
+
+        yield self.client.create(path + "/a.2")
+        yield self.sleep(0.01)
+        self.assertEqual(agent.stopped, set())
+        self.assertEqual(agent.pending, set())
+
+        agent.stop()
+        yield d
+
+
+    @inlineCallbacks
+    def test_failed_start_is_logged(self):
+        from zookeeper import ConnectionLossException
+        log = self.capture_logging()
+        agent = self.get_machine_agent()
+        agent.deployed = set(["a"])
+
+        self.client.server.fail(
+            "get", ConnectionLossException,
+            self.path + "/services/a/settings",
+            )
+
+        agent._reconcile(["a"])
+        yield self.sleep(0.01)
+        self.assertIn("unable to start services: a", log.getvalue())
+        self.assertEqual(agent.stopped, set(["a"]))
+        self.assertEqual(agent.pending, set())
+
+
+class StagedStartTest(MachineTestCase):
+    def test_waves(self):
+        from pop.machine import waves
+        self.assertEqual(waves({
+            "a": (["b", "c"], 1),
+            "b": (["c", "x"], 1),
+            "c": ([], 1),
+            "d": ([], 5),
+            }), [["d", "c"], ["b"], ["a"]])
+
+    @inlineCallbacks
+    def test_requirements_are_started_first(self):
+        started = []
+        agent = self.get_machine_agent(parallelism=1)
+        agent.start_services = \
+            lambda names=None, instances=None: started.extend(names) or []
+
+        yield self.add_service("a", [MACHINE])
+        yield self.add_service("b", [MACHINE])
+        yield self.client.create(
+            self.path + "/services/a/settings", '{"requires": ["b"]}'
+            )
+
+        d = agent.start_staged(["a", "b"])
+        yield self.sleep(0.01)
+        self.assertEqual(started, ["b"])
+
+        # The requirement comes up.
+        yield self.client.create(self.path + "/services/b/state")
+        yield self.client.create(
+            self.path + "/services/b/state/" + MACHINE, "{}"
+            )
+        yield self.sleep(0.01)
+        self.assertEqual(started, ["b", "a"])
+
+        yield self.client.create(self.path + "/services/a/state")
+        yield self.client.create(
+            self.path + "/services/a/state/" + MACHINE, "{}"
+            )
+        yield d
+
+    @inlineCallbacks
+    def test_requires_string(self):
+        agent = self.get_machine_agent()
+        yield self.add_service("a", [MACHINE])
+        yield self.client.create(
+            self.path + "/services/a/settings", '{"requires": "b, c"}'
+            )
+
+        requirements = yield agent.get_requirements(["a"])
+        self.assertEqual(requirements, {"a": (["b", "c"], 1)})
+
+    @inlineCallbacks
+    def test_parallelism_across_calls(self):
+        from twisted.internet.defer import Deferred
+        starting = []
+        agent = self.get_machine_agent(parallelism=1)
+
+        def start_service(name, instances=None):
+            starting.append(name)
+            return Deferred()
+
+        agent._start_service = start_service
+        yield self.add_service("a", [MACHINE])
+        yield self.add_service("b", [MACHINE])
+
+        agent.start_staged(["a"])
+        agent.start_staged(["b"])
+        yield self.sleep(0.01)
+        self.assertEqual(starting, ["a"])
+
+
+class ZygoteTest(MachineTestCase):
+    def test_start_services_using_zygote(self):
+        from twisted.internet.defer import succeed
+
+        class Zygote(object):
+            def fork(self, name, instance=0):
+                return succeed(len(name))
+
+        agent = self.get_machine_agent(zygote=Zygote())
+        pids = agent.start_services(["a", "bb"])
+        self.assertEqual(pids, [])
+        self.assertEqual(sorted(agent.pids), [1, 2])
+
+    def test_fork_failure_is_logged(self):
+        from twisted.internet.defer import fail
+        from pop.zygote import ZygoteError
+        log = self.capture_logging()
+
+        class Zygote(object):
+            def fork(self, name, instance=0):
+                return fail(ZygoteError("zygote stopped."))
+
+        agent = self.get_machine_agent(zygote=Zygote())
+        agent.start_services(["a"])
+        self.assertEqual(agent.pids, [])
+        self.assertIn("unable to start service: a", log.getvalue())
+
+    @inlineCallbacks
+    def test_workers(self):
+        from twisted.internet.defer import succeed
+        forked = []
+
+        class Zygote(object):
+            def fork(self, name, instance=0):
+                forked.append((name, instance))
+                return succeed(1000 + len(forked))
+
+        agent = self.get_machine_agent(zygote=Zygote())
+        agent.start_timeout = 0.005
+        yield self.add_service("a", [MACHINE])
+        yield self.client.create(
+            self.path + "/services/a/settings", '{"workers": 2}'
+            )
+
+        yield agent.start_staged(["a"])
+        self.assertEqual(forked, [("a", 0), ("a", 1)])
+        self.assertEqual(
+            sorted(agent.supervisor.processes.values()), forked
+            )
+
+    def test_missing_instances(self):
+        from twisted.internet.defer import succeed
+        forked = []
+
+        class Zygote(object):
+            def fork(self, name, instance=0):
+                forked.append((name, instance))
+                return succeed(1000 + len(forked))
+
+        # The agent restarted while the second instance kept running.
+        agent = self.get_machine_agent(zygote=Zygote())
+        agent.instances["a"] = 3
+        agent.running = set(["a.1"])
+        agent.start_services(["a"])
+        self.assertEqual(forked, [("a", 0), ("a", 2)])
+
+
+class WorkerTest(MachineTestCase):
+    """Forks a worker like the zygote does."""
+
+    def fork_worker(self, name):
+        import os
+        import signal
+        from twisted.internet.defer import Deferred
+        from pop.exceptions import ProcessForked
+        from pop.process import fork
+        from pop.services import ServiceRegistry
+        from pop.testing import FakeZookeeperClient
+        from pop.zygote import serve
+
+        server = self.client.server
+
+        class Client(FakeZookeeperClient):
+            """Connects using the reactor that ``txzookeeper.client``
+            imported, like the real client does."""
+
+            def __init__(self, servers, session_timeout=None):
+                super(Client, self).__init__(
+                    servers, session_timeout, server=server
+                    )
+
+            def connect(self, servers=None, timeout=10, client_id=None):
+                import txzookeeper.client
+                connect = super(Client, self).connect
+                d = Deferred()
+                txzookeeper.client.reactor.callFromThread(
+                    lambda: connect().chainDeferred(d)
+                    )
+                return d
+
+        try:
+            pid = fork()
+        except ProcessForked:
+            serve(
+                ServiceRegistry.from_entry_points(), "localhost:2181",
+                self.path + "/", name, client_factory=Client
+                )
+
+        def kill():
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        self.addCleanup(kill)
+        return pid
+
+    @inlineCallbacks
+    def wait(self, pid):
+        """Wait for the worker to exit and return its status."""
+
+        import os
+        for i in range(100):
+            result, status = os.waitpid(pid, os.WNOHANG)
+            if result:
+                returnValue(status)
+            yield self.sleep(0.05)
+
+        self.fail("worker did not exit.")
+
+    @inlineCallbacks
+    def test_worker_starts_service(self):
+        import os
+        import signal
+        import socket
+        from pop.services.examples import TwistedEchoService
+        from pop.utils import local_machine_uuid
+
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        service = TwistedEchoService(self.client, self.path + "/services/a")
+        yield service.add({"host": "127.0.0.1", "port": port})
+        yield self.client.create(
+            self.path + "/machines/" + str(local_machine_uuid())
+            )
+
+        pid = self.fork_worker("a")
+
+        # The worker connects and starts the service.
+        for i in range(100):
+            try:
+                connection = socket.create_connection(("127.0.0.1", port))
+            except socket.error:
+                yield self.sleep(0.05)
+            else:
+                break
+        else:
+            self.fail("service did not start.")
+
+        connection.sendall(b"hello")
+        self.assertEqual(connection.recv(5), b"hello")
+        connection.close()
+
+        # The service is stopped on request.
+        os.kill(pid, signal.SIGHUP)
+        status = yield self.wait(pid)
+        self.assertEqual(status, 0)
+
+    @inlineCallbacks
+    def test_failed_start(self):
+        import os
+        pid = self.fork_worker("missing")
+        status = yield self.wait(pid)
+        self.assertEqual(os.WEXITSTATUS(status), 1)
+
+
+class SupervisorTest(MachineTestCase):
+    def get_supervisor(self, restarted):
+        from pop.supervisor import Supervisor
+        supervisor = Supervisor(
+            self.client, self.path, MACHINE,
+            lambda name, instance: restarted.append((name, instance))
+            )
+        supervisor.backoff = 0.001
+        self.addCleanup(supervisor.stop)
+        return supervisor
+
+    @inlineCallbacks
+    def test_restart(self):
+        restarted = []
+        supervisor = self.get_supervisor(restarted)
+        supervisor.watch(1000, "a", reap=False)
+        self.assertTrue(supervisor.supervised("a"))
+
+        supervisor.exited(1000, 256)
+        self.assertTrue(supervisor.supervised("a"))
+        yield self.sleep(0.02)
+        self.assertEqual(restarted, [("a", 0)])
+        self.assertFalse(supervisor.supervised("a"))
+
+        value, metadata = yield self.client.get(
+            self.path + "/services/a/restarts/" + MACHINE
+            )
+        data = json.loads(value)
+        self.assertEqual(data["restarts"], 1)
+        self.assertEqual(data["status"], 256)
+        self.assertFalse(data["crashloop"])
+
+    @inlineCallbacks
+    def test_clean_exit(self):
+        restarted = []
+        supervisor = self.get_supervisor(restarted)
+        supervisor.watch(1000, "a", reap=False)
+        supervisor.exited(1000, 0)
+        yield self.sleep(0.02)
+        self.assertEqual(restarted, [])
+        self.assertFalse(supervisor.supervised("a"))
+        self.assertEqual(supervisor.failures, {})
+
+    @inlineCallbacks
+    def test_crash_loop(self):
+        restarted = []
+        supervisor = self.get_supervisor(restarted)
+        supervisor.max_failures = 2
+
+        for pid in (1000, 1001):
+            supervisor.watch(pid, "a", reap=False)
+            supervisor.exited(pid, 256)
+            yield self.sleep(0.02)
+
+        self.assertEqual(restarted, [("a", 0)])
+        self.assertTrue(supervisor.supervised("a"))
+
+        value, metadata = yield self.client.get(
+            self.path + "/services/a/restarts/" + MACHINE
+            )
+        self.assertTrue(json.loads(value)["crashloop"])
+
+        # Deploying the service again clears the crash loop.
+        supervisor.forget("a")
+        self.assertFalse(supervisor.supervised("a"))
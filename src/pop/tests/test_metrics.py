@@ -0,0 +1,62 @@
+from twisted.internet.defer import inlineCallbacks
+
+from .common import ZookeeperTestCase
+
+
+class MetricsTest(ZookeeperTestCase):
+    def test_histogram(self):
+        from pop.metrics import Histogram
+        histogram = Histogram(
+            "latency_seconds", "Latency.", ("operation", ), (0.1, 1.0)
+            )
+        histogram.observe(0.05, "get")
+        histogram.observe(0.5, "get")
+        histogram.observe(5.0, "get")
+        self.assertEqual(histogram.render(), [
+            "# HELP latency_seconds Latency.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{operation="get",le="0.1"} 1',
+            'latency_seconds_bucket{operation="get",le="1.0"} 2',
+            'latency_seconds_bucket{operation="get",le="+Inf"} 3',
+            'latency_seconds_sum{operation="get"} 5.55',
+            'latency_seconds_count{operation="get"} 3',
+            ])
+
+    @inlineCallbacks
+    def test_client_requests(self):
+        from pop.client import conflicts, request_errors, request_seconds
+        from zookeeper import BadVersionException
+
+        client = self.client
+        count = request_seconds.count("set")
+        errors = request_errors.get("set", "BadVersionException")
+        conflicted = conflicts.get("set")
+
+        yield client.create("/a", "x")
+        yield client.set("/a", "y", 0)
+        yield self.assertFailure(
+            client.set("/a", "z", 0), BadVersionException
+            )
+
+        self.assertEqual(request_seconds.count("set") - count, 2)
+        self.assertEqual(
+            request_errors.get("set", "BadVersionException") - errors, 1
+            )
+        self.assertEqual(conflicts.get("set") - conflicted, 1)
+
+    @inlineCallbacks
+    def test_endpoint(self):
+        from twisted.web.client import Agent, readBody
+        from pop.metrics import Counter, Registry, listen
+
+        registry = Registry()
+        registry.register(Counter("started_total", "Started.")).inc()
+        port = listen(0, registry=registry)
+        self.addCleanup(port.stopListening)
+
+        agent = Agent(self.reactor)
+        response = yield agent.request(
+            b"GET", ("http://127.0.0.1:%d/" % port.getHost().port).encode()
+            )
+        body = yield readBody(response)
+        self.assertIn(b"started_total 1\n", body)
@@ -0,0 +1,27 @@
+import os
+import fcntl
+
+from pop import process
+
+from .common import TestCase
+
+
+class FailingLibrary(object):
+    """System calls fail, e.g. ``close_range`` with ``EINVAL`` on Linux
+    5.9 and 5.10, where ``CLOSE_RANGE_CLOEXEC`` is not supported."""
+
+    def syscall(self, *args):
+        return -1
+
+
+class CloseOnExecTest(TestCase):
+    def test_fallback(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+
+        self.patch(process, "_libc", FailingLibrary())
+        process.set_cloexec(min(r, w))
+
+        for fd in (r, w):
+            self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
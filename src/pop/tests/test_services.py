@@ -0,0 +1,229 @@
+import json
+
+from twisted.internet.defer import inlineCallbacks
+
+from .common import ZookeeperTestCase
+
+
+class DeferredDictTest(ZookeeperTestCase):
+    def make(self, delay=0):
+        from pop.services.utils import DeferredDict
+        return DeferredDict(
+            self.client, "/settings", {}, json.loads, json.dumps, delay
+            )
+
+    @inlineCallbacks
+    def test_changes_are_coalesced(self):
+        settings = self.make()
+        settings["host"] = "localhost"
+        settings["port"] = 8080
+        settings.update(debug=True, workers=2)
+
+        requests = self.client.requests
+        yield settings()
+        self.assertEqual(self.client.requests - requests, 1)
+
+        value, metadata = yield self.client.get("/settings")
+        self.assertEqual(json.loads(value), {
+            "host": "localhost", "port": 8080, "debug": True, "workers": 2,
+            })
+
+    @inlineCallbacks
+    def test_changes_are_written_without_call(self):
+        settings = self.make(delay=0.005)
+        settings["port"] = 8080
+        yield self.sleep(0.002)
+        settings["port"] = 8081
+        yield self.sleep(0.02)
+
+        value, metadata = yield self.client.get("/settings")
+        self.assertEqual(json.loads(value), {"port": 8081})
+        self.assertEqual(metadata["version"], 0)
+
+    @inlineCallbacks
+    def test_immediate(self):
+        yield self.client.create("/settings", "{}")
+
+        settings = self.make(delay=None)
+        yield settings.load(watch=False)
+
+        requests = self.client.requests
+        settings["port"] = 8080
+        settings["port"] = 8081
+
+        yield settings()
+        self.assertEqual(self.client.requests - requests, 2)
+
+        value, metadata = yield self.client.get("/settings")
+        self.assertEqual(json.loads(value), {"port": 8081})
+
+    @inlineCallbacks
+    def test_concurrent_changes_are_merged(self):
+        from pop.utils import AddedItem, ModifiedItem
+        yield self.client.create("/settings", '{"port": 8080}')
+
+        first, second = self.make(), self.make()
+        yield first.load(watch=False)
+        yield second.load(watch=False)
+
+        first["port"] = 8081
+        second["host"] = "localhost"
+        results = yield first()
+        self.assertEqual(results, [
+            (True, [ModifiedItem("port", 8080, 8081)])
+            ])
+
+        results = yield second()
+        self.assertEqual(results, [(True, [AddedItem("host", "localhost")])])
+        self.assertEqual(second["port"], 8081)
+
+        value, metadata = yield self.client.get("/settings")
+        self.assertEqual(json.loads(value), {
+            "host": "localhost", "port": 8081,
+            })
+        self.assertEqual(metadata["version"], 2)
+
+    @inlineCallbacks
+    def test_missing_parent(self):
+        from zookeeper import NoNodeException
+        from pop.services.utils import DeferredDict
+        settings = DeferredDict(
+            self.client, "/missing/settings", {}, json.loads, json.dumps
+            )
+        dict.__setitem__(settings, "port", 8080)
+        yield self.assertFailure(settings.save(), NoNodeException)
+
+    @inlineCallbacks
+    def test_failed_write(self):
+        from zookeeper import NoNodeException
+        from pop.services.utils import DeferredDict
+        settings = DeferredDict(
+            self.client, "/missing/settings", {}, json.loads, json.dumps
+            )
+        settings["port"] = 8080
+        yield self.assertFailure(settings(), NoNodeException)
+
+    @inlineCallbacks
+    def test_unchanged_is_not_written(self):
+        yield self.client.create("/settings", '{"port": 8080}')
+
+        settings = self.make()
+        yield settings.load(watch=False)
+        settings["port"] = 8080
+
+        requests = self.client.requests
+        yield settings()
+        self.assertEqual(self.client.requests, requests)
+
+
+class DeployTest(ZookeeperTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        from pop.services.common import Service
+        yield super(DeployTest, self).setUp()
+
+        self.services = []
+        for name in ("a", "b"):
+            service = Service(self.client, "/pop/services/" + name)
+            yield self.client.create_path(service.path)
+            yield self.client.create(service.path)
+            yield self.client.create(service.path + "/machines", "[]")
+            self.services.append(service)
+
+    @inlineCallbacks
+    def test_concurrent_deploy_to_new_machine(self):
+        from twisted.internet.defer import gatherResults
+        yield gatherResults([
+            service.deploy("m1") for service in self.services
+            ])
+
+        children = yield self.client.get_children(
+            "/pop/machines/m1/deployed"
+            )
+        self.assertEqual(sorted(children), ["a", "b"])
+
+    @inlineCallbacks
+    def test_index_parent_deleted(self):
+        create_path = self.client.create_path
+        deleted = []
+
+        # The parent is deleted after it has been created.
+        @inlineCallbacks
+        def racing_create_path(path, **kwargs):
+            yield create_path(path, **kwargs)
+            if not deleted:
+                deleted.append(path)
+                yield self.client.recursive_delete("/pop/machines/m1")
+
+        self.patch(self.client, "create_path", racing_create_path)
+        yield self.services[1].deploy("m1")
+        self.assertEqual(deleted, ["/pop/machines/m1/deployed/b"])
+
+        children = yield self.client.get_children(
+            "/pop/machines/m1/deployed"
+            )
+        self.assertEqual(children, ["b"])
+
+
+class PythonNetworkServiceTest(ZookeeperTestCase):
+    def test_listen_workers_string(self):
+        import socket
+        from pop.services.common import PythonNetworkService
+        service = PythonNetworkService(self.client, "/echo")
+        s = service.listen("127.0.0.1", 0, "1")
+        self.addCleanup(s.close)
+
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.assertFalse(
+                s.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT)
+                )
+
+
+class ThreadedEchoServiceTest(ZookeeperTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        from pop.services.examples import ThreadedEchoService
+        yield super(ThreadedEchoServiceTest, self).setUp()
+
+        self.service = ThreadedEchoService(self.client, "/echo")
+        yield self.service.add({"host": "127.0.0.1", "port": 0})
+
+    @inlineCallbacks
+    def test_concurrent_connections(self):
+        import socket
+        state = yield self.service.start()
+        address = (state["host"], state["port"])
+
+        # The first connection stays open while the second is served.
+        first = socket.create_connection(address, 1)
+        second = socket.create_connection(address, 1)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+
+        data = b"x" * 10000
+        for s in (second, first):
+            s.sendall(data)
+            received = b""
+            while len(received) < len(data):
+                received += s.recv(4096)
+            self.assertEqual(received, data)
+
+        yield self.service.stop()
+        self.assertEqual(first.recv(1), b"")
+        self.assertFalse([t for t in self.service._threads if t.is_alive()])
+
+    @inlineCallbacks
+    def test_stop(self):
+        import socket
+        state = yield self.service.start()
+        address = (state["host"], state["port"])
+
+        # The acceptor is woken up without relying on a shutdown of
+        # the listening socket (which only works on Linux).
+        self.patch(socket.socket, "shutdown", lambda *args: None)
+        d = self.service.stop()
+        d.addTimeout(5, self.reactor)
+        yield d
+
+        self.assertFalse([t for t in self.service._threads if t.is_alive()])
+        self.assertRaises(socket.error, socket.create_connection, address, 1)
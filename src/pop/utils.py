@@ -1,3 +1,4 @@
+import os
 import yaml
 import uuid
 import subprocess
@@ -7,58 +8,201 @@ from UserDict import DictMixin
 from cStringIO import StringIO
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import DeferredList, DeferredSemaphore
+from twisted.internet.defer import maybeDeferred
 from txzookeeper.utils import retry_change
 from zookeeper import NoNodeException
 
+from .exceptions import InvalidMachineId
 from .exceptions import StateNotFound
+from .serialization import NodeFormat
 
 
-def autocast(string, types):
-    for cast in types:
+def gather(func, items, concurrency=None):
+    """Call ``func`` for each item with a bounded number in flight.
+
+    Returns a deferred list of ``(success, result)`` tuples in the
+    order of ``items``. If ``concurrency`` is given, at most that
+    many calls are outstanding at any time; otherwise, all calls are
+    issued immediately.
+    """
+
+    if concurrency:
+        semaphore = DeferredSemaphore(concurrency)
+        call = lambda item: semaphore.run(func, item)
+    else:
+        call = lambda item: maybeDeferred(func, item)
+
+    return DeferredList([call(item) for item in items], consumeErrors=True)
+
+
+def check_machine_id(value, source):
+    """Return value, or raise ``InvalidMachineId`` if not a UUID.
+
+    >>> check_machine_id("not-a-uuid", "POP_MACHINE_ID")
+    Traceback (most recent call last):
+     ...
+    InvalidMachineId: Invalid machine id 'not-a-uuid' (from POP_MACHINE_ID).
+
+    """
+
+    try:
+        uuid.UUID(str(value))
+    except ValueError:
+        raise InvalidMachineId(value, source)
+
+    return value
+
+
+def machine_id_from_environment():
+    """Return machine identifier set in the environment."""
+
+    value = os.environ.get("POP_MACHINE_ID")
+    if value:
+        return check_machine_id(value, "POP_MACHINE_ID")
+
+
+def machine_id_from_files(paths=(
+        "/etc/machine-id",
+        "/var/lib/dbus/machine-id",
+        "/sys/class/dmi/id/product_uuid",
+        )):
+    """Return machine identifier read from the first available file."""
+
+    for path in paths:
         try:
-            return cast(string)
-        except BaseException:
-            pass
+            with open(path) as f:
+                value = f.read().strip()
+        except (IOError, OSError):
+            continue
+
+        if value:
+            return check_machine_id(value, path)
+
+
+def machine_id_from_hal():
+    """Return hardware identifier reported by HAL."""
+
+    try:
+        return subprocess.check_output(
+            'hal-get-property --udi '
+            '/org/freedesktop/Hal/devices/computer '
+            '--key system.hardware.uuid'.split()
+            ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
 
-    return string
+# Providers are tried in order until one returns an identifier.
+machine_id_providers = [
+    machine_id_from_environment,
+    machine_id_from_files,
+    machine_id_from_hal,
+    ]
+
+_machine_uuid = None
+
+
+def set_local_machine_uuid(value, source="machine id"):
+    """Override local machine unique identifier.
+
+    The ``source`` is named if the value is not a UUID.
+    """
+
+    global _machine_uuid
+
+    if value is not None:
+        value = uuid.UUID(check_machine_id(str(value), source))
+
+    _machine_uuid = value
 
 
 def local_machine_uuid():
     """Return local machine unique identifier.
 
+    The identifier is looked up once using the list of
+    ``machine_id_providers``, then remembered.
+
     >>> uuid = local_machine_uuid()
 
     """
 
-    result = subprocess.check_output(
-        'hal-get-property --udi '
-        '/org/freedesktop/Hal/devices/computer '
-        '--key system.hardware.uuid'.split()
-        ).strip()
+    if _machine_uuid is None:
+        for provider in machine_id_providers:
+            value = provider()
+            if value:
+                set_local_machine_uuid(value)
+                break
+        else:
+            raise RuntimeError("Unable to determine machine identifier.")
 
-    return uuid.UUID(hex=result)
+    return _machine_uuid
 
 
 class DeletedItem(namedtuple("DeletedItem", "key old")):
-    """Represents deleted items when :class:`YAMLState` writes."""
+    """Represents deleted items when changes are merged."""
     def __str__(self):
         return "Setting deleted: %r (was %.100r)" % (self.key, self.old)
 
 
 class ModifiedItem(namedtuple("ModifiedItem", "key old new")):
-    """Represents modified items when :class:`YAMLState` writes."""
+    """Represents modified items when changes are merged."""
     def __str__(self):
         return "Setting changed: %r=%.100r (was %.100r)" % \
             (self.key, self.new, self.old)
 
 
 class AddedItem(namedtuple("AddedItem", "key new")):
-    """Represents added items when :class:`YAMLState` writes."""
+    """Represents added items when changes are merged."""
     def __str__(self):
         return "Setting changed: %r=%.100r (was unset)" % \
             (self.key, self.new)
 
 
+def check_service_name(name):
+    """Raise ``ValueError`` if name can't be used for a service.
+
+    Since instances are named using a dot, a service name must not
+    contain one.
+
+    >>> check_service_name("echo.1")
+    Traceback (most recent call last):
+     ...
+    ValueError: invalid service name: 'echo.1'.
+
+    """
+
+    if not name or "/" in name or "." in name:
+        raise ValueError("invalid service name: %r." % name)
+
+
+def merge(pristine, cache, current):
+    """Apply local changes to ``current`` key by key.
+
+    The local changes are the differences between ``pristine`` (the
+    data as it was read) and ``cache`` (the data as it is now). Keys
+    that were not changed locally keep their current value. Returns
+    a list of the changes that were applied.
+    """
+
+    changes = []
+    missing = object()
+    for key in set(pristine).union(cache):
+        old_value = pristine.get(key, missing)
+        new_value = cache.get(key, missing)
+        if old_value != new_value:
+            if new_value is not missing:
+                current[key] = new_value
+                if old_value is not missing:
+                    changes.append(ModifiedItem(key, old_value, new_value))
+                else:
+                    changes.append(AddedItem(key, new_value))
+            elif key in current:
+                del current[key]
+                changes.append(DeletedItem(key, old_value))
+    return changes
+
+
 class YAMLState(DictMixin, object):
     """Provides a dict like interface around a Zookeeper node
     containing serialised YAML data. The dict provided represents the
@@ -67,10 +211,11 @@ class YAMLState(DictMixin, object):
     `write` writes this information into the Zookeeper node, using a
     retry until success and merges against any existing keys in ZK.
 
-    YAMLState(client, path)
+    YAMLState(client, path, codec=None)
 
     `client`: a Zookeeper client
     `path`: the path of the Zookeeper node to manage
+    `codec`: the codec used to write the node (default: YAML)
 
     The state of this object always represents the product of the
     pristine settings (from Zookeeper) and the pending writes.
@@ -81,9 +226,10 @@ class YAMLState(DictMixin, object):
     # By always updating 'self' on mutation we don't need to do any
     # special handling on data access (gets).
 
-    def __init__(self, client, path):
+    def __init__(self, client, path, codec=None):
         self._client = client
         self._path = path
+        self._format = NodeFormat("yaml", codec)
         self._pristine_cache = None
         self._cache = {}
 
@@ -109,8 +255,8 @@ class YAMLState(DictMixin, object):
         self._pristine_cache = {}
         self._cache = {}
         try:
-            data, stat = yield self._client.get(self._path)
-            data = yaml.load(data)
+            data, stat = yield self._client.get_cached(self._path)
+            data = self._format.loads(data)
             if data:
                 self._pristine_cache = data
                 self._cache = data.copy()
@@ -160,24 +306,9 @@ class YAMLState(DictMixin, object):
 
         def apply_changes(content, stat):
             """Apply the local state to the Zookeeper node state."""
-            del changes[:]
-            current = yaml.load(content) if content else {}
-            missing = object()
-            for key in set(pristine_cache).union(cache):
-                old_value = pristine_cache.get(key, missing)
-                new_value = cache.get(key, missing)
-                if old_value != new_value:
-                    if new_value != missing:
-                        current[key] = new_value
-                        if old_value != missing:
-                            changes.append(
-                                ModifiedItem(key, old_value, new_value))
-                        else:
-                            changes.append(AddedItem(key, new_value))
-                    elif key in current:
-                        del current[key]
-                        changes.append(DeletedItem(key, old_value))
-            return yaml.safe_dump(current)
+            current = self._format.loads(content) if content else {}
+            changes[:] = merge(pristine_cache, cache, current)
+            return self._format.dumps(current)
 
         # Apply the change till it takes.
         yield retry_change(self._client, self._path, apply_changes)
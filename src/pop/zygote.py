@@ -0,0 +1,300 @@
+"""Pre-forked process which starts services.
+
+The zygote imports the service implementations up front and then
+forks a worker for each request it receives. Since it never connects
+to ZooKeeper or runs the reactor, a worker starts out clean, with
+only the standard streams inherited; it connects on its own and runs
+the ``start`` command.
+
+The machine agent talks to the zygote over its standard streams,
+using JSON-encoded messages, one per line:
+
+  ``{"name": <service-name>, "instance": <instance>}``
+    Start an instance of the named service (agent to zygote).
+
+  ``{"name": <service-name>, "pid": <pid>}``
+    The worker was forked (zygote to agent). Replies are sent in the
+    order of the requests.
+
+  ``{"pid": <pid>, "status": <status>}``
+    The worker exited, with the status given by ``os.waitpid``.
+
+Usage::
+
+  $ python -m pop.zygote localhost:2181 /
+
+"""
+
+import gc
+import os
+import sys
+import json
+import errno
+import fcntl
+import signal
+import select
+import logging
+import argparse
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ProcessProtocol
+
+from pop import log
+from pop.exceptions import PopException
+from pop.exceptions import ProcessForked
+from pop.process import fork
+from pop.process import close_fds
+from pop.services import ServiceRegistry
+from pop.utils import local_machine_uuid
+
+
+class ZygoteError(PopException):
+    """Raised when the zygote exits with requests pending."""
+
+
+class Zygote(ProcessProtocol):
+    """Runs the zygote process on behalf of the machine agent.
+
+    The ``exited`` callback is called with the pid and status of each
+    worker that exits.
+    """
+
+    def __init__(self, servers, path, exited=None):
+        self.servers = servers
+        self.path = path
+        self.exited = exited
+        self.pending = []
+        self.stopped = Deferred()
+        self._buffer = ""
+
+    def start(self):
+        from twisted.internet import reactor
+
+        args = [
+            sys.executable, "-m", "pop.zygote", self.servers, self.path,
+            "--verbosity", str(int(log.isEnabledFor(logging.DEBUG))),
+            ]
+
+        # The workers must use the machine id of the agent.
+        env = dict(os.environ, POP_MACHINE_ID=str(local_machine_uuid()))
+
+        log.debug("starting zygote...")
+        reactor.spawnProcess(
+            self, sys.executable, args, env=env,
+            childFDs={0: "w", 1: "r", 2: 2},
+            )
+
+    def fork(self, name, instance=0):
+        """Start service in a new worker; returns a deferred pid."""
+
+        d = Deferred()
+        self.pending.append(d)
+        self.transport.write(
+            json.dumps({"name": name, "instance": instance}) + "\n"
+            )
+        return d
+
+    def stop(self):
+        self.transport.closeStdin()
+        return self.stopped
+
+    def messageReceived(self, message):
+        if "status" in message:
+            log.debug("worker exited: %(pid)d (status: %(status)d)." % (
+                message))
+
+            if self.exited is not None:
+                self.exited(message["pid"], message["status"])
+        else:
+            self.pending.pop(0).callback(message["pid"])
+
+    def connectionMade(self):
+        log.debug("zygote started: %d." % self.transport.pid)
+
+    def outReceived(self, data):
+        lines = (self._buffer + data).split("\n")
+        self._buffer = lines.pop()
+
+        for line in lines:
+            self.messageReceived(json.loads(line))
+
+    def processEnded(self, reason):
+        log.debug("zygote stopped.")
+
+        pending, self.pending = self.pending, []
+        for d in pending:
+            d.errback(ZygoteError("zygote stopped."))
+
+        self.stopped.callback(None)
+
+
+def reinstall_reactor():
+    """Install a new reactor in the worker.
+
+    Importing Twisted installs the default reactor in the zygote;
+    while it's never run, its descriptors (e.g. the epoll instance)
+    would be shared by all workers.
+
+    Modules that imported the reactor at module level before the
+    fork (e.g. ``txzookeeper.client``, which schedules its connection
+    and session events on it) are rebound to the new reactor.
+    """
+
+    import twisted.internet
+    from twisted.internet.default import install
+
+    old = sys.modules.pop("twisted.internet.reactor", None)
+    if hasattr(twisted.internet, "reactor"):
+        del twisted.internet.reactor
+
+    install()
+
+    if old is None:
+        return
+
+    from twisted.internet import reactor
+
+    for module in list(sys.modules.values()):
+        namespace = getattr(module, "__dict__", None)
+        if namespace is not None and namespace.get("reactor") is old:
+            module.reactor = reactor
+
+
+def serve(registry, servers, path, name, instance=0, client_factory=None):
+    """Start service in the worker process (this never returns).
+
+    The client is created using ``client_factory``, which defaults to
+    ``pop.client.ZookeeperClient``.
+    """
+
+    from pop.command import Command
+    from pop.runner import run
+
+    status = 1
+
+    try:
+        gc.enable()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        # The worker reads nothing from the agent, and writes its
+        # output to the standard error stream.
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.dup2(2, 1)
+        close_fds()
+        reinstall_reactor()
+
+        if client_factory is None:
+            from pop.client import ZookeeperClient as client_factory
+
+        client = client_factory(servers, session_timeout=1000)
+        command = Command(client, path, registry)
+
+        def start(options):
+            return command.cmd_start(
+                name=name, wait=True, instance=instance
+                )
+
+        status = run(start, log.level == logging.DEBUG, {})
+    finally:
+        os._exit(status)
+
+
+def reap(stream):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as exc:
+            if exc.errno == errno.ECHILD:
+                break
+            raise
+
+        if pid == 0:
+            break
+
+        write(stream, {"pid": pid, "status": status})
+
+
+def write(stream, message):
+    stream.write(json.dumps(message) + "\n")
+    stream.flush()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("servers")
+    parser.add_argument("path")
+    parser.add_argument("--verbosity", type=int, default=0)
+    options = parser.parse_args(args)
+
+    logging.basicConfig(format="%(asctime)-15s %(message)s")
+    log.setLevel(logging.DEBUG if options.verbosity else logging.INFO)
+
+    # Import the service implementations before forking, such that
+    # the workers share them.
+    registry = ServiceRegistry.from_entry_points()
+    registry.load_all()
+
+    stdout = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    # Exiting workers wake up the loop below using this pipe.
+    wakeup_r, wakeup_w = os.pipe()
+    for fd in (wakeup_r, wakeup_w):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    log.debug("zygote ready (%d services)." % len(registry))
+
+    buffer = ""
+
+    while True:
+        try:
+            readable = select.select([0, wakeup_r], [], [])[0]
+        except (select.error, OSError) as exc:
+            if exc.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if wakeup_r in readable:
+            while True:
+                try:
+                    os.read(wakeup_r, 512)
+                except OSError:
+                    break
+
+            reap(stdout)
+
+        if 0 not in readable:
+            continue
+
+        data = os.read(0, 65536)
+        if not data:
+            break
+
+        lines = (buffer + data).split("\n")
+        buffer = lines.pop()
+
+        for line in lines:
+            request = json.loads(line)
+            name = request["name"]
+            instance = request.get("instance", 0)
+
+            try:
+                pid = fork()
+            except ProcessForked:
+                serve(
+                    registry, options.servers, options.path, str(name),
+                    instance
+                    )
+
+            log.debug("worker started: %d (%s)." % (pid, name))
+            write(stdout, {"name": name, "pid": pid})
+
+
+if __name__ == "__main__":
+    main()